@@ -0,0 +1,257 @@
+import hashlib
+import json
+import os
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from src.grid import DemandPyramid
+from src.h3_utils import geo_to_h3_array
+
+ACCUMULATOR_VERSION = 1
+ACCUMULATOR_DIR = '../data/interim/demand_accumulator'
+
+# Accumulated energy at or below this magnitude (kWh) is treated as zero, so retractions leave no residue
+ZERO_TOLERANCE = 1e-9
+
+
+class DemandAccumulator:
+    """
+    Persisted (hexagon x hour) energy totals of the charging events simulated so far, updated incrementally as
+    new telemetry arrives. The totals are held at one h3 resolution as a sparse (cell x hour) matrix, and every
+    ingested (vehicle, day) contribution is kept so that it can later be retracted. An accumulator is a
+    directory holding:
+
+        manifest.json                 version, resolution, hours and the (vehicle, day) entries ingested
+        cells.npy                     uint64 cell ids, the rows of the totals
+        energy.npz                    sparse (cell x hour) energy totals
+        contributions/<key>.npz       cells, hour positions and energy of one (vehicle, day)
+
+    Ingesting a (vehicle, day) already in the manifest does nothing unless it is replaced, so re-ingesting a
+    day is idempotent, and each update only touches the cells of the new contributions.
+
+    Parameters
+    ____________
+    path : str
+        Directory of the accumulator
+    resolution : int
+        H3 resolution the events are binned at
+    hours : range
+        Hours of the totals
+    """
+
+    def __init__(self, path=ACCUMULATOR_DIR, resolution=8, hours=range(25)):
+        self.path = path
+        self.hours = pd.Index(hours, name='hour')
+        self._removed = set()
+        manifest_path = os.path.join(path, 'manifest.json')
+
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                self.manifest = json.load(f)
+            if self.manifest.get('version') != ACCUMULATOR_VERSION:
+                raise ValueError(f"Accumulator {path} has version {self.manifest.get('version')}, "
+                                 f"expected {ACCUMULATOR_VERSION}")
+            if self.manifest['resolution'] != resolution or self.manifest['hours'] != list(self.hours):
+                raise ValueError(f"Accumulator {path} holds resolution {self.manifest['resolution']} and hours "
+                                 f"{self.manifest['hours']}, not resolution {resolution} and hours {list(self.hours)}")
+
+            self.cells = pd.Index(np.load(os.path.join(path, 'cells.npy')))
+            self.energy = sparse.load_npz(os.path.join(path, 'energy.npz')).tocsr()
+        else:
+            self.manifest = {'version': ACCUMULATOR_VERSION, 'resolution': resolution, 'hours': list(self.hours),
+                             'entries': {}}
+            self.cells = pd.Index(np.array([], dtype=np.uint64))
+            self.energy = sparse.csr_matrix((0, len(self.hours)))
+
+    @property
+    def resolution(self):
+        return self.manifest['resolution']
+
+    def __contains__(self, key):
+        vehicle_id, day = key
+        return str(day) in self.manifest['entries'].get(str(vehicle_id), {})
+
+    def entries(self):
+        """
+        (vehicle, day) pairs ingested so far
+        """
+
+        return [(vehicle_id, day) for vehicle_id, days in self.manifest['entries'].items() for day in days]
+
+    def _contribution_path(self, vehicle_id, day):
+        key = hashlib.sha1(f'{vehicle_id}\0{day}'.encode()).hexdigest()[:20]
+        return os.path.join(self.path, 'contributions', f'{key}.npz')
+
+    def _bin(self, events, by=()):
+        # Energy of the hourly charges summed by the columns by, cell and hour position
+        keys = list(by) + ['cell', 'hour']
+        if not len(events):
+            return pd.DataFrame({key: np.array([], dtype=np.int64) for key in keys}).assign(energy=0.0)
+
+        cells = geo_to_h3_array(events['latitude'].values, events['longitude'].values, self.resolution)
+        hours = self.hours.get_indexer(np.asarray(events['hour']))
+        keep = (cells != 0) & (hours >= 0)
+
+        binned = pd.DataFrame({**{column: np.asarray(events[column])[keep] for column in by},
+                               'cell': cells[keep], 'hour': hours[keep],
+                               'energy': np.nan_to_num(np.asarray(events['energy'], dtype=np.float64)[keep])})
+
+        return binned.groupby(keys, sort=True)['energy'].sum().reset_index()
+
+    def _apply(self, contributions):
+        # Scatter-add signed (cells, hours, energy) contributions into the totals in one update, appending the rows
+        # of the cells seen for the first time once, so a batch costs one pass over the totals
+        if not contributions:
+            return
+
+        cells, hours, energy = (np.concatenate([contribution[k] for contribution in contributions]) for k in range(3))
+        cells = cells.astype(np.uint64)
+
+        rows = self.cells.get_indexer(cells)
+        new_cells = pd.unique(cells[rows < 0])
+        if len(new_cells):
+            self.cells = self.cells.append(pd.Index(new_cells.astype(np.uint64)))
+            self.energy.resize((len(self.cells), len(self.hours)))
+            rows = self.cells.get_indexer(cells)
+
+        # Duplicate (cell, hour) entries are summed when converting to CSR
+        update = sparse.coo_matrix((energy, (rows, hours.astype(np.int64))), shape=self.energy.shape).tocsr()
+        self.energy = (self.energy + update).tocsr()
+
+        # Drop the cells left empty by retractions
+        self.energy.data[np.abs(self.energy.data) <= ZERO_TOLERANCE] = 0
+        self.energy.eliminate_zeros()
+
+    def _ingest(self, contributions, replace):
+        # Record (vehicle_id, day, events, binned) contributions and add them to the totals in one update, with the
+        # retractions of those they replace
+        updates, ingested = [], []
+        for vehicle_id, day, events, binned in contributions:
+            if (vehicle_id, day) in self:
+                if not replace:
+                    continue
+                updates.append(self._retract(vehicle_id, day))
+
+            cells = binned['cell'].values.astype(np.uint64)
+            hours = binned['hour'].values.astype(np.int64)
+            energy = binned['energy'].values.astype(np.float64)
+            updates.append((cells, hours, energy))
+
+            # Keep the contribution so it can be retracted, and record it in the manifest
+            path = self._contribution_path(vehicle_id, day)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            np.savez(path, cells=cells, hours=hours, energy=energy)
+            self._removed.discard(path)
+            self.manifest['entries'].setdefault(vehicle_id, {})[day] = {'events': int(events),
+                                                                        'energy': float(energy.sum())}
+            ingested.append(vehicle_id)
+
+        self._apply(updates)
+
+        return ingested
+
+    def ingest(self, vehicle_id, day, events, replace=False):
+        """
+        Add the hourly charges of one vehicle on one day to the totals
+
+        parameters
+        ---------
+        vehicle_id:str - identifier of the vehicle
+        day:str - label of the telemetry day the events were simulated from, ex. '2020-01-15'
+        events:pd.DataFrame - hourly charges, with columns ['latitude','longitude','hour','energy'], may be empty
+        replace:bool - replace the contribution if the (vehicle, day) was already ingested, otherwise skip it
+
+        returns
+        ---------
+        ingested:bool - whether the totals changed
+        """
+
+        return bool(self._ingest([(str(vehicle_id), str(day), len(events), self._bin(events))], replace))
+
+    def ingest_frame(self, hourly_charges, day, vehicle_ids=None, replace=False):
+        """
+        Add the hourly charges of many vehicles on one day, split by their 'vehicle_id' column, binning them
+        together and updating the totals once. Vehicles of vehicle_ids without any charge are recorded too, so
+        they are not simulated again
+
+        returns
+        ---------
+        ingested:list - vehicle ids whose contribution was added
+        """
+
+        day = str(day)
+        binned = self._bin(hourly_charges, by=['vehicle_id'])
+        groups = dict(tuple(binned.groupby('vehicle_id', sort=False))) if len(binned) else {}
+        events = hourly_charges['vehicle_id'].value_counts() if len(hourly_charges) else pd.Series(dtype=np.int64)
+        empty = binned.iloc[:0]
+
+        vehicles = dict.fromkeys(list(pd.unique(hourly_charges['vehicle_id']) if len(hourly_charges) else [])
+                                 + list(vehicle_ids or []))
+        contributions = [(str(vehicle_id), day, events.get(vehicle_id, 0), groups.get(vehicle_id, empty))
+                         for vehicle_id in vehicles]
+
+        return self._ingest(contributions, replace)
+
+    def _retract(self, vehicle_id, day):
+        # Remove a contribution from the manifest, returning it with negated energy for _apply
+        path = self._contribution_path(vehicle_id, day)
+        with np.load(path) as contribution:
+            retraction = (contribution['cells'], contribution['hours'], -contribution['energy'])
+
+        # The file is removed when the accumulator is saved, so an unsaved retraction can be abandoned
+        self._removed.add(path)
+        del self.manifest['entries'][vehicle_id][day]
+        if not self.manifest['entries'][vehicle_id]:
+            del self.manifest['entries'][vehicle_id]
+
+        return retraction
+
+    def retract(self, vehicle_id, day=None):
+        """
+        Remove the contribution of a vehicle on a day, or on every day if day is None, from the totals
+
+        returns
+        ---------
+        days:list - days retracted
+        """
+
+        vehicle_id = str(vehicle_id)
+        days = list(self.manifest['entries'].get(vehicle_id, {})) if day is None else [str(day)]
+        days = [day for day in days if (vehicle_id, day) in self]
+
+        self._apply([self._retract(vehicle_id, day) for day in days])
+
+        return days
+
+    def save(self):
+        """
+        Write the totals and the manifest, the manifest last and atomically so a reader never sees totals that
+        do not match it
+        """
+
+        os.makedirs(self.path, exist_ok=True)
+
+        for name, write in [('cells.npy', lambda f: np.save(f, self.cells.values.astype(np.uint64))),
+                            ('energy.npz', lambda f: sparse.save_npz(f, self.energy))]:
+            path = os.path.join(self.path, name)
+            with open(path + '.tmp', 'wb') as f:
+                write(f)
+            os.replace(path + '.tmp', path)
+
+        manifest_path = os.path.join(self.path, 'manifest.json')
+        with open(manifest_path + '.tmp', 'w') as f:
+            json.dump(self.manifest, f, indent=2)
+        os.replace(manifest_path + '.tmp', manifest_path)
+
+        for path in self._removed:
+            if os.path.exists(path):
+                os.remove(path)
+        self._removed = set()
+
+    def pyramid(self, min_resolution=None):
+        """
+        DemandPyramid of the totals, with the accumulator's resolution as its base
+        """
+
+        return DemandPyramid.from_cells(self.cells.values, {'energy': self.energy}, self.resolution, min_resolution,
+                                        self.hours)
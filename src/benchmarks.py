@@ -0,0 +1,124 @@
+# Regular Imports
+import time
+from types import SimpleNamespace
+import numpy as np
+import pandas as pd
+from src.components import Vehicle, ChargingEventSink
+from src.simulation import VehicleSimulation
+from src.lp_sparse import sparse_linear_program, INPUT_DIR
+from src.lp_solvers import solver_backend, OPTIMAL
+
+
+class _FixedDistanceModel:
+    """
+    Charge location model that always charges after the same number of miles
+    """
+
+    def __init__(self, miles):
+        self.miles = miles
+
+    def run(self, vehicle, rng=None):
+        return self.miles
+
+
+class _RechargeModel:
+    """
+    Charge amount model that replaces exactly the energy used since the last charge
+    """
+
+    def __init__(self, miles):
+        self.miles = miles
+
+    def run(self, vehicle):
+        return (self.miles / vehicle.range) * vehicle.battery_capacity
+
+
+def synthetic_trajectory(identifier, miles, pings, start='2020-01-01'):
+    """
+    Build a straight-line trajectory covering the input number of miles with evenly spaced pings,
+    shaped like the movingpandas trajectories the Vehicle class is built from
+    """
+
+    times = pd.date_range(start, periods=pings, freq='1min')
+    df = pd.DataFrame({
+        'hashed_vin': identifier,
+        'odo_read': np.linspace(0, miles, pings),
+        'element_time_local': times.astype(str),
+        'decr_lat': np.linspace(34.0, 34.2, pings),
+        'decr_lng': np.linspace(-118.4, -118.2, pings),
+    }, index=pd.Index(times, name='t'))
+
+    return SimpleNamespace(df=df)
+
+
+def benchmark_event_scaling(event_counts=(1000, 2000, 4000, 8000), vehicles=10, pings=200, miles_per_charge=100):
+    """
+    Time the per-vehicle simulation core for an increasing number of charge events. The trajectory length is
+    held fixed so that only the number of events grows; time per event should stay flat.
+
+    returns
+    ---------
+    df:pd.DataFrame - one row per event count with the wall time and time per event
+    """
+
+    location_model = _FixedDistanceModel(miles_per_charge)
+    amount_model = _RechargeModel(miles_per_charge)
+
+    results = []
+    for event_count in event_counts:
+        miles = event_count // vehicles * miles_per_charge
+        fleet = [Vehicle(synthetic_trajectory(f'vehicle_{i}', miles, pings)) for i in range(vehicles)]
+
+        start = time.perf_counter()
+        charging_events = ChargingEventSink()
+        for vehicle in fleet:
+            VehicleSimulation(location_model, amount_model, charging_events).run(vehicle)
+        charging_events.to_frame()
+        seconds = time.perf_counter() - start
+
+        results.append({'events': len(charging_events), 'seconds': seconds,
+                        'microseconds_per_event': 1e6 * seconds / len(charging_events)})
+
+    return pd.DataFrame(results)
+
+
+def benchmark_solver_backends(input_dir=INPUT_DIR, backends=('glpk', 'cbc', 'highs'), **controls):
+    """
+    Solve the same siting LP instance with each installed solver backend and the same controls (time_limit,
+    threads, mip_gap, presolve). The instance is built once as a Pyomo model of the sparse matrix and shared
+    by the backends; backends that are not installed are skipped.
+
+    returns
+    ---------
+    df:pd.DataFrame - one row per backend with the status, objective and build, presolve, solve and extract seconds
+    """
+
+    start = time.perf_counter()
+    lp = sparse_linear_program(input_dir)
+    lp.load()
+    lp.build()
+    model = lp.to_pyomo()
+    build_seconds = time.perf_counter() - start
+
+    results = []
+    for name in backends:
+        backend = solver_backend(name, **controls)
+        if not backend.available():
+            continue
+
+        record = backend.solve(model)
+
+        # Only an optimal solve has a solution to extract
+        if record['status'] == OPTIMAL:
+            start = time.perf_counter()
+            lp.split_solution(np.array([model.z[j].value or 0.0 for j in range(lp.A.shape[1])]), record['objective'])
+            record['extract_seconds'] = time.perf_counter() - start
+        record['build_seconds'] = build_seconds
+        results.append(record)
+
+    return pd.DataFrame(results).set_index('backend')
+
+
+if __name__ == '__main__':
+    print(benchmark_event_scaling())
+    print(benchmark_solver_backends())
@@ -1,53 +1,121 @@
+import numpy as np
 import pandas as pd
 import geopandas as gpd
 from fiona.crs import from_epsg
 from datetime import timedelta
 from geojson.feature import *
+from collections import namedtuple
+
+# Pings of one vehicle in time order, times as int64 epoch nanoseconds in the time zone tz
+TrajectoryArrays = namedtuple('TrajectoryArrays', ['identifier', 'odometer', 'times', 'latitudes', 'longitudes', 'tz'])
 
 
 class Vehicle:
     """
     A class to represent a vehicle in EV charging simulation
 
+    A vehicle only holds its scalar state. Its pings live in a TrajectoryStore, sorted by odometer reading in
+    a contiguous segment of the store's arrays, so a fleet built from one store shares a single set of arrays
+    and no per-vehicle pandas objects are kept.
+
     Attributes
     ----------
     identifier : string
         Unique vehicle identifier
-    trajectory : movingpandas object
-        The movingpandas trajectory object describing the vehicles movement
     range : int
         Range in miles of vehicle on full battery
     state_of_charge : int
         Simulated battery state of charge of vehicle
     odometer_reading : float
         Reading of odometer at current vehicle state
+    epoch_time : int
+        Current time of vehicle state, as int64 epoch nanoseconds
     time : Datetime
-        Current time of vehicle state
+        Current time of vehicle state, as a Timestamp in the trajectory's time zone
     latitude : float
         latitude of current state of vehicle
     longitude : float
         longitude of current state of vehicle
-    charge_events : Pandas DataFrame
-        Pandas DataFrame holding charging event information
     max_odo : float
         Maximum odometer reading in the trajectory
     battery_capacity : int
         55 kWh for Bolt EV
+    interpolate : bool
+        If True, position and time are interpolated between the pings either side of the odometer reading,
+        otherwise they are taken from the closest ping
+    store : TrajectoryStore
+        Store holding the vehicle's pings
+    row : int
+        Position of the vehicle in the store
    """
 
-    def __init__(self, trajectory):
-        self.identifier = trajectory.df.hashed_vin.iloc[0]
-        self.trajectory = trajectory
+    __slots__ = ('identifier', 'range', 'state_of_charge', 'odometer_reading', 'epoch_time', 'latitude', 'longitude',
+                 'max_odo', 'battery_capacity', 'interpolate', 'store', 'row', '_start', '_end')
+
+    def __init__(self, trajectory, interpolate=False):
+        df = trajectory.df
+        times = pd.to_datetime(df.element_time_local)
+        arrays = TrajectoryArrays(df.hashed_vin.iloc[0], df.odo_read.values,
+                                  times.values.astype('datetime64[ns]').astype(np.int64), df.decr_lat.values,
+                                  df.decr_lng.values, times.dt.tz)
+
+        self._attach(TrajectoryStore.from_arrays([arrays]), 0, interpolate)
+
+    @classmethod
+    def from_arrays(cls, arrays, interpolate=False):
+        """
+        Build a vehicle directly from a TrajectoryArrays bundle of its pings in time order, without a movingpandas
+        trajectory
+        """
+
+        return cls.from_store(TrajectoryStore.from_arrays([arrays]), 0, interpolate)
+
+    @classmethod
+    def from_store(cls, store, row, interpolate=False):
+        """
+        Build the vehicle of a row of a TrajectoryStore, referencing the store's arrays
+        """
+
+        vehicle = cls.__new__(cls)
+        vehicle._attach(store, row, interpolate)
+        return vehicle
+
+    def _attach(self, store, row, interpolate):
+        # Vehicle state at the start of its trajectory in the store
+        self.store = store
+        self.row = row
+        self._start = int(store.offsets[row])
+        self._end = self._start + int(store.lengths[row])
+
+        self.identifier = store.identifiers[row]
         self.range = 259
         self.state_of_charge = 100
-        self.odometer_reading = trajectory.df.odo_read.min()
-        self.time = pd.to_datetime(trajectory.df.element_time_local).min()
-        self.latitude = trajectory.df.decr_lat[0]
-        self.longitude = trajectory.df.decr_lng[0]
-        self.charging_events = pd.DataFrame(
-            columns=['latitude', 'longitude', 'start_time', 'end_time', 'delta_soc', 'state_of_charge', 'energy'])
-        self.max_odo = trajectory.df.odo_read.max()
+        self.odometer_reading = store.odometer[self._start] if self._end > self._start else np.nan
+        self.epoch_time = int(store.start_times[row])
+        self.latitude = store.start_latitudes[row]
+        self.longitude = store.start_longitudes[row]
+        self.max_odo = store.odometer[self._end - 1] if self._end > self._start else np.nan
         self.battery_capacity = 55
+        self.interpolate = interpolate
+
+    def __getstate__(self):
+        # Pickle only the vehicle's own segment of a shared store, so chunks sent to workers stay small
+        state = {slot: getattr(self, slot) for slot in self.__slots__}
+        if len(self.store) > 1:
+            state.update(store=TrajectoryStore.from_vehicles([self]), row=0, _start=0, _end=self._end - self._start)
+        return state
+
+    def __setstate__(self, state):
+        for slot, value in state.items():
+            setattr(self, slot, value)
+
+    @property
+    def time(self):
+        return self._timestamp(self.epoch_time)
+
+    @time.setter
+    def time(self, time):
+        self.epoch_time = pd.Timestamp(time).value
 
     def __repr__(self):
         representation = (
@@ -74,20 +142,44 @@ class Vehicle:
         self.odometer_reading += miles
         self.state_of_charge -= (100 * (miles / self.range))
 
-        # Look for the closest odometer reading in the trajectory data
-        self.trajectory.df['odo_diff'] = abs(self.trajectory.df['odo_read'] - self.odometer_reading)
-        closest_ping = self.trajectory.df[self.trajectory.df['odo_diff'] == self.trajectory.df['odo_diff'].min()]
+        # Views of the vehicle's segment of the store
+        store, start, end = self.store, self._start, self._end
+        odometer = store.odometer[start:end]
+        i = np.searchsorted(odometer, self.odometer_reading)
+
+        if self.interpolate:
+            # Interpolate time and gps between the pings either side of the odometer reading
+            i = min(max(i, 1), len(odometer) - 1)
+            span = odometer[i] - odometer[i - 1]
+            weight = 0.0 if span == 0 else min(max((self.odometer_reading - odometer[i - 1]) / span, 0.0), 1.0)
+
+            times = store.times[start:end]
+            latitudes = store.latitudes[start:end]
+            longitudes = store.longitudes[start:end]
+            self.epoch_time = int(times[i - 1] + int(round(weight * (times[i] - times[i - 1]))))
+            self.latitude = latitudes[i - 1] + weight * (latitudes[i] - latitudes[i - 1])
+            self.longitude = longitudes[i - 1] + weight * (longitudes[i] - longitudes[i - 1])
+
+        else:
+            # Look for the closest odometer reading in the trajectory data, preferring the earlier ping on ties
+            reading = self.odometer_reading
+            if i == len(odometer) or (i > 0 and reading - odometer[i - 1] <= odometer[i] - reading):
+                i = np.searchsorted(odometer, odometer[i - 1])
 
-        # Set time and gps to that in the trajectory data
-        self.time = pd.to_datetime(closest_ping.element_time_local.iloc[0])
+            # Set time and gps to that in the trajectory data
+            self.epoch_time = int(store.times[start + i])
+            self.latitude = store.latitudes[start + i]
+            self.longitude = store.longitudes[start + i]
 
-        # Set longitude and latitude
-        self.latitude = closest_ping.decr_lat[0]
-        self.longitude = closest_ping.decr_lng[0]
+    def _timestamp(self, time):
+        # Convert an int64 epoch time back to a Timestamp in the trajectory's time zone
+        if self.store.tz is None:
+            return pd.Timestamp(time)
+        return pd.Timestamp(time, tz='UTC').tz_convert(self.store.tz)
 
     def charge(self, energy):
         """
-        Charges the vehicle and adds a charging event to charge_events
+        Charges the vehicle and returns the resulting charging event
 
         Parameters
         ----------
@@ -95,6 +187,12 @@ class Vehicle:
             Python Vehicle Class Object
         energy: int
             kWh of energy added to the vehicle
+
+        Returns
+        -------
+        charging_event: tuple
+            (latitude, longitude, start_time, end_time, delta_soc, start_soc, energy), as recorded by a
+            ChargingEventSink
         """
 
         # Derive delta_soc from energy
@@ -105,12 +203,327 @@ class Vehicle:
         start_time = self.time
         end_time = start_time + duration
 
-        # Create a charging event and add to events
-        charging_event = pd.DataFrame(
-            [[self.latitude, self.longitude, start_time, end_time, delta_soc, self.state_of_charge, energy]],
-            columns=['latitude', 'longitude', 'start_time', 'end_time', 'delta_soc', 'start_soc', 'energy'])
-
-        self.charging_events = self.charging_events.append(charging_event)
+        # Create the charging event
+        charging_event = (self.latitude, self.longitude, start_time, end_time, delta_soc, self.state_of_charge, energy)
 
         # Increase the state_of_charge by delta_soc
         self.state_of_charge += delta_soc
+
+        return charging_event
+
+
+class TrajectoryStore:
+    """
+    Fleet-wide column store of vehicle trajectories. Each vehicle's pings are sorted by odometer reading and
+    stored contiguously, addressed by an offset and length per vehicle, so that the closest ping can be found
+    for many vehicles at once with a segmented binary search, and so vehicles can reference their segment
+    instead of holding their own arrays.
+
+    Attributes
+    ----------
+    odometer : np.ndarray
+        Odometer readings of every ping, sorted within each vehicle
+    times : np.ndarray
+        int64 epoch nanosecond times aligned with odometer
+    latitudes : np.ndarray
+        Latitudes aligned with odometer
+    longitudes : np.ndarray
+        Longitudes aligned with odometer
+    offsets : np.ndarray
+        Position of each vehicle's first ping
+    lengths : np.ndarray
+        Number of pings for each vehicle
+    tz : tzinfo
+        Time zone of the trajectory times
+    identifiers : np.ndarray
+        Identifier of each vehicle
+    start_times : np.ndarray
+        int64 epoch nanosecond time of each vehicle's first ping
+    start_latitudes, start_longitudes : np.ndarray
+        Position of each vehicle's first ping in time
+    """
+
+    def __init__(self, odometer, times, latitudes, longitudes, offsets, lengths, tz=None, identifiers=None,
+                 start_times=None, start_latitudes=None, start_longitudes=None):
+        self.odometer = odometer
+        self.times = times
+        self.latitudes = latitudes
+        self.longitudes = longitudes
+        self.offsets = offsets
+        self.lengths = lengths
+        self.tz = tz
+        self.identifiers = identifiers
+        self.start_times = start_times
+        self.start_latitudes = start_latitudes
+        self.start_longitudes = start_longitudes
+
+    def __len__(self):
+        return len(self.offsets)
+
+    @classmethod
+    def from_arrays(cls, trajectories):
+        """
+        Build a store from TrajectoryArrays bundles, each vehicle's pings in time order, dropping pings without an
+        odometer reading from the sorted segments
+        """
+
+        segments, starts = [], []
+        tz = None
+        for arrays in trajectories:
+            odometer = np.asarray(arrays.odometer, dtype=np.float64)
+            times = np.asarray(arrays.times, dtype=np.int64)
+            latitudes = np.asarray(arrays.latitudes, dtype=np.float64)
+            longitudes = np.asarray(arrays.longitudes, dtype=np.float64)
+            tz = tz if tz is not None else arrays.tz
+
+            # A stable sort keeps pings with equal readings in time order
+            valid = np.flatnonzero(~np.isnan(odometer))
+            order = valid[np.argsort(odometer[valid], kind='mergesort')]
+            segments.append((odometer[order], times[order], latitudes[order], longitudes[order]))
+            starts.append((arrays.identifier, times.min(), latitudes[0], longitudes[0]))
+
+        lengths = np.array([len(segment[0]) for segment in segments], dtype=np.int64)
+        offsets = np.concatenate([[0], np.cumsum(lengths)[:-1]]).astype(np.int64)
+        identifiers, start_times, start_latitudes, start_longitudes = zip(*starts)
+
+        return cls(*(np.concatenate([segment[k] for segment in segments]) for k in range(4)), offsets, lengths, tz,
+                   np.array(identifiers, dtype=object), np.array(start_times, dtype=np.int64),
+                   np.array(start_latitudes, dtype=np.float64), np.array(start_longitudes, dtype=np.float64))
+
+    def vehicles(self, interpolate=False):
+        """
+        One Vehicle per row of the store, all referencing the store's arrays
+        """
+
+        return [Vehicle.from_store(self, row, interpolate) for row in range(len(self))]
+
+    @classmethod
+    def from_vehicles(cls, vehicles):
+        """
+        Store of the input vehicles' segments, in order. Vehicles that are the rows of one store in order
+        share that store, otherwise their segments are gathered into a new one
+        """
+
+        stores = {id(vehicle.store) for vehicle in vehicles}
+        if len(stores) == 1 and [vehicle.row for vehicle in vehicles] == list(range(len(vehicles[0].store))):
+            return vehicles[0].store
+
+        segments = [np.arange(vehicle._start, vehicle._end) for vehicle in vehicles]
+        lengths = np.array([len(segment) for segment in segments], dtype=np.int64)
+        offsets = np.concatenate([[0], np.cumsum(lengths)[:-1]]).astype(np.int64)
+        tz = next((vehicle.store.tz for vehicle in vehicles if vehicle.store.tz is not None), None)
+
+        def gather(column):
+            return np.concatenate([getattr(vehicle.store, column)[segment]
+                                   for vehicle, segment in zip(vehicles, segments)])
+
+        def start(column):
+            return np.array([getattr(vehicle.store, column)[vehicle.row] for vehicle in vehicles])
+
+        return cls(gather('odometer'), gather('times'), gather('latitudes'), gather('longitudes'), offsets, lengths,
+                   tz, start('identifiers').astype(object), start('start_times'), start('start_latitudes'),
+                   start('start_longitudes'))
+
+    def _search(self, rows, readings):
+        # Binary search each vehicle's segment for the first ping at or beyond the reading
+        lo = self.offsets[rows].copy()
+        hi = lo + self.lengths[rows]
+        searching = lo < hi
+        while searching.any():
+            mid = (lo + hi) // 2
+            beyond = self.odometer[np.minimum(mid, len(self.odometer) - 1)] >= readings
+            hi = np.where(searching & beyond, mid, hi)
+            lo = np.where(searching & ~beyond, mid + 1, lo)
+            searching = lo < hi
+        return lo
+
+    def locate(self, rows, readings, interpolate=False):
+        """
+        Find the time and position of the input vehicles (rows) at the input odometer readings, from the closest
+        ping or interpolated between the pings either side, matching Vehicle.drive
+
+        returns
+        ---------
+        times, latitudes, longitudes:np.ndarray - one element per row
+        """
+
+        start = self.offsets[rows]
+        end = start + self.lengths[rows]
+        i = self._search(rows, readings)
+
+        if interpolate:
+            i = np.minimum(np.maximum(i, start + 1), end - 1)
+            span = self.odometer[i] - self.odometer[i - 1]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                weight = np.where(span == 0, 0.0, (readings - self.odometer[i - 1]) / span)
+            weight = np.clip(weight, 0.0, 1.0)
+
+            times = self.times[i - 1] + np.round(weight * (self.times[i] - self.times[i - 1])).astype(np.int64)
+            latitudes = self.latitudes[i - 1] + weight * (self.latitudes[i] - self.latitudes[i - 1])
+            longitudes = self.longitudes[i - 1] + weight * (self.longitudes[i] - self.longitudes[i - 1])
+            return times, latitudes, longitudes
+
+        # Take the closest ping, preferring the earliest one on ties
+        below = self.odometer[np.maximum(i - 1, start)]
+        above = self.odometer[np.minimum(i, end - 1)]
+        earlier = (i == end) | ((i > start) & (readings - below <= above - readings))
+        i = np.where(earlier, self._search(rows, below), i)
+
+        return self.times[i], self.latitudes[i], self.longitudes[i]
+
+
+class ChargingEventSink:
+    """
+    Column store of simulated charging events, backed by preallocated NumPy buffers that double in size when full.
+    Events are appended one at a time during simulation and converted to a GeoDataFrame once at the end.
+
+    Attributes
+    ----------
+    size : int
+        Number of events recorded
+    vehicle_ids : list
+        Vehicle identifiers, indexed by the integer vehicle codes stored with each event
+    tz : tzinfo
+        Time zone of the recorded timestamps, times are stored as int64 epoch nanoseconds
+    """
+
+    float_columns = ['latitude', 'longitude', 'delta_soc', 'start_soc', 'energy']
+    time_columns = ['start_time', 'end_time']
+
+    def __init__(self, capacity=1024):
+        self.size = 0
+        self.tz = None
+        self.vehicle_ids = []
+        self._vehicle_codes = {}
+        self._columns = {}
+        self._allocate(capacity)
+
+    def __len__(self):
+        return self.size
+
+    def _allocate(self, capacity):
+        # Create (or grow) the column buffers, keeping the recorded events
+        columns = {column: np.empty(capacity, dtype=np.float64) for column in self.float_columns}
+        columns.update({column: np.empty(capacity, dtype=np.int64) for column in self.time_columns})
+        columns['vehicle'] = np.empty(capacity, dtype=np.int32)
+
+        for column, buffer in self._columns.items():
+            columns[column][:self.size] = buffer[:self.size]
+
+        self._columns = columns
+        self.capacity = capacity
+
+    def _vehicle_code(self, vehicle_id):
+        code = self._vehicle_codes.get(vehicle_id)
+        if code is None:
+            code = self._vehicle_codes[vehicle_id] = len(self.vehicle_ids)
+            self.vehicle_ids.append(vehicle_id)
+        return code
+
+    def _epoch(self, time):
+        time = pd.Timestamp(time)
+        if time.tz is not None:
+            self.tz = time.tz
+        return time.value
+
+    def append(self, vehicle_id, latitude, longitude, start_time, end_time, delta_soc, start_soc, energy):
+        """
+        Record one charging event, start_time and end_time may be Timestamps or int64 epoch nanoseconds
+        """
+
+        if self.size == self.capacity:
+            self._allocate(2 * self.capacity)
+
+        i = self.size
+        columns = self._columns
+        columns['vehicle'][i] = self._vehicle_code(vehicle_id)
+        columns['latitude'][i] = latitude
+        columns['longitude'][i] = longitude
+        columns['start_time'][i] = self._epoch(start_time)
+        columns['end_time'][i] = self._epoch(end_time)
+        columns['delta_soc'][i] = delta_soc
+        columns['start_soc'][i] = start_soc
+        columns['energy'][i] = energy
+        self.size += 1
+
+    def register(self, vehicle_ids):
+        """
+        Assign vehicle codes for the input identifiers, in order, for use with append_batch
+        """
+
+        return np.array([self._vehicle_code(vehicle_id) for vehicle_id in vehicle_ids], dtype=np.int32)
+
+    def append_batch(self, vehicle_codes, latitude, longitude, start_time, end_time, delta_soc, start_soc, energy,
+                     tz=None):
+        """
+        Record one charging event per element of the input arrays, times as int64 epoch nanoseconds in time zone tz
+        """
+
+        n = len(vehicle_codes)
+        if self.size + n > self.capacity:
+            self._allocate(max(2 * self.capacity, self.size + n))
+
+        self.tz = self.tz or tz
+        values = {'vehicle': vehicle_codes, 'latitude': latitude, 'longitude': longitude, 'start_time': start_time,
+                  'end_time': end_time, 'delta_soc': delta_soc, 'start_soc': start_soc, 'energy': energy}
+
+        for column, buffer in self._columns.items():
+            buffer[self.size:self.size + n] = values[column]
+
+        self.size += n
+
+    def sort_by_vehicle(self):
+        """
+        Reorder the recorded events by vehicle code, keeping each vehicle's events in recorded order
+        """
+
+        order = np.argsort(self._columns['vehicle'][:self.size], kind='mergesort')
+
+        for buffer in self._columns.values():
+            buffer[:self.size] = buffer[:self.size][order]
+
+    def extend(self, other):
+        """
+        Append every event of another sink, in order
+        """
+
+        if self.size + other.size > self.capacity:
+            self._allocate(max(2 * self.capacity, self.size + other.size))
+
+        # Recode the other sink's vehicles into this sink's codes
+        self.tz = self.tz or other.tz
+        recode = np.array([self._vehicle_code(vehicle_id) for vehicle_id in other.vehicle_ids], dtype=np.int32)
+
+        for column, buffer in self._columns.items():
+            values = other._columns[column][:other.size]
+            buffer[self.size:self.size + other.size] = recode[values] if column == 'vehicle' else values
+
+        self.size += other.size
+
+    def to_frame(self):
+        """
+        Convert the recorded events to a GeoDataFrame with one row per charging event
+        """
+
+        columns = {column: buffer[:self.size] for column, buffer in self._columns.items()}
+
+        # Restore the time zone of the recorded timestamps
+        times = {}
+        for column in self.time_columns:
+            times[column] = pd.to_datetime(columns[column], utc=self.tz is not None)
+            if self.tz is not None:
+                times[column] = times[column].tz_convert(self.tz)
+
+        events = pd.DataFrame({
+            'latitude': columns['latitude'],
+            'longitude': columns['longitude'],
+            'start_time': times['start_time'],
+            'end_time': times['end_time'],
+            'delta_soc': columns['delta_soc'],
+            'start_soc': columns['start_soc'],
+            'energy': columns['energy'],
+            'vehicle_id': np.array(self.vehicle_ids, dtype=object)[columns['vehicle']],
+        })
+
+        return gpd.GeoDataFrame(events, geometry=gpd.points_from_xy(events.latitude, events.longitude),
+                                crs=from_epsg(4326))
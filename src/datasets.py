@@ -0,0 +1,109 @@
+import hashlib
+import os
+import numpy as np
+import pandas as pd
+
+CHARGING_EVENTS = '../data/raw/charges_derived_joined_charger.csv'
+DATASET_CACHE_DIR = '../data/interim/dataset_cache'
+
+# Datasets of the default registry, with the columns the models use and their dtypes
+DATASETS = {
+    'charging_events': (CHARGING_EVENTS, {'start_soc': 'float32', 'delta_soc': 'float32'}),
+}
+
+
+def _fingerprint(path):
+    # Identity of a source file version, from its path, size and modification time, without reading it
+    stat = os.stat(path)
+    return hashlib.sha1(f'{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime_ns}'.encode()).hexdigest()[:16]
+
+
+class DatasetRegistry:
+    """
+    Read-only columns of the raw datasets shared by the models. The first use of a dataset reads only its
+    registered columns from the csv, with compact dtypes, and writes each column to a .npy sidecar in the
+    cache directory. Later uses, in this or any other process, memory-map the sidecars, so the csv is parsed
+    once per version of the file and the operating system shares a single copy of the pages between
+    processes. Arrays are also memoized in the registry.
+
+    A registry pickles as its configuration only, so models holding one stay small when sent to worker
+    processes.
+
+    Parameters
+    ____________
+    datasets : dict
+        Dataset name to (csv path, {column: dtype}), defaults to DATASETS
+    cache_dir : str
+        Directory of the .npy sidecars
+    """
+
+    def __init__(self, datasets=None, cache_dir=DATASET_CACHE_DIR):
+        self.datasets = dict(DATASETS if datasets is None else datasets)
+        self.cache_dir = cache_dir
+        self._arrays = {}
+
+    def __getstate__(self):
+        return {'datasets': self.datasets, 'cache_dir': self.cache_dir}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def register(self, name, path, columns):
+        """
+        Add or replace a dataset, given its csv path and a dict of the columns to load and their dtypes
+        """
+
+        self.datasets[name] = (path, dict(columns))
+        self._arrays = {key: array for key, array in self._arrays.items() if key[0] != name}
+
+    def _sidecar(self, name, column, suffix=''):
+        path, _ = self.datasets[name]
+        return os.path.join(self.cache_dir, f'{name}_{_fingerprint(path)}_{column}{suffix}.npy')
+
+    def _save(self, path, array):
+        # Write to a temporary file and move it into place, so concurrent readers never see a partial file
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.tmp.npy'
+        np.save(tmp_path, array)
+        os.replace(tmp_path, path)
+
+    def _build(self, name):
+        # Parse the registered columns of the csv once and write their sidecars
+        path, columns = self.datasets[name]
+        df = pd.read_csv(path, usecols=list(columns), dtype=columns)
+        for column in columns:
+            self._save(self._sidecar(name, column), df[column].values)
+
+    def column(self, name, column):
+        """
+        A column of a dataset as a read-only memory-mapped array
+        """
+
+        key = (name, column, '')
+        if key not in self._arrays:
+            sidecar = self._sidecar(name, column)
+            if not os.path.exists(sidecar):
+                self._build(name)
+            self._arrays[key] = np.load(sidecar, mmap_mode='r')
+
+        return self._arrays[key]
+
+    def sorted_column(self, name, column):
+        """
+        The non-missing values of a column in ascending order, as a read-only memory-mapped array, itself
+        cached as a sidecar
+        """
+
+        key = (name, column, '_sorted')
+        if key not in self._arrays:
+            sidecar = self._sidecar(name, column, '_sorted')
+            if not os.path.exists(sidecar):
+                values = np.asarray(self.column(name, column))
+                self._save(sidecar, np.sort(values[~np.isnan(values)]))
+            self._arrays[key] = np.load(sidecar, mmap_mode='r')
+
+        return self._arrays[key]
+
+
+# Registry of this process, shared by the models unless one is injected
+registry = DatasetRegistry()
@@ -1,26 +1,137 @@
 from __future__ import division
 from pyomo.environ import *
+import numpy as np
 import pandas as pd
-from haversine import haversine, Unit
+from h3 import h3
+from scipy.sparse import coo_matrix
+from sklearn.neighbors import BallTree
 
+# Mean earth radius, matching the haversine package
+EARTH_RADIUS = {'mi': 3958.7613, 'km': 6371.0088}
 
-def haversine_distance_matrix(df):
-    # Create line list
-    all_lines = []
-    for id1 in list(df.B):
-        for id2 in list(df.B):
-            all_lines.append(f"{id1}_{id2}")
 
-    # Create node and point dictionary
-    point_list = list(zip(df['latitude'], df['longitude']))
-    node_points = dict(list(zip(df.B, point_list)))
+def haversine_vectorized(lat1, lon1, lat2, lon2, unit='mi'):
+    """
+    Great-circle distance between arrays of points, element-wise (broadcasting applies)
 
-    # Create distance dataframe to fill
-    distances = pd.DataFrame(columns=['dist'], index=all_lines)
+    parameters
+    ---------
+    lat1, lon1:np.ndarray - coordinates of the first points in degrees
+    lat2, lon2:np.ndarray - coordinates of the second points in degrees
+    unit:str - 'mi' or 'km'
 
-    # Fill distances
-    for index, row in distances.iterrows():
-        n1, n2 = index.split("_")
-        row['dist'] = haversine(node_points[n1], node_points[n2], unit=Unit.MILES)
+    returns
+    ---------
+    distance:np.ndarray - distances in the requested unit
+    """
 
-    return distances
\ No newline at end of file
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+
+    return 2 * EARTH_RADIUS[unit] * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+def _balltree_candidates(lat, lon, radius, unit, chunk_size):
+    # Index the nodes on the sphere and query each block of nodes for neighbours within the radius
+    points = np.radians(np.column_stack([lat, lon]))
+    tree = BallTree(points, metric='haversine')
+
+    for start in range(0, len(points), chunk_size):
+        neighbours = tree.query_radius(points[start:start + chunk_size], r=radius / EARTH_RADIUS[unit])
+        counts = np.fromiter((len(n) for n in neighbours), dtype=np.int64, count=len(neighbours))
+        rows = np.repeat(np.arange(start, start + len(neighbours), dtype=np.int32), counts)
+        cols = np.concatenate(neighbours).astype(np.int32) if len(neighbours) else np.empty(0, dtype=np.int32)
+        yield rows, cols
+
+
+def _h3_candidates(hex_ids, radius, unit, chunk_size):
+    # Grid distance that is guaranteed to cover the radius, with a margin for cell size variation
+    resolution = h3.h3_get_resolution(hex_ids[0])
+    radius_km = radius * EARTH_RADIUS['km'] / EARTH_RADIUS[unit]
+    k = int(np.ceil(radius_km / (np.sqrt(3) * h3.edge_length(resolution, unit='km') * 0.75))) + 1
+
+    codes = {hex_id: code for code, hex_id in enumerate(hex_ids)}
+
+    for start in range(0, len(hex_ids), chunk_size):
+        rows, cols = [], []
+        for row, hex_id in enumerate(hex_ids[start:start + chunk_size], start):
+            neighbours = [codes[n] for n in h3.k_ring(hex_id, k) if n in codes]
+            rows.extend([row] * len(neighbours))
+            cols.extend(neighbours)
+        yield np.array(rows, dtype=np.int32), np.array(cols, dtype=np.int32)
+
+
+def _all_pairs(n, chunk_size):
+    for start in range(0, n, chunk_size):
+        stop = min(start + chunk_size, n)
+        yield np.repeat(np.arange(start, stop, dtype=np.int32), n), np.tile(np.arange(n, dtype=np.int32), stop - start)
+
+
+def haversine_sparse(df, radius=None, unit='mi', method='balltree', chunk_size=4096):
+    """
+    Compute great-circle distances between all node pairs within a radius, without building the dense N² matrix.
+    Candidate pairs come from a spatial index and only those are measured, one block of nodes at a time.
+
+    parameters
+    ---------
+    df:pd.DataFrame - nodes, with columns ['B', 'latitude', 'longitude'] (B holds h3 hex ids for method='h3')
+    radius:float - cutoff distance in `unit`, or None to compute every pair
+    unit:str - 'mi' or 'km'
+    method:str - 'balltree' for a haversine BallTree or 'h3' for a k-ring neighbourhood of the hex ids in B
+    chunk_size:int - number of nodes queried per block
+
+    returns
+    ---------
+    nodes:pd.Index - node ids, the position of a node is its integer code
+    distances:scipy.sparse.coo_matrix - N x N distances keyed by node code, holding only pairs within the radius
+                                        (self pairs and coincident nodes are stored as explicit zeros)
+    """
+
+    nodes = pd.Index(df['B'])
+    lat = np.asarray(df['latitude'], dtype=np.float64)
+    lon = np.asarray(df['longitude'], dtype=np.float64)
+
+    if radius is None:
+        candidates = _all_pairs(len(nodes), chunk_size)
+    elif method == 'balltree':
+        candidates = _balltree_candidates(lat, lon, radius, unit, chunk_size)
+    elif method == 'h3':
+        candidates = _h3_candidates(list(nodes), radius, unit, chunk_size)
+    else:
+        raise ValueError(f"Unknown method '{method}', expected 'balltree' or 'h3'")
+
+    # Measure each block of candidates exactly and keep only those within the radius
+    all_rows, all_cols, all_dist = [], [], []
+    for rows, cols in candidates:
+        dist = haversine_vectorized(lat[rows], lon[rows], lat[cols], lon[cols], unit=unit)
+        if radius is not None:
+            keep = dist <= radius
+            rows, cols, dist = rows[keep], cols[keep], dist[keep]
+        all_rows.append(rows)
+        all_cols.append(cols)
+        all_dist.append(dist)
+
+    rows = np.concatenate(all_rows) if all_rows else np.empty(0, dtype=np.int32)
+    cols = np.concatenate(all_cols) if all_cols else np.empty(0, dtype=np.int32)
+    dist = np.concatenate(all_dist) if all_dist else np.empty(0)
+
+    distances = coo_matrix((dist, (rows, cols)), shape=(len(nodes), len(nodes)))
+
+    return nodes, distances
+
+
+def haversine_distance_matrix(df, radius=None, unit='mi', method='balltree'):
+    """
+    Distances between node pairs as a DataFrame indexed by "id1_id2" line names with a 'dist' column.
+    Thin wrapper around haversine_sparse for code that still expects string-keyed lines; pass a radius
+    to only produce the lines within it.
+    """
+
+    nodes, distances = haversine_sparse(df, radius=radius, unit=unit, method=method)
+
+    # Name the lines from the node codes
+    node_names = np.asarray(nodes).astype(str)
+    lines = pd.Index(np.char.add(np.char.add(node_names[distances.row], '_'), node_names[distances.col]))
+
+    return pd.DataFrame({'dist': distances.data}, index=lines)
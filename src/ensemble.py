@@ -0,0 +1,347 @@
+import copy
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from src.components import Vehicle
+from src.grid import HexGrid, DemandPyramid
+from src.general_utils import generate_hourly_charges
+from src.lp_bundle import BUNDLE_DIR
+from src.simulation import write_demand
+
+# Simulation of the replicas run by a worker process, set once per worker
+_worker_simulation = None
+
+
+def _init_worker(simulation):
+    global _worker_simulation
+    _worker_simulation = simulation
+
+
+def _run_replica(seed, simulation=None):
+    """
+    Simulate one replica with the input seed and bin its hourly charging energy at the simulation's resolution
+
+    returns
+    ---------
+    cells:np.ndarray - uint64 ids of the cells with demand
+    energy:sparse.csr_matrix - (cell x hour) energy, rows in the order of cells
+    """
+
+    # Each replica drives its own vehicles from the start of their trajectories, simulating mutates them
+    simulation = copy.copy(_worker_simulation if simulation is None else simulation)
+    simulation.vehicles = [Vehicle.from_store(vehicle.store, vehicle.row, vehicle.interpolate)
+                           for vehicle in simulation.vehicles]
+    simulation.seed = seed
+    simulation.workers = 1
+
+    pyramid = DemandPyramid(simulation.resolution)
+    charging_events = simulation.simulate()
+    if len(charging_events):
+        pyramid.join(generate_hourly_charges(charging_events), agg_map={'energy': 'sum'})
+    else:
+        pyramid.levels = {simulation.resolution: (pd.Index(np.array([], dtype=np.uint64)),
+                                                  {'energy': sparse.csr_matrix((0, len(pyramid.hours)))})}
+
+    cells, demand = pyramid.level(simulation.resolution)
+    return cells.values, demand['energy']
+
+
+class StreamingMoments:
+    """
+    Mean and variance of each element of a stream of equally shaped arrays, updated one array at a time with
+    Welford's algorithm
+
+    Attributes
+    ----------
+    count : int
+        Number of arrays seen
+    mean : np.ndarray
+        Running mean of each element
+    m2 : np.ndarray
+        Running sum of squared deviations from the mean of each element
+    """
+
+    def __init__(self, shape):
+        self.count = 0
+        self.mean = np.zeros(shape)
+        self.m2 = np.zeros(shape)
+
+    def grow(self, rows):
+        """
+        Append rows of elements whose observations so far were all zero
+        """
+
+        self.mean = np.concatenate([self.mean, np.zeros((rows,) + self.mean.shape[1:])])
+        self.m2 = np.concatenate([self.m2, np.zeros((rows,) + self.m2.shape[1:])])
+
+    def update(self, x):
+        self.count += 1
+        delta = x - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (x - self.mean)
+
+    @property
+    def variance(self):
+        return self.m2 / (self.count - 1) if self.count > 1 else np.zeros_like(self.m2)
+
+
+class P2Quantile:
+    """
+    P-square estimate (Jain and Chlamtac, 1985) of a quantile of each element of a stream of equally shaped
+    arrays. Five markers per element are kept and adjusted with each array, so the estimate needs constant
+    memory whatever the number of arrays.
+
+    Attributes
+    ----------
+    quantile : float
+        Quantile estimated, between 0 and 1
+    count : int
+        Number of arrays seen
+    heights : np.ndarray
+        Marker heights, the last axis holds the five markers
+    positions : np.ndarray
+        Marker positions, aligned with heights
+    """
+
+    def __init__(self, quantile, shape):
+        self.quantile = quantile
+        self.count = 0
+        self.increments = np.array([0, quantile / 2, quantile, (1 + quantile) / 2, 1])
+        self.desired = np.array([1, 1 + 2 * quantile, 1 + 4 * quantile, 3 + 2 * quantile, 5])
+        self.heights = np.zeros(tuple(shape) + (5,))
+        self.positions = np.zeros(tuple(shape) + (5,))
+
+    def _initial_positions(self):
+        # Marker positions of an element whose observations so far were all equal
+        positions = np.clip(np.round(self.desired), 1, self.count)
+        positions[0], positions[4] = 1, self.count
+        for i in (1, 2, 3):
+            positions[i] = min(max(positions[i], positions[i - 1] + 1), self.count - (4 - i))
+        return positions
+
+    def grow(self, rows):
+        """
+        Append rows of elements whose observations so far were all zero
+        """
+
+        shape = (rows,) + self.heights.shape[1:]
+        positions = np.zeros(shape)
+        if self.count >= 5:
+            positions[...] = self._initial_positions()
+
+        self.heights = np.concatenate([self.heights, np.zeros(shape)])
+        self.positions = np.concatenate([self.positions, positions])
+
+    def update(self, x):
+        self.count += 1
+
+        # The first five observations are the markers, in order
+        if self.count <= 5:
+            self.heights[..., self.count - 1] = x
+            if self.count == 5:
+                self.heights.sort(axis=-1)
+                self.positions[...] = np.arange(1, 6)
+            return
+
+        q, n = self.heights, self.positions
+
+        # Extend the extreme markers, and shift the markers above the cell the observation falls in
+        q[..., 0] = np.minimum(q[..., 0], x)
+        q[..., 4] = np.maximum(q[..., 4], x)
+        cell = np.sum(x[..., None] >= q[..., 1:4], axis=-1)
+        n += np.arange(5) > cell[..., None]
+        self.desired = self.desired + self.increments
+
+        # Move the middle markers that are off their desired position by one, parabolically where possible
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for i in (1, 2, 3):
+                d = self.desired[i] - n[..., i]
+                move = ((d >= 1) & (n[..., i + 1] - n[..., i] > 1)) | ((d <= -1) & (n[..., i - 1] - n[..., i] < -1))
+                if not move.any():
+                    continue
+
+                s = np.sign(d)
+                q_below, q_at, q_above = q[..., i - 1], q[..., i], q[..., i + 1]
+                n_below, n_at, n_above = n[..., i - 1], n[..., i], n[..., i + 1]
+
+                parabolic = q_at + s / (n_above - n_below) * (
+                    (n_at - n_below + s) * (q_above - q_at) / (n_above - n_at)
+                    + (n_above - n_at - s) * (q_at - q_below) / (n_at - n_below))
+                neighbour = np.where(s > 0, q_above, q_below)
+                linear = q_at + s * (neighbour - q_at) / (np.where(s > 0, n_above, n_below) - n_at)
+                adjusted = np.where((q_below < parabolic) & (parabolic < q_above), parabolic, linear)
+
+                q[..., i] = np.where(move, adjusted, q_at)
+                n[..., i] = np.where(move, n_at + s, n_at)
+
+    @property
+    def estimate(self):
+        if self.count == 0:
+            return np.zeros(self.heights.shape[:-1])
+        if self.count < 5:
+            return np.quantile(self.heights[..., :self.count], self.quantile, axis=-1)
+        return self.heights[..., 2].copy()
+
+
+class DemandEnsemble:
+    """
+    Monte Carlo ensemble of seeded replicas of a Simulation, folding the hexagon by hour charging energy of each
+    replica into streaming statistics, so replicas are not kept in memory. Replicas run in worker processes and
+    the run stops early once the mean demand has stabilized.
+
+    The statistics are held densely over the cells that have had demand in any replica, at the simulation's
+    resolution; cells enter with zeros for the replicas before their first demand.
+
+    Parameters
+    ____________
+    simulation : Simulation
+        Simulation of the replicas, its vehicles and models are sent once to each worker
+    quantiles : tuple
+        Quantiles of the demand estimated with P-square sketches, ex. (0.9,)
+    seed : int
+        Seed of the ensemble, replica i is run with the i-th seed drawn from np.random.SeedSequence(seed)
+
+    Attributes
+    ----------
+    cells : pd.Index
+        uint64 ids of the cells with demand, the rows of the statistics
+    moments : StreamingMoments
+        Mean and variance of the energy of each (cell, hour)
+    sketches : dict
+        Quantile to the P2Quantile of the energy of each (cell, hour)
+    history : pd.DataFrame
+        Convergence diagnostics after each replica
+    """
+
+    def __init__(self, simulation, quantiles=(0.9,), seed=None):
+        self.simulation = simulation
+        self.quantiles = tuple(quantiles)
+        self.seed = np.random.SeedSequence().entropy if seed is None else seed
+        self.hours = pd.Index(range(25), name='hour')
+
+        self.cells = pd.Index(np.array([], dtype=np.uint64))
+        self.moments = StreamingMoments((0, len(self.hours)))
+        self.sketches = {quantile: P2Quantile(quantile, (0, len(self.hours))) for quantile in self.quantiles}
+        self.history = pd.DataFrame()
+
+    @property
+    def replicas(self):
+        return self.moments.count
+
+    def _fold(self, cells, energy):
+        # Append the cells seen for the first time, then update the statistics with the replica's dense grid
+        new_cells = cells[self.cells.get_indexer(cells) < 0]
+        if len(new_cells):
+            self.cells = self.cells.append(pd.Index(new_cells))
+            for statistic in [self.moments] + list(self.sketches.values()):
+                statistic.grow(len(new_cells))
+
+        x = np.zeros((len(self.cells), len(self.hours)))
+        x[self.cells.get_indexer(cells)] = energy.toarray()
+
+        previous_mean = self.moments.mean.copy()
+        self.moments.update(x)
+        for sketch in self.sketches.values():
+            sketch.update(x)
+
+        # Convergence diagnostics: the energy weighted relative standard error of the mean, and its last change
+        mean = self.moments.mean
+        total = np.abs(mean).sum()
+        standard_error = np.sqrt(self.moments.variance / self.moments.count)
+        previous_mean = np.concatenate([previous_mean, np.zeros((len(mean) - len(previous_mean), len(self.hours)))])
+
+        return {'replicas': self.moments.count, 'cells': len(self.cells), 'mean_energy': mean.sum(),
+                'relative_error': standard_error.sum() / total if total else np.nan,
+                'mean_change': np.abs(mean - previous_mean).sum() / total if total else np.nan}
+
+    def run(self, max_replicas=100, min_replicas=10, tolerance=0.01, workers=1):
+        """
+        Run replicas until the relative standard error of the mean demand is at or below tolerance, after at
+        least min_replicas, or until max_replicas. Replicas are folded in seed order, so results do not depend
+        on the number of workers
+
+        parameters
+        ---------
+        max_replicas:int - most replicas run
+        min_replicas:int - fewest replicas before stopping early
+        tolerance:float - relative standard error of the mean demand at which the run stops, None to run them all
+        workers:int - number of processes running replicas, 1 runs them in the current process
+
+        returns
+        ---------
+        history:pd.DataFrame - convergence diagnostics after each replica
+        """
+
+        seeds = [int(seed) for seed in np.random.SeedSequence(self.seed).generate_state(max_replicas)]
+        seeds = seeds[self.replicas:]
+        history = [] if self.history.empty else self.history.to_dict('records')
+
+        def converged():
+            return (tolerance is not None and self.replicas >= min_replicas
+                    and history[-1]['relative_error'] <= tolerance)
+
+        if workers > 1:
+            with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                     initargs=(self.simulation,)) as executor:
+                # Keep a replica per worker in flight, folding the results in seed order
+                pending = [executor.submit(_run_replica, seed) for seed in seeds[:workers]]
+                submitted = len(pending)
+                while pending:
+                    history.append(self._fold(*pending.pop(0).result()))
+                    if converged():
+                        for future in pending:
+                            future.cancel()
+                        break
+                    if submitted < len(seeds):
+                        pending.append(executor.submit(_run_replica, seeds[submitted]))
+                        submitted += 1
+        else:
+            for seed in seeds:
+                history.append(self._fold(*_run_replica(seed, self.simulation)))
+                if converged():
+                    break
+
+        self.history = pd.DataFrame(history)
+        return self.history
+
+    def statistic(self, statistic='mean'):
+        """
+        A statistic of the energy of each (cell, hour) as a sparse (cell x hour) matrix, rows in the order of
+        cells: 'mean', 'variance', 'std' or a quantile as 'p90' (for 0.9)
+        """
+
+        quantiles = {'p%g' % (100 * quantile): quantile for quantile in self.quantiles}
+
+        if statistic == 'mean':
+            values = self.moments.mean
+        elif statistic == 'variance':
+            values = self.moments.variance
+        elif statistic == 'std':
+            values = np.sqrt(self.moments.variance)
+        elif statistic in quantiles:
+            values = self.sketches[quantiles[statistic]].estimate
+        else:
+            raise ValueError(f"Unknown statistic '{statistic}', expected 'mean', 'variance', 'std' or one of "
+                             f"{list(quantiles)}")
+
+        return sparse.csr_matrix(values)
+
+    def grid(self, statistic='mean', resolution=None):
+        """
+        HexGrid of the region with a statistic of the demand as its 'energy', at the simulation's resolution or,
+        rolled up, a coarser one
+        """
+
+        resolution = self.simulation.resolution if resolution is None else resolution
+        pyramid = DemandPyramid.from_cells(self.cells.values, {'energy': self.statistic(statistic)},
+                                           self.simulation.resolution, resolution, self.hours)
+
+        return pyramid.fill_grid(HexGrid(resolution=resolution))
+
+    def export(self, statistic='mean', bundle_path=BUNDLE_DIR, resolution=None):
+        """
+        Write a statistic of the demand, ex. 'mean' or 'p90', into an LP input bundle as the demand parameter A
+        """
+
+        write_demand(self.grid(statistic, resolution), bundle_path)
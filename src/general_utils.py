@@ -2,59 +2,87 @@
 from geojson.feature import *
 from src.h3_utils import *
 import geopandas as gpd
+import hashlib
+import numpy as np
+import os
 import pandas as pd
+from shapely import wkb
+
+LA_SHAPEFILE = '../data/raw/la_dissolved.shp'
+HEXGRID_CACHE_DIR = '../data/interim/hexgrid_cache'
+
+# Hex grids loaded in this process, keyed by (shapefile hash, resolution)
+_hexgrid_cache = {}
+
 
 def generate_hourly_charges(charges):
-    # Create a unique identifier
-    charges['ID'] = [i for i in range(0, charges.shape[0])]
-
-    # Create dataframe by minutes in this datetime range
-    start = charges['start_time'].min()
-    end = charges['end_time'].max()
-    index = pd.date_range(start=start, end=end, freq='1T')
-    df2 = pd.DataFrame(index=index, columns= \
-        ['minutes', 'ID', 'latitude', 'longitude', 'delta_soc', 'energy', 'start_soc'])
-
-    # Spread the events across minutes
-    for index, row in charges.iterrows():
-        df2['minutes'][row['start_time']:row['end_time']] = 1
-        df2['ID'][row['start_time']:row['end_time']] = row['ID']
-        df2['latitude'][row['start_time']:row['end_time']] = row['latitude']
-        df2['longitude'][row['start_time']:row['end_time']] = row['longitude']
-        df2['delta_soc'][row['start_time']:row['end_time']] = row['delta_soc']
-        df2['energy'][row['start_time']:row['end_time']] = row['energy']
-        df2['start_soc'][row['start_time']:row['end_time']] = row['start_soc']
-
-    # Clean up dataframe
-    df2 = df2[df2.ID.notna()]
-    df2['time'] = df2.index
-    df2['hour'] = df2['time'].apply(lambda x: x.hour)
-
-    # GroupBy ID and hour
-    df3 = df2.groupby(['ID', 'hour']).agg(
-        {'minutes': 'count', 'time': 'first', 'latitude': 'first', 'longitude': 'first', 'delta_soc': 'first',
-         'energy': 'first', 'start_soc': 'first'}).reset_index()
-
-    # Recreate time index
-    df3['time'] = df3['time'].apply(lambda x: pd.datetime(year=x.year, month=x.month, day=x.day, hour=x.hour))
-    df3.set_index('time', inplace=True)
-    df3['time'] = df3.index
+    """
+    Split each charging event into the clock hours it spans, pro-rating energy and delta_soc by the fraction of
+    the event's duration that falls in each hour. Events are split independently, so overlapping sessions each
+    keep their full energy.
+
+    parameters
+    ---------
+    charges:pd.DataFrame - charging events with columns ['start_time', 'end_time', 'latitude', 'longitude',
+                           'delta_soc', 'energy', 'start_soc'] and optionally 'vehicle_id'
+
+    returns
+    ---------
+    df:pd.DataFrame - one row per (event, hour), indexed by the start of the hour ('time'), with the event 'ID'
+                      (its position in charges), the 'hour' of day and the event columns
+    """
+
+    hour = np.int64(3600 * 10 ** 9)
+    start_time = pd.to_datetime(charges['start_time'])
+    tz = start_time.dt.tz
+
+    start = start_time.values.astype('datetime64[ns]').astype(np.int64)
+    end = pd.to_datetime(charges['end_time']).values.astype('datetime64[ns]').astype(np.int64)
+    duration = end - start
+
+    # Hour buckets touched by each event, an event ending on the hour does not touch the next one
+    first = start // hour
+    last = np.where(duration > 0, (end - 1) // hour, first)
+    counts = last - first + 1
+
+    # One row per (event, hour bucket)
+    event = np.repeat(np.arange(len(charges)), counts)
+    bucket = np.repeat(first, counts) + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+
+    # Fraction of each event's duration that falls in the bucket
+    overlap = np.minimum(end[event], (bucket + 1) * hour) - np.maximum(start[event], bucket * hour)
+    fraction = np.ones(len(event))
+    np.divide(overlap, duration[event], out=fraction, where=duration[event] > 0)
+
+    time = pd.to_datetime(bucket * hour, utc=tz is not None)
+    if tz is not None:
+        time = time.tz_convert(tz)
+
+    df = pd.DataFrame({'ID': event, 'hour': time.hour}, index=pd.Index(time, name='time'))
+    for column in ['latitude', 'longitude', 'delta_soc', 'energy', 'start_soc', 'vehicle_id']:
+        if column in charges:
+            df[column] = np.asarray(charges[column])[event]
 
     # Spread energy and delta_soc
-    sums = df3.groupby('ID').agg({'minutes': 'sum'}).rename(columns={'minutes': 'minutes_sum'})
-    df4 = pd.merge(df3, sums, on='ID')
-    df4.set_index('time', inplace=True)
-    df4['delta_soc'] = df4['delta_soc'] * (df4['minutes'] / df4['minutes_sum'])
-    df4['energy'] = df4['energy'] * (df4['minutes'] / df4['minutes_sum'])
-    df5 = df4.drop(columns=['minutes', 'minutes_sum']).sort_values(by='ID')
+    df['delta_soc'] = df['delta_soc'] * fraction
+    df['energy'] = df['energy'] * fraction
+
+    return df
+
 
-    return df5
+def _file_hash(path):
+    # Hash of the file contents, read in blocks
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
 
 
-def generate_hexgrid(by_hour):
+def _polyfill_shapefile(shapefile, resolution):
 
     # import la_shapefile
-    la_shp = gpd.read_file('../data/raw/la_dissolved.shp')
+    la_shp = gpd.read_file(shapefile)
 
     # remove extraneous multipolygon data structure
     la_shp['geometry'] = la_shp.geometry[0][1]
@@ -62,20 +90,70 @@ def generate_hexgrid(by_hour):
     # create geojson
     la_json = gpd.GeoSeries(la_shp['geometry']).__geo_interface__['features'][0]['geometry']
 
-    # create hexes, put into df:
-    la_hexes = fill_shapefile_hexes(geojson=la_json, resolution=8)
+    # create hexes, put into df, in a stable order
+    la_hexes = fill_shapefile_hexes(geojson=la_json, resolution=resolution)
+    la_hexes = la_hexes.sort_values(by='hex_id').reset_index(drop=True)
 
-    # Add an hour component to the hexagonal grid
+    return la_hexes[['hex_id', 'value', 'geometry']]
 
-    if by_hour:
-        la_hexes_with_hour = []
-        for i in range(25):
-            la_hexes_copy = la_hexes.copy()
-            la_hexes_copy['hour'] = i
-            la_hexes_with_hour.append(la_hexes_copy)
 
-        la_hexes_with_hour = pd.concat(la_hexes_with_hour)
+def load_hexgrid(resolution=8, shapefile=LA_SHAPEFILE, cache_dir=HEXGRID_CACHE_DIR):
+    """
+    Load the h3 hexagons filling a shapefile, cached in process by the shapefile's path, modification time and
+    size, and on disk by (shapefile hash, resolution). The disk cache is a Parquet file of hex ids and WKB
+    geometries, so the region is only polyfilled once, and the shapefile is only read to hash it on a miss of
+    the in-process cache.
+
+    parameters
+    ---------
+    resolution:int - h3 resolution
+    shapefile:str - path of the shapefile to fill
+    cache_dir:str - directory of the on-disk cache, None to only cache in process
+
+    returns
+    ---------
+    hex_df:gpd.GeoDataFrame - hex_id, value and geometry, one row per hexagon sorted by hex_id, shared between
+                              callers so it should not be modified
+    """
+
+    stat = os.stat(shapefile)
+    key = (os.path.abspath(shapefile), stat.st_mtime_ns, stat.st_size, resolution)
+
+    if key in _hexgrid_cache:
+        return _hexgrid_cache[key]
+
+    shapefile_hash = _file_hash(shapefile)
+    path = None if cache_dir is None else os.path.join(cache_dir, f'hexgrid_{shapefile_hash}_{resolution}.parquet')
+
+    if path is not None and os.path.exists(path):
+        # Read the cached hexagons
+        cached = pd.read_parquet(path)
+        la_hexes = gpd.GeoDataFrame({'hex_id': cached['hex_id'], 'value': 0},
+                                    geometry=[wkb.loads(geometry) for geometry in cached['geometry']],
+                                    crs="EPSG:4326")
+    else:
+        # Fill the shapefile and write the hexagons to the cache
+        la_hexes = _polyfill_shapefile(shapefile, resolution)
+        if path is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            pd.DataFrame({'hex_id': la_hexes['hex_id'],
+                          'geometry': [geometry.wkb for geometry in la_hexes.geometry]}).to_parquet(path, index=False)
+
+    _hexgrid_cache[key] = la_hexes
+
+    return la_hexes
+
+
+def generate_hexgrid(by_hour, resolution=8, hours=range(25)):
+
+    # Load the hexes of the LA region
+    la_hexes = load_hexgrid(resolution=resolution)
+
+    # Add an hour component to the hexagonal grid, hour by hour
+    if by_hour:
+        la_hexes_with_hour = la_hexes.iloc[np.tile(np.arange(len(la_hexes)), len(hours))].reset_index(drop=True)
+        la_hexes_with_hour['hour'] = np.repeat(np.asarray(hours), len(la_hexes))
         return la_hexes_with_hour
 
     else:
-        return la_hexes
\ No newline at end of file
+        return la_hexes
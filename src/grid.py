@@ -1,6 +1,8 @@
 # Regular Imports
 from geojson.feature import *
+from scipy import sparse
 from src.general_utils import *
+from src.h3_utils import geo_to_h3_array, h3_to_parent_array, h3_int
 
 
 class HexGrid:
@@ -8,44 +10,329 @@ class HexGrid:
     Hexagonal Grid based on H3 with functionality to join a set of points to it and plot those values
     What I need to do is retool the class to do outer joins and then also to make it so that it is generalizable
 
+    Joined values are held as sparse (hexagon x hour) matrices, with the geometries kept once in hex_grid, and
+    are only expanded to a dense frame of every cell on request.
+
     Attributes
     ----------
     resolution : str
         Resolution of the H3 Hexagonal Grid
-    region : GeoPandas DF
-        GeoPandas DataFrame representing the are across which you want to join features
+    hex_grid : GeoPandas DF
+        One row per hexagon of the region with its geometry, shared with the hex grid cache
+    hours : Pandas Index
+        Hours of the grid, the columns of the demand matrices
+    demand : dict
+        Aggregated column name to a sparse (hexagon x hour) CSR matrix, rows in the order of hex_grid
     """
 
-    def __init__(self, resolution):
+    def __init__(self, resolution, hours=range(25)):
         """
         Input the region and resolution of  the hexagonal grid
         """
 
         # initialize attributes
-        self.hex_grid = generate_hexgrid(by_hour=True)
+        self.hex_grid = generate_hexgrid(by_hour=False, resolution=resolution)
+        self.hours = pd.Index(hours, name='hour')
         self.resolution = resolution
-        self.hex_data = None
+        self.demand = {}
+        self._cells = None
+
+    @property
+    def cells(self):
+        """
+        uint64 cell ids of the hexagons, in the order of hex_grid
+        """
+
+        if self._cells is None:
+            self._cells = pd.Index(np.array([h3_int.string_to_h3(hex_id) for hex_id in self.hex_grid.hex_id],
+                                            dtype=np.uint64))
+        return self._cells
+
+    @property
+    def index(self):
+        """
+        (hour, hex_id) MultiIndex of every cell of the grid, in the row order of hex_data
+        """
+
+        return pd.MultiIndex.from_product([self.hours, self.hex_grid.hex_id], names=['hour', 'hex_id'])
+
+    @property
+    def hex_data(self):
+        """
+        Dense GeoDataFrame of every (hour, hexagon) cell with its geometry and joined values, zero where nothing
+        was joined, built on request
+        """
+
+        return self.to_frame()
 
-    def join(self, df, groupby_items, agg_map, resolution):
+    def join(self, df, groupby_items, agg_map, resolution=None):
         """
-        Bin the input dataframe by h3 hexagons
+        Bin the input dataframe by h3 hexagon and hour into one sparse (hexagon x hour) matrix per aggregated
+        column. Points are coded to the integer positions of their hexagon and hour in the grid and their values
+        scatter-added, so only the nonzero cells are stored. Points outside the grid or its hours are dropped.
+
+        parameters
+        ---------
+        df:pd.DataFrame - points with columns ['latitude','longitude','hour'] and the aggregated columns
+        groupby_items:list - ['hex_id','hour'], the dimensions of the grid
+        agg_map:dict - column to 'sum' or 'count', ex. {'energy':'sum'}
+        resolution:int - H3 cell resolution of the points, the grid's resolution if None
         """
 
-        # Bin the dataframe by hexagon with the specified params
-        df_aggreg = bin_by_hexagon(df, groupby_items, agg_map, resolution)
+        if sorted(groupby_items) != ['hex_id', 'hour']:
+            raise ValueError(f"HexGrid joins by ['hex_id', 'hour'], got {groupby_items}")
+        unsupported = {column: function for column, function in agg_map.items() if function not in ('sum', 'count')}
+        if unsupported:
+            raise ValueError(f"HexGrid aggregates with 'sum' or 'count', got {unsupported}")
+
+        resolution = self.resolution if resolution is None else resolution
 
-        # Join with the polyfill grid with the df_aggreg
-        df_outer = pd.merge(left=self.hex_grid[["hex_id", "hour", "geometry"]],
-                            right=df_aggreg[["hex_id", "hour", "energy"]],
-                            left_on=groupby_items, right_on=groupby_items, how="left")
+        # Code each point by the positions of its hexagon and hour in the grid
+        rows = self.cells.get_indexer(geo_to_h3_array(df['latitude'].values, df['longitude'].values, resolution))
+        columns = self.hours.get_indexer(df['hour'].values)
+        keep = (rows >= 0) & (columns >= 0)
+        rows, columns = rows[keep], columns[keep]
 
-        df_outer = df_outer.fillna(0)
+        # Scatter-add the values of each column, duplicate cells are summed when converting to CSR
+        self.demand = {}
+        for column, function in agg_map.items():
+            values = df[column].values[keep]
+            values = pd.notna(values).astype(np.float64) if function == 'count' \
+                else np.nan_to_num(np.asarray(values, dtype=np.float64))
+            matrix = sparse.coo_matrix((values, (rows, columns)), shape=(len(self.hex_grid), len(self.hours)))
+            matrix = matrix.tocsr()
+            matrix.eliminate_zeros()
+            self.demand[column] = matrix
 
-        self.hex_data = df_outer
+    def to_dense(self, column):
+        """
+        Dense (hexagon x hour) array of a joined column
+        """
+
+        return self.demand[column].toarray()
+
+    def to_frame(self, hours=None, nonzero=False, geometry=True):
+        """
+        Long frame of the joined values, ordered by hour then hexagon
+
+        parameters
+        ---------
+        hours:list - hours included, every hour of the grid if None
+        nonzero:bool - only the cells where a joined value is nonzero, otherwise every hexagon of each hour
+        geometry:bool - attach the hexagon geometries, returning a GeoDataFrame
+
+        returns
+        ---------
+        df:pd.DataFrame - columns ['hex_id','hour'], 'geometry' if requested, and one column per joined value
+        """
+
+        hours = self.hours if hours is None else pd.Index(hours, name='hour')
+        positions = self.hours.get_indexer(hours)
+        if (positions < 0).any():
+            raise ValueError(f"Hours {list(hours[positions < 0])} are not in the grid")
+
+        matrices = {column: matrix[:, positions] for column, matrix in self.demand.items()}
+        n_hexes = len(self.hex_grid)
+
+        if nonzero:
+            # Union of the nonzero cells of the columns, ordered by hour then hexagon
+            pattern = sparse.csc_matrix((n_hexes, len(positions)))
+            for matrix in matrices.values():
+                pattern = pattern + abs(matrix)
+            pattern = pattern.tocsc()
+            pattern.sort_indices()
+            rows = pattern.indices
+            columns = np.repeat(np.arange(len(positions)), np.diff(pattern.indptr))
+            values = {column: np.asarray(matrix.tocsc()[rows, columns]).ravel() for column, matrix in matrices.items()}
+        else:
+            rows = np.tile(np.arange(n_hexes), len(positions))
+            columns = np.repeat(np.arange(len(positions)), n_hexes)
+            values = {column: matrix.toarray().ravel(order='F') for column, matrix in matrices.items()}
+
+        df = pd.DataFrame({'hex_id': self.hex_grid.hex_id.values[rows], 'hour': hours.values[columns]})
+        if geometry:
+            df = gpd.GeoDataFrame(df, geometry=self.hex_grid.geometry.values[rows], crs=self.hex_grid.crs)
+        for column, column_values in values.items():
+            df[column] = column_values
+
+        return df
+
+    def geometry_lookup(self, hex_ids):
+        """
+        GeoDataFrame of the hex_id and geometry of the input hexagons of the grid, in the input order
+        """
+
+        positions = pd.Index(self.hex_grid.hex_id).get_indexer(np.asarray(hex_ids))
+        positions = positions[positions >= 0]
+
+        return self.hex_grid.iloc[positions][['hex_id', 'geometry']].reset_index(drop=True)
 
     def plot(self, value_to_map, kind, hour):
 
+        # Densify only the mapped hour, or the totals over the hours
+        if hour is not None:
+            df = self.to_frame(hours=[hour])
+        else:
+            df = self.geometry_lookup(self.hex_grid.hex_id)
+            for column, matrix in self.demand.items():
+                df[column] = np.asarray(matrix.sum(axis=1)).ravel()
+
         # Use choropleth plotting function
-        hmap = h3_choropleth_map(self.hex_data, value_to_map, kind, hour)
+        hmap = h3_choropleth_map(df, value_to_map, kind, hour)
 
         return hmap
+
+
+class DemandPyramid:
+    """
+    Hexagon by hour demand at a range of H3 resolutions. Points are binned once at the finest (base) resolution
+    into sparse (cell x hour) matrices, and each coarser level is rolled up from the level below by summing the
+    cells into their h3_to_parent cell. Every level is computed once when joining and cached, so the LP and maps
+    can switch resolution without touching the points.
+
+    Attributes
+    ----------
+    base_resolution : int
+        Resolution the points are binned at, the finest level
+    min_resolution : int
+        Coarsest level of the pyramid
+    hours : Pandas Index
+        Hours of the pyramid, the columns of the demand matrices
+    levels : dict
+        Resolution to (cells, demand), the pd.Index of uint64 ids of the cells with joined points and the
+        aggregated column name to a sparse (cell x hour) CSR matrix with rows in the order of cells
+    """
+
+    def __init__(self, base_resolution=8, min_resolution=None, hours=range(25)):
+        min_resolution = base_resolution if min_resolution is None else min_resolution
+        if not 0 <= min_resolution <= base_resolution <= 15:
+            raise ValueError(f"Expected 0 <= min_resolution <= base_resolution <= 15, got {min_resolution} and "
+                             f"{base_resolution}")
+
+        self.base_resolution = base_resolution
+        self.min_resolution = min_resolution
+        self.hours = pd.Index(hours, name='hour')
+        self.levels = {}
+
+    @property
+    def resolutions(self):
+        return range(self.min_resolution, self.base_resolution + 1)
+
+    def join(self, df, agg_map):
+        """
+        Bin the input dataframe by base resolution cell and hour, then roll the result up to every coarser level
+
+        parameters
+        ---------
+        df:pd.DataFrame - points with columns ['latitude','longitude','hour'] and the aggregated columns
+        agg_map:dict - column to 'sum' or 'count', ex. {'energy':'sum'}
+        """
+
+        unsupported = {column: function for column, function in agg_map.items() if function not in ('sum', 'count')}
+        if unsupported:
+            raise ValueError(f"DemandPyramid aggregates with 'sum' or 'count', got {unsupported}")
+
+        # Code each point by its base cell and hour, dropping points without a cell or outside the hours
+        cells = geo_to_h3_array(df['latitude'].values, df['longitude'].values, self.base_resolution)
+        columns = self.hours.get_indexer(df['hour'].values)
+        keep = (cells != 0) & (columns >= 0)
+        unique_cells, rows = np.unique(cells[keep], return_inverse=True)
+        shape = (len(unique_cells), len(self.hours))
+
+        # Scatter-add the values of each column at the base level
+        demand = {}
+        for column, function in agg_map.items():
+            values = df[column].values[keep]
+            values = pd.notna(values).astype(np.float64) if function == 'count' \
+                else np.nan_to_num(np.asarray(values, dtype=np.float64))
+            demand[column] = sparse.coo_matrix((values, (rows, columns[keep])), shape=shape).tocsr()
+
+        self._build(unique_cells, demand)
+
+    @classmethod
+    def from_cells(cls, cells, demand, base_resolution=8, min_resolution=None, hours=range(25)):
+        """
+        Pyramid of demand already binned at the base resolution, given the uint64 cell ids and the aggregated
+        column name to a sparse (cell x hour) matrix with rows in the order of cells
+        """
+
+        pyramid = cls(base_resolution, min_resolution, hours)
+        pyramid._build(np.asarray(cells, dtype=np.uint64), {column: sparse.csr_matrix(matrix)
+                                                            for column, matrix in demand.items()})
+        return pyramid
+
+    def _build(self, cells, demand):
+        # Roll up each coarser level from the one below
+        self.levels = {self.base_resolution: (pd.Index(cells), demand)}
+        for resolution in reversed(self.resolutions[:-1]):
+            self.levels[resolution] = self._roll_up(self.levels[resolution + 1], resolution)
+
+    @staticmethod
+    def _roll_up(level, resolution):
+        # Sum the cells of a level into their parents, through a sparse (parent x cell) indicator matrix
+        cells, demand = level
+        parent_cells, codes = np.unique(h3_to_parent_array(cells.values, resolution), return_inverse=True)
+        indicator = sparse.csr_matrix((np.ones(len(cells)), (codes, np.arange(len(cells)))),
+                                      shape=(len(parent_cells), len(cells)))
+
+        return pd.Index(parent_cells), {column: (indicator @ matrix).tocsr() for column, matrix in demand.items()}
+
+    def level(self, resolution):
+        """
+        (cells, demand) of a level of the pyramid, see levels
+        """
+
+        if resolution not in self.levels:
+            raise ValueError(f"Resolution {resolution} is not in the pyramid, which has {list(self.levels)}")
+        return self.levels[resolution]
+
+    def to_frame(self, resolution, hours=None):
+        """
+        Long frame of the nonzero cells of a level, ordered by hour then cell
+
+        returns
+        ---------
+        df:pd.DataFrame - columns ['hex_id','hour'] and one column per joined value, hex_id as h3 strings
+        """
+
+        cells, demand = self.level(resolution)
+        hours = self.hours if hours is None else pd.Index(hours, name='hour')
+        positions = self.hours.get_indexer(hours)
+        matrices = {column: matrix[:, positions].tocsc() for column, matrix in demand.items()}
+
+        # Union of the nonzero cells of the columns
+        pattern = sparse.csc_matrix((len(cells), len(positions)))
+        for matrix in matrices.values():
+            pattern = pattern + abs(matrix)
+        pattern = pattern.tocsc()
+        pattern.sort_indices()
+        rows = pattern.indices
+        columns = np.repeat(np.arange(len(positions)), np.diff(pattern.indptr))
+
+        hex_ids = pd.Series(cells.values[rows]).map({cell: h3_int.h3_to_string(int(cell))
+                                                    for cell in np.unique(cells.values[rows])})
+        df = pd.DataFrame({'hex_id': hex_ids.values, 'hour': hours.values[columns]})
+        for column, matrix in matrices.items():
+            df[column] = np.asarray(matrix[rows, columns]).ravel()
+
+        return df
+
+    def fill_grid(self, grid):
+        """
+        Set the demand of a HexGrid from the level of the pyramid at the grid's resolution. Cells outside the
+        grid's region are dropped
+        """
+
+        if not grid.hours.equals(self.hours):
+            raise ValueError("The grid and the pyramid have different hours")
+
+        cells, demand = self.level(grid.resolution)
+        rows = grid.cells.get_indexer(cells)
+        inside = np.flatnonzero(rows >= 0)
+
+        # Move the rows of the level to the grid's rows, through a sparse (grid x cell) selection matrix
+        selection = sparse.csr_matrix((np.ones(len(inside)), (rows[inside], inside)),
+                                      shape=(len(grid.hex_grid), len(cells)))
+        grid.demand = {column: (selection @ matrix).tocsr() for column, matrix in demand.items()}
+
+        return grid
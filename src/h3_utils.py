@@ -1,20 +1,126 @@
 from h3 import h3
+from h3.api import basic_int as h3_int
+import io
 import json
+import warnings
+from collections import OrderedDict
+from functools import lru_cache
+import numpy as np
 import pandas as pd
 from geojson.feature import *
+from geojson.geometry import Geometry
 from folium import Map, Marker, GeoJson
 from geojson.feature import *
 import branca.colormap as cm
 import geopandas as gpd
 from shapely.geometry import Polygon
 
+# h3's vectorized indexer is experimental and may be missing from older releases
+try:
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        from h3.unstable import vect as h3_vect
+except ImportError:
+    h3_vect = None
 
-def bin_by_hexagon(df: pd.DataFrame, groupby_items: list, agg_map: dict, resolution: int):
+
+def geo_to_h3_array(latitudes, longitudes, resolution, chunk_size=1000000):
+    """
+    Index arrays of points into h3 cells at the specified resolution, in chunks.
+    Uses h3's vectorized indexer when available and the integer API otherwise.
+
+    parameters
+    ---------
+    latitudes:np.ndarray - latitudes of the points
+    longitudes:np.ndarray - longitudes of the points
+    resolution:int - H3 cell resolution size
+    chunk_size:int - number of points indexed at a time
+
+    returns
+    ---------
+    cells:np.ndarray - uint64 cell ids, 0 where a coordinate is missing
+    """
+
+    latitudes = np.ascontiguousarray(latitudes, dtype=np.float64)
+    longitudes = np.ascontiguousarray(longitudes, dtype=np.float64)
+    cells = np.zeros(len(latitudes), dtype=np.uint64)
+
+    for start in range(0, len(latitudes), chunk_size):
+        lat = latitudes[start:start + chunk_size]
+        lng = longitudes[start:start + chunk_size]
+        valid = ~(np.isnan(lat) | np.isnan(lng))
+
+        if h3_vect is not None:
+            chunk = h3_vect.geo_to_h3(lat, lng, resolution)
+            cells[start:start + chunk_size] = np.where(valid, chunk, 0)
+        else:
+            cells[start:start + chunk_size][valid] = np.fromiter(
+                (h3_int.geo_to_h3(y, x, resolution) for y, x in zip(lat[valid], lng[valid])),
+                dtype=np.uint64, count=int(valid.sum()))
+
+    return cells
+
+
+def h3_to_parent_array(cells, resolution):
+    """
+    Parent cells at the specified (coarser) resolution of an array of uint64 cell ids.
+    Uses h3's vectorized function when available and the integer API otherwise.
+
+    parameters
+    ---------
+    cells:np.ndarray - uint64 cell ids, 0 for no cell
+    resolution:int - H3 cell resolution of the parents
+
+    returns
+    ---------
+    parents:np.ndarray - uint64 parent cell ids, 0 where the input is 0
+    """
+
+    cells = np.ascontiguousarray(cells, dtype=np.uint64)
+    valid = cells != 0
+    parents = np.zeros(len(cells), dtype=np.uint64)
+
+    if h3_vect is not None:
+        parents[valid] = h3_vect.h3_to_parent(cells[valid], resolution)
+    else:
+        parents[valid] = np.fromiter((h3_int.h3_to_parent(int(cell), resolution) for cell in cells[valid]),
+                                     dtype=np.uint64, count=int(valid.sum()))
+
+    return parents
+
+
+# Hexagon boundaries kept by _hex_boundary and geometries by _geometry_json, the most recently used ones are kept
+HEX_BOUNDARY_CACHE_SIZE = 2 ** 16
+
+
+@lru_cache(maxsize=HEX_BOUNDARY_CACHE_SIZE)
+def _hex_boundary(hex_id):
+    # GeoJSON (lng, lat) boundary of a hexagon, computed once while it is among the recently used hexagons
+    return tuple(h3.h3_to_geo_boundary(h=hex_id, geo_json=True))
+
+
+def hex_geojson(hex_ids):
+    """
+    GeoJSON polygon dicts for the input hex ids, computing each distinct boundary once
+    """
+
+    hex_ids = pd.Series(hex_ids)
+    unique_ids = hex_ids.unique()
+    polygons = {hex_id: {"type": "Polygon", "coordinates": [_hex_boundary(hex_id)]} for hex_id in unique_ids}
+
+    return hex_ids.map(polygons)
+
+
+def bin_by_hexagon(df: pd.DataFrame, groupby_items: list, agg_map: dict, resolution: int, int_ids: bool = False,
+                   chunk_size: int = 1000000):
     """
     Use h3.geo_to_h3 to join each point into the spatial index of the hex at the specified resolution.
     Use h3.h3_to_geo_boundary to obtain the geometries of these hexagons.
     adopted from: Uber https://github.com/uber/h3-py-notebooks/blob/master/notebooks/urban_analytics.ipynb
 
+    Points are indexed in bulk from the latitude and longitude arrays and grouped on integer cell ids; the input
+    dataframe is not modified. Points with missing coordinates are dropped.
+
     parameters
     ---------
     df:pd.DataFrame - dataframe with points to be binned, including columns ['latitude'.'longitude']
@@ -22,6 +128,8 @@ def bin_by_hexagon(df: pd.DataFrame, groupby_items: list, agg_map: dict, resolut
     agg_map:dict - dict where keys=columns to be included in groupby and values=aggrigate function
             ex. {'station_id':'count','energy':'sum'}
     resolution:int - H3 cell resolution size
+    int_ids:bool - return hex_id as uint64 cell ids instead of h3 strings
+    chunk_size:int - number of points indexed at a time
 
     returns
     ---------
@@ -29,51 +137,113 @@ def bin_by_hexagon(df: pd.DataFrame, groupby_items: list, agg_map: dict, resolut
 
     """
 
-    # Assign hex_ids
-    df["hex_id"] = df.apply(lambda row: h3.geo_to_h3(row["latitude"], row["longitude"], resolution), axis=1)
+    # Assign hex_ids as integer cells
+    cells = geo_to_h3_array(df["latitude"].values, df["longitude"].values, resolution, chunk_size)
+
+    # Work on a new frame holding only the columns needed
+    columns = [column for column in dict.fromkeys(list(groupby_items) + list(agg_map)) if column != "hex_id"]
+    binned = pd.DataFrame({column: df[column].values for column in columns})
+    binned["hex_id"] = cells
+    binned = binned[cells != 0]
 
     # Groupby and aggregate
-    df_aggreg = df.groupby(groupby_items).agg(agg_map)
+    df_aggreg = binned.groupby(groupby_items).agg(agg_map)
     df_aggreg.reset_index(inplace=True)
 
+    # Convert the distinct cells back to h3 strings
+    unique_cells = df_aggreg["hex_id"].unique()
+    hex_strings = df_aggreg["hex_id"].map(dict(zip(unique_cells, (h3_int.h3_to_string(int(cell))
+                                                                   for cell in unique_cells))))
+    if not int_ids:
+        df_aggreg["hex_id"] = hex_strings
+
     # Create geojson column
-    df_aggreg["geojson"] = df_aggreg.hex_id.apply(lambda x:
-                                                  {"type": "Polygon",
-                                                   "coordinates":
-                                                       [h3.h3_to_geo_boundary(h=x, geo_json=True)]
-                                                   }
-                                                  )
+    df_aggreg["geojson"] = hex_geojson(hex_strings).values
 
     return df_aggreg
 
 
-def hexagons_dataframe_to_geojson(df_hex, file_output=None):
+_encode = json.JSONEncoder().encode
+
+
+# Serialized hexagon geometries kept by _geometry_json across collections, the most recently written ones are kept
+_geometry_fragments = OrderedDict()
+
+
+def _geometry_json(hex_id, geometry):
+    # Serialize a hexagon's geometry, rounded as the geojson package does, once while it is among the recently
+    # written hexagons, so the collections of every hour reuse it
+    fragment = _geometry_fragments.get(hex_id)
+    if fragment is None:
+        fragment = _geometry_fragments[hex_id] = json.dumps(Geometry.to_instance(geometry))
+        while len(_geometry_fragments) > HEX_BOUNDARY_CACHE_SIZE:
+            _geometry_fragments.popitem(last=False)
+    else:
+        _geometry_fragments.move_to_end(hex_id)
+    return fragment
+
+
+def _value_json(values):
+    # Serialize a column's values, as python scalars so numpy types encode like json.dumps of a row
+    return [_encode(value) for value in values.tolist()]
+
+
+def write_geojson(df_hex, f, properties=None):
     """
-    Produce the GeoJSON for a dataframe that has a geometry column in geojson format ,
-    along with the other columns to include such as hex_id, station_ids, station_count, etc
-    adopted from: Uber https://github.com/uber/h3-py-notebooks/blob/master/notebooks/urban_analytics.ipynb
+    Stream the GeoJSON FeatureCollection of a dataframe of hexagons to a file handle, one feature at a time.
+    Features are built from the column arrays and the geometry fragment of each hexagon, which is serialized
+    once and kept among the recently written hexagons, so the collections of other hours only serialize their
+    property values
 
+    parameters
+    ---------
+    df_hex:pd.DataFrame - hexagons with columns ['hex_id','geometry'] and the properties to include
+    f:file - text file handle the collection is written to
+    properties:list - columns included as feature properties, every column except geometry if None
     """
 
-    list_features = []
+    if properties is None:
+        properties = [column for column in df_hex.columns if column != 'geometry']
 
-    for i, row in df_hex.iterrows():
-        feature = Feature(geometry=row["geometry"], id=row["hex_id"],
-                          properties={
-                              col: row[col] for col in df_hex.columns.drop('geometry', 'hex_id')
-                          }
-                          )
+    # Key and value fragments of each property, column by column
+    hex_ids = df_hex['hex_id'].tolist()
+    geometries = [_geometry_json(hex_id, geometry)
+                  for hex_id, geometry in zip(hex_ids, df_hex['geometry'].values)]
+    columns = [(_encode(column), _value_json(df_hex[column].values)) for column in properties]
 
-        list_features.append(feature)
+    f.write('{"type": "FeatureCollection", "features": [')
+    for row, (hex_id, geometry) in enumerate(zip(hex_ids, geometries)):
+        values = ', '.join(f'{key}: {values[row]}' for key, values in columns)
+        f.write(f'{", " if row else ""}{{"type": "Feature", "id": {_encode(hex_id)}, "geometry": {geometry}, '
+                f'"properties": {{{values}}}}}')
+    f.write(']}')
 
-    feat_collection = FeatureCollection(list_features)
 
-    geojson_result = json.dumps(feat_collection)
+def hexagons_dataframe_to_geojson(df_hex, file_output=None, properties=None):
+    """
+    Produce the GeoJSON for a dataframe that has a geometry column in geojson format ,
+    along with the other columns to include such as hex_id, station_ids, station_count, etc
+    adopted from: Uber https://github.com/uber/h3-py-notebooks/blob/master/notebooks/urban_analytics.ipynb
+
+    parameters
+    ---------
+    df_hex:pd.DataFrame - hexagons with columns ['hex_id','geometry'] and the properties to include
+    file_output:str - path the GeoJSON is also written to, optional
+    properties:list - columns included as feature properties, every column except geometry if None
+
+    returns
+    ---------
+    geojson_result:str - the FeatureCollection
+    """
+
+    buffer = io.StringIO()
+    write_geojson(df_hex, buffer, properties)
+    geojson_result = buffer.getvalue()
 
     # optionally write to file
     if file_output is not None:
         with open(file_output, "w") as f:
-            json.dump(feat_collection, f)
+            f.write(geojson_result)
 
     return geojson_result
 
@@ -99,7 +269,7 @@ def h3_choropleth_map(df_aggreg: pd.DataFrame, value_to_map: str, kind: str, hou
         df_aggreg = df_aggreg.groupby(['hex_id']).agg({value_to_map: 'sum', 'geometry': 'first', 'hex_id': 'first'})
 
     # create geojson data from dataframe
-    geojson_data = hexagons_dataframe_to_geojson(df_hex=df_aggreg)
+    geojson_data = hexagons_dataframe_to_geojson(df_hex=df_aggreg, properties=[value_to_map] if value_to_map else [])
 
     if initial_map is None:
         initial_map = Map(location=[34.0522, -118.2437], zoom_start=11, tiles="cartodbpositron",
@@ -0,0 +1,149 @@
+import glob
+import os
+import tempfile
+import warnings
+import numpy as np
+import pandas as pd
+from src.components import TrajectoryArrays, TrajectoryStore
+
+LA_MSA = 'Los Angeles-Long Beach-Anaheim, CA (Metropolitan Statistical Area)'
+LA_TZ = 'America/Los_Angeles'
+
+# Telemetry columns a vehicle is built from, plus the MSA the rows are filtered on
+TELEMETRY_COLUMNS = ['hashed_vin', 'odo_read', 'element_time_local', 'decr_lat', 'decr_lng', 'msa_name']
+TELEMETRY_DTYPES = {'hashed_vin': str, 'odo_read': np.float64, 'element_time_local': str,
+                    'decr_lat': np.float64, 'decr_lng': np.float64, 'msa_name': 'category'}
+
+
+def _parse_times(values, tz):
+    # Times as UTC, from local times with their offset or, when they have none, from local times in the zone tz
+    present = values.dropna()
+    if not len(present) or pd.Timestamp(present.iloc[0]).tzinfo is not None:
+        return pd.to_datetime(values, utc=True)
+    return pd.to_datetime(values).dt.tz_localize(tz, ambiguous='NaT', nonexistent='NaT').dt.tz_convert('UTC')
+
+
+def _read_filtered(path, msa_name, null_columns, chunk_size, tz):
+    # Read a part-file in chunks of the needed columns, dropping the rows outside the MSA as each chunk is read,
+    # and the rows without a time, ex. local times repeated or skipped by a daylight saving time change
+    dropped = 0
+    columns = TELEMETRY_COLUMNS + [column for column in null_columns if column not in TELEMETRY_COLUMNS]
+
+    for chunk in pd.read_csv(path, usecols=columns, dtype={**TELEMETRY_DTYPES, **{c: str for c in null_columns}},
+                             chunksize=chunk_size):
+        keep = np.ones(len(chunk), dtype=bool)
+        if msa_name is not None:
+            keep &= (chunk['msa_name'] == msa_name).values
+        for column in null_columns:
+            keep &= chunk[column].isna().values
+        chunk = chunk[keep & chunk['hashed_vin'].notna().values]
+
+        if len(chunk):
+            # Parse the times once to UTC, so every chunk has the same dtype whatever offsets it spans
+            times = _parse_times(chunk['element_time_local'], tz)
+            valid = times.notna().values
+            dropped += int((~valid).sum())
+            if valid.any():
+                chunk = chunk[valid]
+                yield pd.DataFrame({'hashed_vin': chunk['hashed_vin'].values,
+                                    'time': times[valid].reset_index(drop=True),
+                                    'odo_read': chunk['odo_read'].values, 'decr_lat': chunk['decr_lat'].values,
+                                    'decr_lng': chunk['decr_lng'].values})
+
+    if dropped:
+        warnings.warn(f"Dropped {dropped} rows of {path} without a time, missing or ambiguous in {tz}")
+
+
+def _spill(paths, spill_dir, partitions, msa_name, null_columns, chunk_size, tz):
+    # Hash partition the filtered rows by VIN into one directory of Parquet chunks per partition
+    for file_number, path in enumerate(paths):
+        for chunk_number, chunk in enumerate(_read_filtered(path, msa_name, null_columns, chunk_size, tz)):
+            partition = pd.util.hash_array(chunk['hashed_vin'].values.astype(object)) % partitions
+            for p in np.unique(partition):
+                # Zero padded names keep the chunks of a partition in file and row order
+                part_dir = os.path.join(spill_dir, f'partition={p}')
+                part_path = os.path.join(part_dir, f'{file_number:06d}_{chunk_number:06d}.parquet')
+                os.makedirs(part_dir, exist_ok=True)
+                chunk[partition == p].to_parquet(part_path, index=False)
+
+
+def stream_trajectories(paths, msa_name=LA_MSA, null_columns=(), partitions=64, chunk_size=1000000,
+                        spill_dir=None, min_pings=2, tz=LA_TZ):
+    """
+    Stream per-vehicle ping arrays out of telemetry part-files that do not fit in memory together.
+
+    Each file is read in chunks of only the needed columns, and rows outside the MSA are dropped as each chunk
+    is read. The remaining rows are spilled to disk, hash partitioned by VIN, so every vehicle's pings land in
+    one partition whatever file or chunk they came from. Partitions are then loaded one at a time, sorted by
+    VIN and time, and split into one bundle per vehicle, so memory holds one partition rather than the export.
+
+    Times are read as UTC, as the local offsets of the export change with daylight saving time, and the
+    vehicles carry the MSA's time zone, so local hours follow the zone's own offset on each date. Local times
+    without an offset that the change repeats or skips have no single UTC time, their rows are dropped with a
+    warning of the count, as are rows without a time.
+
+    parameters
+    ---------
+    paths:list - telemetry csv part-files, or a glob pattern
+    msa_name:str - metropolitan statistical area to keep, None for all
+    null_columns:tuple - columns that must be empty for a row to be kept, e.g. ('battery_pack',)
+    partitions:int - number of VIN partitions, raise it when a partition does not fit in memory
+    chunk_size:int - rows read from a csv at a time
+    spill_dir:str - directory of the spilled partitions, a temporary directory removed at the end if None
+    min_pings:int - vehicles with fewer pings are skipped, as movingpandas does for single pings
+    tz:str - time zone of the MSA, ex. 'America/Los_Angeles', also that of local times without an offset
+
+    returns
+    ---------
+    trajectories:generator - TrajectoryArrays of each vehicle, in partition then VIN order
+    """
+
+    paths = sorted(glob.glob(paths)) if isinstance(paths, str) else list(paths)
+    temporary = tempfile.TemporaryDirectory(prefix='telemetry_spill_') if spill_dir is None else None
+    spill_dir = temporary.name if temporary is not None else spill_dir
+
+    try:
+        _spill(paths, spill_dir, partitions, msa_name, tuple(null_columns), chunk_size, tz)
+
+        for p in range(partitions):
+            part_dir = os.path.join(spill_dir, f'partition={p}')
+            if not os.path.isdir(part_dir):
+                continue
+
+            df = pd.concat([pd.read_parquet(os.path.join(part_dir, name)) for name in sorted(os.listdir(part_dir))],
+                           ignore_index=True)
+            df = df.sort_values(['hashed_vin', 'time'], kind='mergesort')
+
+            # Boundaries of each vehicle's run of rows
+            vins = df['hashed_vin'].values
+            starts = np.flatnonzero(np.r_[True, vins[1:] != vins[:-1]])
+            ends = np.r_[starts[1:], len(vins)]
+
+            # UTC epoch nanoseconds, the spilled times are all UTC
+            times = pd.to_datetime(df['time'], utc=True).values.astype('datetime64[ns]').astype(np.int64)
+            odometer, latitudes, longitudes = (df[column].values for column in ['odo_read', 'decr_lat', 'decr_lng'])
+
+            for start, end in zip(starts, ends):
+                if end - start >= min_pings:
+                    yield TrajectoryArrays(vins[start], odometer[start:end], times[start:end], latitudes[start:end],
+                                           longitudes[start:end], tz)
+    finally:
+        if temporary is not None:
+            temporary.cleanup()
+
+
+def stream_vehicles(paths, interpolate=False, batch_size=1024, **kwargs):
+    """
+    Vehicles of the trajectories streamed by stream_trajectories, built without movingpandas. Each batch of
+    vehicles references one TrajectoryStore of their pings rather than arrays of its own
+    """
+
+    batch = []
+    for arrays in stream_trajectories(paths, **kwargs):
+        batch.append(arrays)
+        if len(batch) == batch_size:
+            yield from TrajectoryStore.from_arrays(batch).vehicles(interpolate)
+            batch = []
+
+    if batch:
+        yield from TrajectoryStore.from_arrays(batch).vehicles(interpolate)
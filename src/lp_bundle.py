@@ -0,0 +1,268 @@
+import json
+import os
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+from shapely import wkb
+
+BUNDLE_VERSION = 1
+BUNDLE_DIR = '../data/interim/lp_data/input_data/lp_inputs.bundle'
+
+# Sets of the siting LP and the sets each parameter is indexed by
+SETS = ('B', 'K', 'T', 'L')
+PARAM_INDEX = {
+    'F': ('B', 'K'),
+    'D': ('B', 'K'),
+    'p': ('B', 'L'),
+    'A': ('B', 'T'),
+    'G': ('T',),
+    'C': ('B', 'K'),
+    'N': ('K',),
+    'E': ('B', 'K'),
+    'S': ('B',),
+    'VW': ('B', 'K', 'T'),
+    'P_H_U': ('L', 'T'),
+}
+
+
+class InputBundle:
+    """
+    Versioned, memory-mappable store of the LP inputs of one scenario, replacing the csv files read through
+    DataPortal. A bundle is a directory holding a manifest.json and one .npy file per array:
+
+        set_<name>.npy             members of each set, positions are the set codes
+        param_<name>_<set>.npy     int32 set codes of each index column of a parameter
+        param_<name>.npy           float64 parameter values
+
+    Parameters are stored sparsely in coordinate form, entries that are not stored are zero. Sets only grow by
+    appending members, so the codes of parameters already written stay valid.
+
+    Attributes
+    ----------
+    path : str
+        Directory of the bundle
+    manifest : dict
+        Version, set sizes and parameter index sets of the bundle
+    """
+
+    def __init__(self, path=BUNDLE_DIR):
+        self.path = path
+        manifest_path = os.path.join(path, 'manifest.json')
+
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                self.manifest = json.load(f)
+            if self.manifest.get('version') != BUNDLE_VERSION:
+                raise ValueError(f"Bundle {path} has version {self.manifest.get('version')}, "
+                                 f"expected {BUNDLE_VERSION}")
+        else:
+            self.manifest = {'version': BUNDLE_VERSION, 'sets': {}, 'params': {}}
+
+    def _file(self, name):
+        return os.path.join(self.path, f'{name}.npy')
+
+    def _save(self, name, array):
+        os.makedirs(self.path, exist_ok=True)
+        np.save(self._file(name), array)
+
+    def _write_manifest(self):
+        # Replace the manifest atomically, so readers never see a partial one
+        os.makedirs(self.path, exist_ok=True)
+        manifest_path = os.path.join(self.path, 'manifest.json')
+        with open(manifest_path + '.tmp', 'w') as f:
+            json.dump(self.manifest, f, indent=2)
+        os.replace(manifest_path + '.tmp', manifest_path)
+
+    def write_set(self, name, members):
+        """
+        Write the members of a set. Existing members must keep their position, new members are appended
+        """
+
+        members = np.asarray(members)
+        if members.dtype == object:
+            members = members.astype(str)
+
+        if name in self.manifest['sets']:
+            existing = self.read_set(name, mmap=False)
+            if len(members) < len(existing) or not np.array_equal(existing, members[:len(existing)]):
+                raise ValueError(f"Set {name} can only be extended, its existing members must keep their codes")
+
+        self._save(f'set_{name}', members)
+        self.manifest['sets'][name] = {'size': int(len(members)), 'dtype': members.dtype.str}
+        self._write_manifest()
+
+    def read_set(self, name, mmap=True):
+        """
+        Members of a set, as a (memory-mapped) array
+        """
+
+        return np.load(self._file(f'set_{name}'), mmap_mode='r' if mmap else None)
+
+    def encode(self, name, labels, extend=False):
+        """
+        Codes of the input labels in a set, appending unknown labels to the set if extend, otherwise -1
+        """
+
+        labels = np.asarray(labels)
+        members = pd.Index(self.read_set(name, mmap=False)) if name in self.manifest['sets'] else pd.Index([])
+        codes = members.get_indexer(labels)
+
+        if extend and (codes < 0).any():
+            new_members = pd.unique(labels[codes < 0])
+            members = members.append(pd.Index(new_members))
+            self.write_set(name, members.values)
+            codes = members.get_indexer(labels)
+
+        return codes
+
+    def write_param(self, name, codes, values):
+        """
+        Write a parameter from one set code array per index column and the values at those codes
+        """
+
+        index = PARAM_INDEX[name]
+        if len(codes) != len(index):
+            raise ValueError(f"Parameter {name} is indexed by {list(index)}, got {len(codes)} code arrays")
+        for set_name, set_codes in zip(index, codes):
+            self._save(f'param_{name}_{set_name}', np.asarray(set_codes, dtype=np.int32))
+        self._save(f'param_{name}', np.asarray(values, dtype=np.float64))
+
+        self.manifest['params'][name] = {'index': list(index), 'nnz': int(len(values))}
+        self._write_manifest()
+
+    def write_param_frame(self, name, df, extend_sets=False, drop_zeros=True):
+        """
+        Write a parameter from a frame of index columns followed by a value column, as in the csv inputs.
+        Zero entries are dropped if drop_zeros, and entries whose labels are not in the sets are dropped unless
+        extend_sets appends them to the sets
+        """
+
+        index = PARAM_INDEX[name]
+        if drop_zeros:
+            df = df[np.asarray(df.iloc[:, -1], dtype=np.float64) != 0]
+
+        values = np.asarray(df.iloc[:, -1], dtype=np.float64)
+        codes = [self.encode(set_name, df.iloc[:, i].values, extend=extend_sets) for i, set_name in enumerate(index)]
+        keep = np.logical_and.reduce([set_codes >= 0 for set_codes in codes])
+
+        self.write_param(name, [set_codes[keep] for set_codes in codes], values[keep])
+
+    def read_param(self, name, mmap=True):
+        """
+        A parameter as a list of (memory-mapped) set code arrays, one per index column, and its values
+        """
+
+        mmap_mode = 'r' if mmap else None
+        codes = [np.load(self._file(f'param_{name}_{set_name}'), mmap_mode=mmap_mode)
+                 for set_name in self.manifest['params'][name]['index']]
+        values = np.load(self._file(f'param_{name}'), mmap_mode=mmap_mode)
+
+        return codes, values
+
+    def write_geometry(self, geometry):
+        """
+        Write the geometry lookup of the demand nodes, a frame of hex_id and shapely geometry, as a Parquet table
+        of WKB geometries. Nodes already in the lookup keep their geometry unless the input replaces it
+        """
+
+        wkbs = [None if polygon is None else polygon.wkb for polygon in geometry['geometry']]
+        lookup = pd.DataFrame({'hex_id': np.asarray(geometry['hex_id']).astype(str), 'geometry': wkbs})
+
+        path = os.path.join(self.path, 'geometry_B.parquet')
+        if os.path.exists(path):
+            existing = pd.read_parquet(path)
+            lookup = pd.concat([existing[~existing['hex_id'].isin(lookup['hex_id'])], lookup], ignore_index=True)
+
+        os.makedirs(self.path, exist_ok=True)
+        lookup.to_parquet(path + '.tmp', index=False)
+        os.replace(path + '.tmp', path)
+
+        self.manifest['geometry'] = {'B': int(len(lookup))}
+        self._write_manifest()
+
+    def read_geometry(self):
+        """
+        Geometry lookup of the demand nodes, as a GeoDataFrame of hex_id and geometry
+        """
+
+        lookup = pd.read_parquet(os.path.join(self.path, 'geometry_B.parquet'))
+        geometry = [None if polygon is None else wkb.loads(polygon) for polygon in lookup['geometry']]
+
+        return gpd.GeoDataFrame({'hex_id': lookup['hex_id']}, geometry=geometry, crs='EPSG:4326')
+
+    def validate(self, required=tuple(PARAM_INDEX)):
+        """
+        Check the bundle is complete and consistent
+
+        returns
+        ---------
+        errors:list - description of each problem found, empty if the bundle is valid
+        """
+
+        errors = []
+
+        for name in SETS:
+            if name not in self.manifest['sets']:
+                errors.append(f"Missing set {name}")
+            elif not os.path.exists(self._file(f'set_{name}')):
+                errors.append(f"Missing array set_{name} of set {name}")
+            elif len(self.read_set(name)) != self.manifest['sets'][name]['size']:
+                errors.append(f"Set {name} does not match the size in the manifest")
+            elif len(pd.unique(np.asarray(self.read_set(name)))) != self.manifest['sets'][name]['size']:
+                errors.append(f"Set {name} has duplicate members")
+
+        for name in required:
+            if name not in self.manifest['params']:
+                errors.append(f"Missing parameter {name}")
+
+        for name, param in self.manifest['params'].items():
+            if list(PARAM_INDEX.get(name, ())) != param['index']:
+                errors.append(f"Parameter {name} is indexed by {param['index']}, expected {PARAM_INDEX.get(name)}")
+                continue
+
+            arrays = [f'param_{name}_{set_name}' for set_name in param['index']] + [f'param_{name}']
+            missing = [array for array in arrays if not os.path.exists(self._file(array))]
+            if missing:
+                errors.append(f"Missing arrays {missing} of parameter {name}")
+                continue
+
+            codes, values = self.read_param(name)
+            if any(len(set_codes) != len(values) for set_codes in codes) or len(values) != param['nnz']:
+                errors.append(f"Parameter {name} has index and value arrays of different lengths")
+                continue
+            if np.isnan(values).any():
+                errors.append(f"Parameter {name} has missing values")
+
+            sizes = [self.manifest['sets'].get(set_name, {}).get('size', 0) for set_name in param['index']]
+            in_sets = all(len(set_codes) == 0 or (set_codes.min() >= 0 and set_codes.max() < size)
+                          for set_codes, size in zip(codes, sizes))
+            if not in_sets:
+                errors.append(f"Parameter {name} has codes outside its sets")
+            elif len(values):
+                flat = np.ravel_multi_index(tuple(np.asarray(set_codes) for set_codes in codes), tuple(sizes))
+                if len(np.unique(flat)) != len(flat):
+                    errors.append(f"Parameter {name} has duplicate entries")
+
+        return errors
+
+    @classmethod
+    def from_csv(cls, input_dir, path=BUNDLE_DIR):
+        """
+        Convert the csv inputs of a scenario, as read by sparse_linear_program, into a bundle
+        """
+
+        from src.lp_sparse import sparse_linear_program
+
+        lp = sparse_linear_program(input_dir)
+        lp.load()
+
+        bundle = cls(path)
+        for name in SETS:
+            bundle.write_set(name, lp.sets[name].values)
+        for name, (codes, values) in lp.params.items():
+            bundle.write_param(name, codes, values)
+
+        incidence = lp.incidence.tocoo()
+        bundle.write_param('p', [incidence.row, incidence.col], incidence.data)
+
+        return bundle
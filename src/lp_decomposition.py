@@ -0,0 +1,349 @@
+from __future__ import division
+from pyomo.environ import *
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from src.lp_sparse import sparse_linear_program, INPUT_DIR
+from src.lp_results import OUTPUT_DIR, solution_tables, write_solution
+
+# Hour data each worker process solves subproblems from, set once per process by _init_worker
+_worker_data = {}
+
+
+def _init_worker(data):
+    _worker_data.update(data)
+
+
+def _solve_model(model, solver, problem):
+    # Solve a Pyomo model, loading its values and duals only from an optimal solve
+    results = SolverFactory(solver).solve(model, load_solutions=False)
+    if results.solver.termination_condition != TerminationCondition.optimal:
+        raise RuntimeError(f"The {problem} ended with status '{results.solver.termination_condition}', it has "
+                           f"no solution")
+    model.solutions.load_from(results)
+
+
+def _highs_linprog():
+    # SciPy's linprog if it has the HiGHS methods (SciPy 1.5) and their row duals (SciPy 1.7), otherwise None
+    try:
+        import scipy
+        from scipy.optimize import linprog
+    except ImportError:
+        return None
+
+    version = tuple(int(part) for part in re.findall(r'\d+', scipy.__version__)[:2])
+    return linprog if version >= (1, 7) else None
+
+
+def _solve_rows(c, A_ub, b_ub, solver, duals=False):
+    # Minimise c.z subject to A_ub z <= b_ub and z >= 0, returning the objective, z and the row duals
+    linprog = _highs_linprog()
+    if linprog is not None:
+        result = linprog(c, A_ub=A_ub, b_ub=b_ub, bounds=(0, None), method='highs')
+        if result.status != 0:
+            raise RuntimeError(f"The subproblem ended with status {result.status} ({result.message}), it has no "
+                               f"solution")
+        return result.fun, result.x, (result.ineqlin.marginals if duals else None)
+
+    # Without a SciPy that has them, go through Pyomo with a dual suffix
+    A_ub = sp.csr_matrix(A_ub)
+    model = ConcreteModel()
+    model.z = Var(range(A_ub.shape[1]), domain=NonNegativeReals)
+    model.OBJ = Objective(expr=sum(float(c[j]) * model.z[j] for j in np.flatnonzero(c)), sense=minimize)
+
+    def row_rule(model, i):
+        start, end = A_ub.indptr[i], A_ub.indptr[i + 1]
+        body = sum(float(a) * model.z[int(j)] for a, j in zip(A_ub.data[start:end], A_ub.indices[start:end]))
+        return body <= float(b_ub[i])
+
+    model.Rows = Constraint(range(A_ub.shape[0]), rule=row_rule)
+    model.dual = Suffix(direction=Suffix.IMPORT)
+    _solve_model(model, solver, 'subproblem')
+
+    z = np.array([model.z[j].value or 0.0 for j in range(A_ub.shape[1])])
+    row_duals = np.array([model.dual.get(model.Rows[i], 0.0) for i in range(A_ub.shape[0])]) if duals else None
+
+    return value(model.OBJ), z, row_duals
+
+
+def _subproblem(hours, x, data):
+    """
+    Serving LP of a window of hours for fixed capacities x, with columns y[b,k,h], f[l,h], u[b,h] and
+    rows demand[b,h] then capacity[b,k,h], all as <= rows
+    """
+
+    A, VW, P_H_U, G, E, p = (data[name] for name in ['A', 'VW', 'P_H_U', 'G', 'E', 'p'])
+    n_b, n_k = E.shape
+    n_l, n_w = p.shape[1], len(hours)
+
+    # Column offsets of y, f and u
+    n_y = n_b * n_k * n_w
+    off_f = n_y
+    off_u = off_f + n_l * n_w
+
+    c = np.concatenate([VW[:, :, hours].ravel(), P_H_U[:, hours].ravel(), np.full(n_b * n_w, data['penalty'])])
+
+    # Demand rows b*W + h: -(sum_k y + sum_l p f + u) <= -A
+    bkh = np.arange(n_y)
+    b, k, h = np.unravel_index(bkh, (n_b, n_k, n_w))
+    rows = [b * n_w + h]
+    cols = [bkh]
+    vals = [-np.ones(n_y)]
+
+    incidence = p.tocoo()
+    p_h = np.tile(np.arange(n_w), incidence.nnz)
+    rows.append(np.repeat(incidence.row, n_w) * n_w + p_h)
+    cols.append(off_f + np.repeat(incidence.col, n_w) * n_w + p_h)
+    vals.append(-np.repeat(incidence.data, n_w))
+
+    bh = np.arange(n_b * n_w)
+    rows.append(bh)
+    cols.append(off_u + bh)
+    vals.append(-np.ones(n_b * n_w))
+
+    # Capacity rows: y[b,k,h] <= (x[b,k] + E[b,k]) G[h]
+    n_demand = n_b * n_w
+    rows.append(n_demand + bkh)
+    cols.append(bkh)
+    vals.append(np.ones(n_y))
+
+    matrix = sp.csr_matrix((np.concatenate(vals), (np.concatenate(rows), np.concatenate(cols))),
+                           shape=(n_demand + n_y, off_u + n_b * n_w))
+    g = G[hours]
+    b_ub = np.concatenate([-A[:, hours].ravel(), ((x + E)[:, :, None] * g).ravel()])
+
+    return c, matrix, b_ub, n_demand, g
+
+
+def _solve_window(window, x, primal=False):
+    # Optimal serving cost of each hour of a window for fixed x and its subgradient with respect to x. The window
+    # LP is separable by hour, so the hourly costs and subgradients are read from the one solve
+    data = _worker_data
+    hours = data['windows'][window]
+    n_b, n_k = data['E'].shape
+    n_l, n_w = data['P_H_U'].shape[0], len(hours)
+
+    c, matrix, b_ub, n_demand, g = _subproblem(hours, x, data)
+    objective, z, duals = _solve_rows(c, matrix, b_ub, data['solver'], duals=True)
+
+    # Cost of each hour, from the y, f and u columns of the hour
+    n_y = n_b * n_k * n_w
+    cost = c * z
+    hourly = (cost[:n_y].reshape(n_b * n_k, n_w).sum(axis=0)
+              + cost[n_y:n_y + n_l * n_w].reshape(n_l, n_w).sum(axis=0)
+              + cost[n_y + n_l * n_w:].reshape(n_b, n_w).sum(axis=0))
+
+    # d Q[h] / d x[b,k] = capacity dual[b,k,h] G[h]
+    gradient = np.asarray(duals[n_demand:]).reshape(n_b, n_k, n_w) * g
+
+    result = {'hours': hours, 'objective': hourly, 'gradient': gradient}
+    if primal:
+        result['y'] = z[:n_y].reshape(n_b, n_k, n_w)
+        result['f'] = z[n_y:n_y + n_l * n_w].reshape(n_l, n_w)
+        result['u'] = z[n_y + n_l * n_w:].reshape(n_b, n_w)
+
+    return result
+
+
+class benders_decomposition:
+    """
+    Benders decomposition of the charger siting LP over time.
+
+    The hours of the LP are only coupled through the capacities x (and the site decisions v), so the master
+    problem keeps v, x and one serving cost estimate theta[t] per hour, and the serving problem in y and f is
+    a separate LP per hour for fixed x. Hours are solved in windows of consecutive hours, one LP per window.
+    Every iteration solves the master for a lower bound, solves the windows at its x in parallel for an upper
+    bound, and adds an optimality cut for each hour whose cost the master underestimates, from the duals of
+    the capacity rows, until the relative gap between the bounds is within the tolerance. The first cuts are
+    taken at the capacity that serves each node's peak demand locally.
+
+    Each subproblem carries an unmet demand slack u[b,t] priced at penalty per kWh, so it is feasible for any x
+    and only optimality cuts are needed. With a penalty above the cost of serving the demand the solution is
+    the one of the full LP. A master or subproblem the solver does not solve to optimality, ex. an unbounded
+    subproblem from negative costs, raises a RuntimeError rather than giving cuts from values that are not a
+    solution.
+
+    Memory is that of the dense parameter arrays, the cuts and one window's LP per worker, rather than the
+    full B x K x T matrix.
+
+    Attributes
+    ----------
+    lp : sparse_linear_program
+        Loaded sets and parameters
+    windows : list
+        Hour positions of each window
+    history : pd.DataFrame
+        Lower bound, upper bound, gap, cuts added and seconds of each iteration
+    solution : dict
+        Objective, bounds, gap and the v, x, y, f and unmet demand u arrays of the best iterate
+    """
+
+    def __init__(self, input_dir=INPUT_DIR, bundle=None, window=24, penalty=1e4, solver='glpk'):
+        self.lp = sparse_linear_program(input_dir, bundle)
+        self.lp.load()
+        self.penalty = penalty
+        self.solver = solver
+
+        n_t = len(self.lp.sets['T'])
+        self.windows = [np.arange(start, min(start + window, n_t)) for start in range(0, n_t, window)]
+
+        self.data = {'A': self.lp._dense('A'), 'VW': self.lp._dense('VW'), 'P_H_U': self.lp._dense('P_H_U'),
+                     'G': self.lp._dense('G'), 'E': self.lp._dense('E'), 'p': self.lp.incidence,
+                     'penalty': penalty, 'solver': solver, 'windows': self.windows}
+        self.history = None
+        self.solution = None
+
+    def _solve_master(self, cut_hours, cut_gradients, cut_rhs):
+        # Master over v[b], x[b,k], theta[t] with cuts theta[t] - g.x >= Q[t] - g.x_hat
+        S = self.lp._dense('S')
+        cost_x = (self.lp._dense('F') + self.lp._dense('D')).ravel()
+        n_b, n_x, n_t = len(S), len(cost_x), len(self.lp.sets['T'])
+
+        c = np.concatenate([S, cost_x, np.ones(n_t)])
+        integrality = np.concatenate([np.ones(n_b), np.zeros(n_x + n_t)])
+        upper = np.concatenate([np.ones(n_b), np.full(n_x + n_t, np.inf)])
+
+        hours = np.concatenate(cut_hours) if cut_hours else np.empty(0, dtype=np.int64)
+        rows = sp.hstack([sp.csr_matrix((len(hours), n_b)),
+                          -sp.vstack(cut_gradients) if cut_gradients else sp.csr_matrix((0, n_x)),
+                          sp.csr_matrix((np.ones(len(hours)), (np.arange(len(hours)), hours)),
+                                        shape=(len(hours), n_t))]).tocsr()
+        rhs = np.concatenate(cut_rhs) if cut_rhs else np.empty(0)
+
+        try:
+            from scipy.optimize import milp, LinearConstraint, Bounds
+        except ImportError:
+            milp = None
+
+        if milp is not None:
+            constraints = LinearConstraint(rows, rhs, np.inf) if len(rhs) else ()
+            result = milp(c, constraints=constraints, integrality=integrality, bounds=Bounds(0, upper))
+            if result.status != 0:
+                raise RuntimeError(f"The master problem ended with status {result.status} ({result.message})")
+            z, objective = result.x, result.fun
+        else:
+            model = ConcreteModel()
+            model.z = Var(range(len(c)), domain=lambda m, j: Binary if integrality[j] else NonNegativeReals)
+            model.OBJ = Objective(expr=sum(float(c[j]) * model.z[j] for j in np.flatnonzero(c)), sense=minimize)
+
+            def cut_rule(model, i):
+                start, end = rows.indptr[i], rows.indptr[i + 1]
+                return sum(float(a) * model.z[int(j)]
+                           for a, j in zip(rows.data[start:end], rows.indices[start:end])) >= float(rhs[i])
+
+            model.Cuts = Constraint(range(len(rhs)), rule=cut_rule)
+            _solve_model(model, self.solver, 'master problem')
+            z = np.array([model.z[j].value or 0.0 for j in range(len(c))])
+            objective = value(model.OBJ)
+
+        v = z[:n_b]
+        x = z[n_b:n_b + n_x].reshape(n_b, -1)
+        theta = z[n_b + n_x:]
+
+        return objective, S @ v + cost_x @ x.ravel(), v, x, theta
+
+    def _initial_capacity(self):
+        # Capacity split evenly over the charger types that serves each node's peak demand without flows
+        A, G, E = self.data['A'], self.data['G'], self.data['E']
+        with np.errstate(divide='ignore', invalid='ignore'):
+            peak = np.nan_to_num(A / G, nan=0.0, posinf=0.0).max(axis=1)
+        return np.clip(peak[:, None] / E.shape[1] - E, 0, None)
+
+    def solve(self, tolerance=1e-4, max_iterations=100, workers=1):
+        """
+        Iterate master and subproblem solves until the relative optimality gap is within the tolerance
+
+        returns
+        ---------
+        solution:dict - objective (upper bound), lower_bound, gap, iterations and the arrays of the best iterate
+        """
+
+        executor = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(self.data,)) \
+            if workers > 1 else None
+        if executor is None:
+            _init_worker(self.data)
+
+        def solve_windows(x, primal=False):
+            args = [(w, x, primal) for w in range(len(self.windows))]
+            if executor is None:
+                return [_solve_window(*arg) for arg in args]
+            return list(executor.map(_solve_window, *zip(*args)))
+
+        def hourly(windows, name):
+            return np.concatenate([w[name] for w in windows], axis=-1)
+
+        S = self.lp._dense('S')
+        cost_x = (self.lp._dense('F') + self.lp._dense('D')).ravel()
+        n_t = len(self.lp.sets['T'])
+
+        cut_hours, cut_gradients, cut_rhs, history = [], [], [], []
+        best = {'upper_bound': np.inf}
+        try:
+            x = self._initial_capacity()
+            v = np.zeros(len(S))
+            theta = np.full(n_t, -np.inf)
+            lower_bound = -np.inf
+
+            for iteration in range(max_iterations):
+                start = time.perf_counter()
+
+                # Serving cost of every hour at the current capacities
+                windows = solve_windows(x)
+                cost, gradient = hourly(windows, 'objective'), hourly(windows, 'gradient')
+                upper_bound = S @ v + cost_x @ x.ravel() + cost.sum()
+                if upper_bound < best['upper_bound']:
+                    best = {'upper_bound': upper_bound, 'v': v, 'x': x}
+
+                # Cut the hours whose cost the master underestimates
+                violated = np.flatnonzero(cost > theta + tolerance * np.maximum(np.abs(cost), 1.0))
+                g = np.moveaxis(gradient[:, :, violated], -1, 0).reshape(len(violated), len(cost_x))
+                cut_hours.append(violated)
+                cut_gradients.append(sp.csr_matrix(g))
+                cut_rhs.append(cost[violated] - g @ x.ravel())
+
+                lower_bound, _, v, x, theta = self._solve_master(cut_hours, cut_gradients, cut_rhs)
+
+                gap = (best['upper_bound'] - lower_bound) / max(abs(best['upper_bound']), 1e-9)
+                history.append({'iteration': iteration, 'lower_bound': lower_bound,
+                                'upper_bound': best['upper_bound'], 'gap': gap, 'cuts': len(violated),
+                                'seconds': time.perf_counter() - start})
+
+                if gap <= tolerance or not len(violated):
+                    break
+
+            # Serving decisions of the best capacities
+            windows = solve_windows(best['x'], primal=True)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+        self.history = pd.DataFrame(history).set_index('iteration')
+        self.solution = {
+            'objective': best['upper_bound'],
+            'lower_bound': lower_bound,
+            'gap': history[-1]['gap'],
+            'iterations': len(history),
+            'v': best['v'],
+            'x': best['x'],
+            'y': hourly(windows, 'y'),
+            'f': hourly(windows, 'f'),
+            'u': hourly(windows, 'u'),
+        }
+
+        return self.solution
+
+    def save(self, path=OUTPUT_DIR, metadata=None):
+        """
+        Write the nonzero values of the solution, including the unmet demand u, as a Parquet dataset with the
+        bounds, gap and iterations
+        """
+
+        metadata = dict({name: self.solution[name] for name in ['objective', 'lower_bound', 'gap', 'iterations']},
+                        **(metadata or {}))
+        write_solution(solution_tables(self.solution, self.lp.sets), path, metadata)
+
+    def run(self, tolerance=1e-4, max_iterations=100, workers=1):
+        return self.solve(tolerance, max_iterations, workers)
@@ -1,9 +1,26 @@
 from __future__ import division
 from pyomo.environ import *
+from pyomo.core.expr.visitor import identify_variables
 import numpy as np
 import pandas as pd
 from folium import Map, CircleMarker, FeatureGroup, LayerControl
 import os.path
+import time
+from src.lp_results import OUTPUT_DIR, instance_tables, write_solution, read_solution
+from src.lp_solvers import solver_backend, require_optimal
+from src.profiling import RunProfiler
+
+
+def model_size(instance):
+    """
+    Number of constraints, variables and constraint nonzeros of a Pyomo instance
+    """
+
+    constraints = list(instance.component_data_objects(Constraint, active=True))
+    nonzeros = sum(len(set(id(var) for var in identify_variables(constraint.body, include_fixed=False)))
+                   for constraint in constraints)
+
+    return {'constraints': len(constraints), 'variables': instance.nvariables(), 'nonzeros': nonzeros}
 
 
 class linear_program:
@@ -16,6 +33,7 @@ class linear_program:
         # Create each file
             # Calculate Travel Times from google_api and Calculate Penalty Matrix
         #
+        pass
 
     def load(self):
 
@@ -106,101 +124,87 @@ class linear_program:
 
         return instance
 
-    def run(self):
-        instance = self.load()
+    def run(self, solver='glpk', profiler=None, **controls):
+        """
+        Build and solve the LP with a solver_backend, or the name of one with the input controls (time_limit,
+        threads, mip_gap, presolve), and save the results with the timing record of the run. The build, solve
+        and save stages, and the size of the model, are recorded by the profiler if one is given
+
+        returns
+        ---------
+        record:dict - backend, status, objective and build, presolve, solve and extract seconds
+        """
+
+        profiler = profiler if profiler is not None else RunProfiler(enabled=False)
+
+        with profiler.stage('lp_build'):
+            start = time.perf_counter()
+            instance = self.load()
+            build_seconds = time.perf_counter() - start
+            if profiler.enabled:
+                profiler.count(**model_size(instance))
 
         # Create and solve the LP
-        solver = pyomo.opt.SolverFactory('glpk')
-        solver.solve(instance, tee=True, keepfiles=True)
+        with profiler.stage('lp_solve'):
+            backend = solver_backend(solver, **controls) if isinstance(solver, str) else solver
+            record = backend.solve(instance)
+            record['build_seconds'] = build_seconds
+            profiler.count(backend=record['backend'], status=record['status'])
+            require_optimal(record)
 
         # Save the instance results
-        self.save(instance)
-
-    def save(self, instance):
-
-        # Write out results
-        ind_x = list(instance.x)
-        val_x = list(instance.x[:, :].value)
-
-        ind_v = list(instance.v)
-        val_v = list(instance.v[:].value)
-
-        ind_y = list(instance.y)
-        val_y = list(instance.y[:, :, :].value)
-
-        ind_f = list(instance.f)
-        val_f = list(instance.f[:, :].value)
-
-        result_x = [i + tuple([j]) for i, j in zip(ind_x, val_x)]
-        result_v = [i for i in zip(ind_v, val_v)]
-        result_y = [i + tuple([j]) for i, j in zip(ind_y, val_y)]
-        result_f = [i + tuple([j]) for i, j in zip(ind_f, val_f)]
-
-        pd.DataFrame(np.array(result_x)).to_csv('../data/processed/lp_data/output_data/x.csv', index=False)
-        pd.DataFrame(np.array(result_v)).to_csv('../data/processed/lp_data/output_data/v.csv', index=False)
-        pd.DataFrame(np.array(result_y)).to_csv('../data/processed/lp_data/output_data/y.csv', index=False)
-        pd.DataFrame(np.array(result_f)).to_csv('../data/processed/lp_data/output_data/f.csv', index=False)
-
-    def show(self):
-
-       # Function should take the LP output, join with h3 hexagons to get geometries
-       # And plot the proposed charging stations
-       # Could add functionality for overlap with
-
-        def map_multiple_outputs_points(directory: str, map_center=None, save_path=None):
-            """
-            Creates a folium map of single or multiple outputs from the LP model. Circle markers communicate both location of
-            station and forecast demand (diameter).
-            Good for outputs from LP model that outputs points - not hexes.
-            """
-            station_locations = open_station_locations()
-            if not map_center:
-                m_lat = station_locations[:1]['latitude']
-                m_long = station_locations[:1]['longitude']
-
-            else:
-                m_lat = map_center[0]
-                m_long = map_center[1]
-
-            m = Map(
-                location=[m_lat, m_long],
-                tiles='cartodbpositron',
-                zoom_start=9
-            )
-
-            colors = ['blue', 'crimson', 'violet', 'orange', 'yellow', 'black']
-            cnt = 0
-
-            for file in os.listdir(directory):
-                open_path_1 = f'data/GIS/LP_outputs/{file}'
-                print(file)
-                name = file.rstrip('.csv')
-                proposed_stations_1 = open_lp_proposed_stations(lp_proposed_stations_path=open_path_1)
-                proposed_stations_1.set_index('id', inplace=True)
-                proposed_stations_1 = join_dfs(station_locations, proposed_stations_1)
-
-                feature_group = FeatureGroup(name=name)
-                for i, row in proposed_stations_1.iterrows():
-                    if row['demand'] == 0:
-                        pass
-                    else:
-                        c = CircleMarker(
-                            radius=row['demand'],
-                            location=[row["latitude"], row["longitude"]],
-                            tooltip=f"Station ID: {row.name} \n Demand: {row['demand']} kWh",
-                            color=colors[cnt],
-                            fill=True,
-                            fill_color=colors[cnt]
-                        )
-                        c.add_to(feature_group)
-                feature_group.add_to(m)
-                cnt += 1
-
-            LayerControl('bottomright', collapsed=False).add_to(m)
-            if save_path:
-                m.save(save_path)
-
-            return m
-
-
-def join_hex_ids()
\ No newline at end of file
+        with profiler.stage('lp_save'):
+            self.save(instance, metadata=record)
+
+        return record
+
+    def save(self, instance, path=OUTPUT_DIR, metadata=None):
+        """
+        Write the nonzero values of x, v, y and f as a Parquet dataset, one table per variable, with the
+        objective and any solve metadata. The extraction time is added to the metadata
+        """
+
+        start = time.perf_counter()
+        tables = instance_tables(instance)
+
+        metadata = metadata if metadata is not None else {}
+        metadata['objective'] = value(instance.OBJ)
+        metadata['extract_seconds'] = time.perf_counter() - start
+
+        write_solution(tables, path, metadata)
+
+    def show(self, path=OUTPUT_DIR, save_path=None):
+        """
+        Folium map of the proposed charging stations of a saved solution, one layer per charger type, with a
+        circle at each hexagon sized by the capacity built there
+        """
+
+        tables, _ = read_solution(path, variables=['x'])
+        stations = tables['x']
+        stations = stations[stations.geometry.notna()]
+        if stations.empty:
+            raise ValueError(f"No proposed stations with hexagon geometry in {path}")
+        centroids = pd.Series([polygon.centroid for polygon in stations.geometry], index=stations.index)
+
+        m = Map(location=[np.mean([point.y for point in centroids]), np.mean([point.x for point in centroids])],
+                tiles='cartodbpositron', zoom_start=9)
+
+        colors = ['blue', 'crimson', 'violet', 'orange', 'yellow', 'black']
+        for cnt, (charger, group) in enumerate(stations.groupby('K')):
+            feature_group = FeatureGroup(name=f'Charger {charger}')
+            for hex_id, capacity, point in zip(group['B'], group['value'], centroids[group.index]):
+                CircleMarker(
+                    radius=capacity,
+                    location=[point.y, point.x],
+                    tooltip=f"Hex ID: {hex_id} \n Capacity: {capacity}",
+                    color=colors[cnt % len(colors)],
+                    fill=True,
+                    fill_color=colors[cnt % len(colors)]
+                ).add_to(feature_group)
+            feature_group.add_to(m)
+
+        LayerControl('bottomright', collapsed=False).add_to(m)
+        if save_path:
+            m.save(save_path)
+
+        return m
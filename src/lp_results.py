@@ -0,0 +1,148 @@
+import json
+import os
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+from h3 import h3
+from shapely import wkb
+from shapely.geometry import Polygon
+from src.h3_utils import _hex_boundary
+
+OUTPUT_DIR = '../data/processed/lp_data/output_data/solution.parquet'
+
+# Decision variables of the siting LP and the sets they are indexed by, u is the unmet demand of the
+# decomposition
+VARIABLE_SETS = {
+    'v': ('B',),
+    'x': ('B', 'K'),
+    'y': ('B', 'K', 'T'),
+    'f': ('L', 'T'),
+    'u': ('B', 'T'),
+}
+
+# Variables written with the geometry of their node's hexagon
+GEOMETRY_VARIABLES = ('v', 'x')
+
+
+def instance_tables(instance, tolerance=0):
+    """
+    Nonzero values of the decision variables of a solved Pyomo instance, one typed frame per variable with a
+    column per index set and a 'value' column
+
+    parameters
+    ---------
+    instance:pyomo.environ.ConcreteModel - solved instance of lp_model.linear_program
+    tolerance:float - values with a magnitude at or below this are treated as zero
+
+    returns
+    ---------
+    tables:dict - variable name to pd.DataFrame
+    """
+
+    tables = {}
+    for name, index in VARIABLE_SETS.items():
+        var = getattr(instance, name, None)
+        if var is None:
+            continue
+
+        # Values in one pass, then index tuples of the nonzero entries only
+        keys = list(var.keys())
+        values = np.fromiter((np.nan if v.value is None else v.value for v in var.values()),
+                             dtype=np.float64, count=len(keys))
+        nonzero = np.flatnonzero(np.abs(np.nan_to_num(values)) > tolerance)
+
+        labels = pd.MultiIndex.from_tuples([keys[i] if isinstance(keys[i], tuple) else (keys[i],) for i in nonzero],
+                                           names=list(index)) \
+            if len(nonzero) else pd.MultiIndex.from_arrays([[]] * len(index), names=list(index))
+        tables[name] = pd.DataFrame({'value': values[nonzero]}, index=labels).reset_index()
+
+    return tables
+
+
+def solution_tables(solution, sets, tolerance=0):
+    """
+    Nonzero values of the variable arrays of a sparse_linear_program or benders_decomposition solution, one
+    typed frame per variable with a column per index set and a 'value' column
+
+    parameters
+    ---------
+    solution:dict - variable name to array shaped by its sets
+    sets:dict - pd.Index of the members of each set
+    tolerance:float - values with a magnitude at or below this are treated as zero
+
+    returns
+    ---------
+    tables:dict - variable name to pd.DataFrame
+    """
+
+    tables = {}
+    for name, index in VARIABLE_SETS.items():
+        if name not in solution:
+            continue
+
+        values = np.asarray(solution[name])
+        codes = np.nonzero(np.abs(values) > tolerance)
+        df = pd.DataFrame({set_name: sets[set_name].values[set_codes] for set_name, set_codes in zip(index, codes)})
+        df['value'] = values[codes]
+        tables[name] = df
+
+    return tables
+
+
+def _hex_geometry(hex_ids):
+    # Polygon of each distinct hex id, None for labels that are not h3 cells
+    hex_ids = pd.Series(hex_ids).astype(str)
+    polygons = {hex_id: Polygon(_hex_boundary(hex_id)) if h3.h3_is_valid(hex_id) else None
+                for hex_id in hex_ids.unique()}
+    return hex_ids.map(polygons).values
+
+
+def write_solution(tables, path=OUTPUT_DIR, metadata=None):
+    """
+    Write the variable tables of a solve as one Parquet dataset: a directory with a <variable>.parquet table
+    per variable and a metadata.json of the solve. The v and x tables carry the WKB geometry of the hexagon of
+    their node, so the solution can be mapped without further lookups.
+
+    parameters
+    ---------
+    tables:dict - variable name to pd.DataFrame, from instance_tables or solution_tables
+    path:str - dataset directory
+    metadata:dict - solver, status, objective, timings and any other JSON serializable solve information
+    """
+
+    os.makedirs(path, exist_ok=True)
+
+    for name, df in tables.items():
+        if name in GEOMETRY_VARIABLES:
+            df = df.assign(geometry=[None if polygon is None else polygon.wkb for polygon in _hex_geometry(df['B'])])
+        df.to_parquet(os.path.join(path, f'{name}.parquet'), index=False)
+
+    metadata = dict(metadata or {})
+    metadata['variables'] = {name: {'index': list(VARIABLE_SETS[name]), 'nonzeros': int(len(df))}
+                             for name, df in tables.items()}
+    with open(os.path.join(path, 'metadata.json'), 'w') as f:
+        json.dump(metadata, f, indent=2, default=float)
+
+
+def read_solution(path=OUTPUT_DIR, variables=None):
+    """
+    Read a solution dataset written by write_solution
+
+    returns
+    ---------
+    tables:dict - variable name to pd.DataFrame, GeoDataFrames for the variables with geometry
+    metadata:dict - the solve metadata
+    """
+
+    with open(os.path.join(path, 'metadata.json')) as f:
+        metadata = json.load(f)
+
+    tables = {}
+    for name in variables or metadata['variables']:
+        df = pd.read_parquet(os.path.join(path, f'{name}.parquet'))
+        if 'geometry' in df:
+            geometry = [None if geometry is None else wkb.loads(geometry) for geometry in df['geometry']]
+            df = gpd.GeoDataFrame(df.drop(columns='geometry'), geometry=geometry, crs='EPSG:4326')
+        tables[name] = df
+
+    return tables, metadata
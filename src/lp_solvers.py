@@ -0,0 +1,216 @@
+from __future__ import division
+from pyomo.environ import *
+import os
+import re
+import tempfile
+import time
+import numpy as np
+
+# Pyomo solver of each backend. HiGHS goes through the persistent APPSI interface, which needs highspy
+PYOMO_SOLVERS = {'glpk': 'glpk', 'cbc': 'cbc', 'highs': 'appsi_highs'}
+
+# Option names of each backend for the time limit (seconds), thread count, relative MIP gap and presolve
+OPTION_NAMES = {
+    'glpk': {'time_limit': 'tmlim', 'threads': None, 'mip_gap': 'mipgap'},
+    'cbc': {'time_limit': 'sec', 'threads': 'threads', 'mip_gap': 'ratioGap'},
+    'highs': {'time_limit': 'time_limit', 'threads': 'threads', 'mip_gap': 'mip_rel_gap'},
+}
+
+# Default directory of the captured solver logs
+LOG_DIR = os.path.join(tempfile.gettempdir(), 'lp_solver_logs')
+
+# HiGHS reports its presolve time in the closing summary of a solve
+_HIGHS_PRESOLVE = re.compile(r'([\d.]+) \(presolve\)', re.IGNORECASE)
+
+# Status of a solve whose solution can be used, any other status has no solution
+OPTIMAL = 'optimal'
+
+# Normalised status of the Pyomo termination conditions, any other condition is an 'error'
+_PYOMO_STATUS = {'optimal': OPTIMAL, 'globallyOptimal': OPTIMAL, 'locallyOptimal': OPTIMAL,
+                 'infeasible': 'infeasible', 'unbounded': 'unbounded',
+                 'infeasibleOrUnbounded': 'infeasible_or_unbounded', 'maxTimeLimit': 'time_limit',
+                 'maxIterations': 'iteration_limit', 'maxEvaluations': 'iteration_limit'}
+
+# Normalised status of the scipy.optimize.milp status codes
+_MILP_STATUS = {0: OPTIMAL, 1: 'time_limit', 2: 'infeasible', 3: 'unbounded', 4: 'error'}
+
+
+def require_optimal(record):
+    """
+    Raise a RuntimeError with the solver's termination unless the solve of a timing record found an optimal
+    solution, so a failed solve is never split or saved as a solution
+    """
+
+    if record['status'] != OPTIMAL:
+        raise RuntimeError(f"The {record['backend']} solve ended with status '{record['status']}' "
+                           f"({record['termination']}), it has no solution")
+
+
+class solver_backend:
+    """
+    Open-source MIP solver used for the siting LP, selected by name, with the same controls for every backend.
+    Solves run silently, the solver log is captured to a file and summarised in a timing record.
+
+    'glpk' and 'cbc' run the installed executables through Pyomo, 'highs' runs HiGHS in process, through
+    Pyomo's persistent interface for Pyomo models and through scipy.optimize.milp for matrices.
+
+    Parameters
+    ____________
+    name : str
+        'glpk', 'cbc' or 'highs'
+    time_limit : float
+        Seconds before the solver stops with its best solution, None for no limit
+    threads : int
+        Solver threads, None for the solver default (GLPK is single threaded)
+    mip_gap : float
+        Relative MIP gap at which the solver stops, None for the solver default
+    presolve : bool
+        Whether the solver presolves the model
+    log_dir : str
+        Directory of the solver logs
+    """
+
+    def __init__(self, name='glpk', time_limit=None, threads=None, mip_gap=None, presolve=True, log_dir=LOG_DIR):
+        if name not in PYOMO_SOLVERS:
+            raise ValueError(f"Unknown solver '{name}', expected one of {list(PYOMO_SOLVERS)}")
+
+        self.name = name
+        self.time_limit = time_limit
+        self.threads = threads
+        self.mip_gap = mip_gap
+        self.presolve = presolve
+        self.log_dir = log_dir
+        self._solver = None
+
+    def options(self):
+        """
+        Solver options of the controls, in the backend's own names
+        """
+
+        options = {}
+        for control, option in OPTION_NAMES[self.name].items():
+            setting = getattr(self, control)
+            if setting is not None and option is not None:
+                options[option] = setting
+
+        if self.name == 'glpk':
+            options['presol' if self.presolve else 'nopresol'] = ''
+        elif self.name == 'cbc' and not self.presolve:
+            options['preprocess'] = 'off'
+        elif self.name == 'highs':
+            options['presolve'] = 'on' if self.presolve else 'off'
+
+        return options
+
+    def pyomo_solver(self):
+        """
+        The configured Pyomo solver, created once so persistent solvers keep their model between solves
+        """
+
+        if self._solver is None:
+            self._solver = SolverFactory(PYOMO_SOLVERS[self.name])
+            for option, setting in self.options().items():
+                self._solver.options[option] = setting
+
+        return self._solver
+
+    def available(self):
+        """
+        Whether the backend can solve Pyomo models here
+        """
+
+        try:
+            return bool(self.pyomo_solver().available(exception_flag=False))
+        except Exception:
+            return False
+
+    def _record(self, status, termination, objective, solve_seconds, log_path):
+        log = ''
+        if log_path is not None and os.path.exists(log_path):
+            with open(log_path) as f:
+                log = f.read()
+
+        presolve = _HIGHS_PRESOLVE.search(log)
+
+        return {'backend': self.name, 'status': status, 'termination': termination, 'objective': objective,
+                'presolve_seconds': float(presolve.group(1)) if presolve else None,
+                'solve_seconds': solve_seconds, 'log_path': log_path}
+
+    def solve(self, model, warmstart=False):
+        """
+        Solve a Pyomo model in place, warm started from its current values if asked and supported
+
+        returns
+        ---------
+        record:dict - backend, status ('optimal', 'infeasible', 'unbounded', 'time_limit', ...), the solver's own
+                      termination, objective (None unless optimal), presolve and solve seconds and the log path
+        """
+
+        solver = self.pyomo_solver()
+        os.makedirs(self.log_dir, exist_ok=True)
+        log_path = os.path.join(self.log_dir, f'{self.name}_{time.time_ns()}.log')
+
+        # APPSI solvers take the log file through their config rather than as a solve argument. Solutions are
+        # loaded once the termination is known, as solvers without one raise on loading
+        kwargs = {'tee': False, 'load_solutions': False}
+        if 'logfile' in getattr(solver, 'config', {}):
+            solver.config.logfile = log_path
+        else:
+            kwargs['logfile'] = log_path
+        if warmstart and getattr(solver, 'warm_start_capable', lambda: False)():
+            kwargs['warmstart'] = True
+
+        start = time.perf_counter()
+        results = solver.solve(model, **kwargs)
+        solve_seconds = time.perf_counter() - start
+
+        # The variables only take a solution from an optimal solve
+        termination = str(results.solver.termination_condition).split('.')[-1]
+        status = _PYOMO_STATUS.get(termination, 'error')
+        objective = None
+        if status == OPTIMAL:
+            model.solutions.load_from(results)
+            objective = next((value(obj) for obj in model.component_data_objects(Objective, active=True)), None)
+
+        return self._record(status, termination, objective, solve_seconds, log_path)
+
+    def solve_matrix(self, lp):
+        """
+        Solve the assembled matrix of a sparse_linear_program, through scipy.optimize.milp for HiGHS when the
+        installed SciPy has it and through a Pyomo model of the matrix otherwise
+
+        returns
+        ---------
+        z:np.ndarray - value of every column, None unless the solve is optimal
+        record:dict - as for solve
+        """
+
+        try:
+            from scipy.optimize import milp, LinearConstraint, Bounds
+        except ImportError:
+            milp = None
+
+        if self.name != 'highs' or milp is None:
+            model = lp.to_pyomo()
+            record = self.solve(model)
+            if record['status'] != OPTIMAL:
+                return None, record
+            z = np.array([model.z[j].value or 0.0 for j in range(lp.A.shape[1])], dtype=np.float64)
+            return z, record
+
+        options = {'disp': False, 'presolve': self.presolve}
+        if self.time_limit is not None:
+            options['time_limit'] = self.time_limit
+        if self.mip_gap is not None:
+            options['mip_rel_gap'] = self.mip_gap
+
+        start = time.perf_counter()
+        result = milp(lp.c, constraints=LinearConstraint(lp.A, lp.row_lower, lp.row_upper),
+                      integrality=lp.integrality, bounds=Bounds(lp.lower, lp.upper), options=options)
+        solve_seconds = time.perf_counter() - start
+
+        status = _MILP_STATUS.get(result.status, 'error')
+        if status != OPTIMAL:
+            return None, self._record(status, result.message, None, solve_seconds, None)
+
+        return result.x, self._record(status, result.message, result.fun, solve_seconds, None)
@@ -0,0 +1,336 @@
+from __future__ import division
+from pyomo.environ import *
+import os.path
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from src.lp_bundle import InputBundle
+from src.lp_results import OUTPUT_DIR, solution_tables, write_solution
+from src.lp_solvers import solver_backend, require_optimal
+from src.profiling import RunProfiler
+
+INPUT_DIR = '../data/interim/lp_data/input_data/'
+
+# Parameter files of the siting LP, with the sets they are indexed by
+PARAM_FILES = {
+    'F': ('Fixed_Cost.csv', ('B', 'K')),
+    'D': ('Demand_Charge.csv', ('B', 'K')),
+    'A': ('Demand.csv', ('B', 'T')),
+    'G': ('Charging_Efficiency.csv', ('T',)),
+    'C': ('Plug_in_Limit.csv', ('B', 'K')),
+    'N': ('Charger_Capacity.csv', ('K',)),
+    'E': ('Existing_Capacity.csv', ('B', 'K')),
+    'S': ('Site_Develop_Cost.csv', ('B',)),
+    'VW': ('V_Times_W.csv', ('B', 'K', 'T')),
+    'P_H_U': ('P_H_U.csv', ('L', 'T')),
+}
+INCIDENCE_FILE = 'Incidence_Matrix.tab'
+
+
+def _set_index(values, name):
+    # Set members from a Set_List column, which is padded with NaN to the longest set
+    values = pd.Series(values).dropna()
+    if values.dtype.kind == 'f' and (values == values.round()).all():
+        values = values.astype(np.int64)
+    return pd.Index(values.values, name=name)
+
+
+class sparse_linear_program:
+    """
+    Matrix form of the charger siting LP in lp_model.linear_program, built directly as SciPy sparse arrays.
+
+    The objective and constraints are the same as the Pyomo model:
+        min  S.v + (F + D).x + VW.y + P_H_U.f
+        s.t. sum_k y[b,k,t] + sum_l p[b,l] f[l,t] >= A[b,t]       (FirstConstraint)
+             y[b,k,t] <= (x[b,k] + E[b,k]) G[t]                   (SecondConstraint)
+    but the incidence sums only run over the nonzero p[b,l], so the build scales with the nonzeros rather than
+    B x L x T, and the full sets are used. The integer charger count n, which appears in no constraint or
+    objective term, is left out. Parameter entries missing from the input files are zero.
+
+    Columns are ordered v[b], x[b,k], y[b,k,t], f[l,t] and rows FirstConstraint[b,t], SecondConstraint[b,k,t],
+    each row-major over its sets.
+
+    Attributes
+    ----------
+    sets : dict
+        Pandas Index of the members of each set B, K, T and L, positions are the integer codes
+    params : dict
+        Parameters as (codes, values) pairs, codes holding one integer code array per indexing set
+    incidence : scipy.sparse.csr_matrix
+        B x L incidence matrix p
+    build_stats : dict
+        Time, peak memory and size of the last build
+    """
+
+    def __init__(self, input_dir=INPUT_DIR, bundle=None):
+        self.input_dir = input_dir
+        self.bundle = bundle
+        self.sets = None
+        self.params = None
+        self.incidence = None
+        self.build_stats = {}
+        self.solution = None
+
+    def load(self):
+        """
+        Read the sets, parameters and incidence matrix from the input bundle if one was given, otherwise from
+        the input csv files
+        """
+
+        if self.bundle is not None:
+            return self.load_bundle(self.bundle)
+
+        # Import sets
+        set_df = pd.read_csv(os.path.join(self.input_dir, 'Set_List.csv'))
+        self.sets = {name: _set_index(set_df[name], name) for name in ['B', 'K', 'T', 'L']}
+
+        # Import parameters, encoding the index columns as set codes
+        self.params = {}
+        for name, (filename, index) in PARAM_FILES.items():
+            df = pd.read_csv(os.path.join(self.input_dir, filename))
+            self.params[name] = self._encode(df.iloc[:, :len(index)], df.iloc[:, -1].values, index)
+
+        # Import the incidence matrix, stored as a dense table in Pyomo's array format
+        incidence = pd.read_csv(os.path.join(self.input_dir, INCIDENCE_FILE), sep=r'\s+', index_col=0)
+        rows, cols = np.nonzero(incidence.values)
+        (b, l), p = self._encode(pd.DataFrame({'B': incidence.index[rows], 'L': incidence.columns[cols]}),
+                                 incidence.values[rows, cols], ('B', 'L'))
+        self.incidence = sp.csr_matrix((p, (b, l)), shape=(len(self.sets['B']), len(self.sets['L'])))
+
+    def load_bundle(self, bundle):
+        """
+        Read the sets, parameters and incidence matrix from an InputBundle (or its path), memory-mapping the
+        parameter arrays
+        """
+
+        bundle = InputBundle(bundle) if isinstance(bundle, str) else bundle
+
+        errors = bundle.validate()
+        if errors:
+            raise ValueError(f"Invalid input bundle {bundle.path}: " + "; ".join(errors))
+
+        self.sets = {name: pd.Index(bundle.read_set(name), name=name) for name in ['B', 'K', 'T', 'L']}
+        self.params = {name: bundle.read_param(name) for name in PARAM_FILES}
+
+        (b, l), p = bundle.read_param('p')
+        self.incidence = sp.csr_matrix((p, (b, l)), shape=(len(self.sets['B']), len(self.sets['L'])))
+
+    def _encode(self, index_df, values, index):
+        # Integer codes of each index column, dropping entries outside the sets
+        codes = [self.sets[name].get_indexer(index_df.iloc[:, i].values) for i, name in enumerate(index)]
+        keep = np.logical_and.reduce([code >= 0 for code in codes])
+        return [code[keep] for code in codes], np.asarray(values, dtype=np.float64)[keep]
+
+    def _dense(self, name):
+        # Dense array of a parameter over its sets
+        codes, values = self.params[name]
+        shape = tuple(len(self.sets[s]) for s in PARAM_FILES[name][1])
+        dense = np.zeros(shape)
+        dense[tuple(codes)] = values
+        return dense
+
+    def objective(self):
+        """
+        Objective coefficients of every column, from the current S, F, D, VW and P_H_U
+        """
+
+        return np.concatenate([self._dense('S'),
+                               (self._dense('F') + self._dense('D')).ravel(),
+                               self._dense('VW').ravel(),
+                               self._dense('P_H_U').ravel()])
+
+    def row_bounds(self):
+        """
+        Lower and upper bounds of every row, from the current A, E and G
+        """
+
+        n_b, n_k, n_t = (len(self.sets[name]) for name in ['B', 'K', 'T'])
+        b, k, t = np.unravel_index(np.arange(n_b * n_k * n_t), (n_b, n_k, n_t))
+
+        row_lower = np.concatenate([self._dense('A').ravel(), np.full(len(b), -np.inf)])
+        row_upper = np.concatenate([np.full(n_b * n_t, np.inf), (self._dense('E')[b, k] * self._dense('G')[t])])
+
+        return row_lower, row_upper
+
+    def build(self):
+        """
+        Assemble the objective vector, constraint matrix, bounds and integrality of the LP
+
+        returns
+        ---------
+        build_stats:dict - build seconds, peak Python memory during the build, matrix size and nonzeros
+        """
+
+        start = time.perf_counter()
+        tracemalloc.start()
+
+        n_b, n_k, n_t, n_l = (len(self.sets[name]) for name in ['B', 'K', 'T', 'L'])
+
+        # Column offsets of each variable
+        off_x = n_b
+        off_y = off_x + n_b * n_k
+        off_f = off_y + n_b * n_k * n_t
+        n_cols = off_f + n_l * n_t
+
+        # Objective
+        self.c = self.objective()
+
+        # FirstConstraint rows b*T + t: the y of every charger type at the node
+        bkt = np.arange(n_b * n_k * n_t)
+        b, k, t = np.unravel_index(bkt, (n_b, n_k, n_t))
+        rows = [b * n_t + t]
+        cols = [off_y + bkt]
+        vals = [np.ones(len(bkt))]
+
+        # FirstConstraint: flows on the lines incident to the node, for the nonzero incidences only
+        incidence = self.incidence.tocoo()
+        p_row = np.repeat(incidence.row, n_t)
+        p_col = np.repeat(incidence.col, n_t)
+        p_t = np.tile(np.arange(n_t), incidence.nnz)
+        rows.append(p_row * n_t + p_t)
+        cols.append(off_f + p_col * n_t + p_t)
+        vals.append(np.repeat(incidence.data, n_t))
+
+        # SecondConstraint rows, one per y: y[b,k,t] - G[t] x[b,k] <= E[b,k] G[t]
+        g = self._dense('G')
+        n_first = n_b * n_t
+        rows.extend([n_first + bkt, n_first + bkt])
+        cols.extend([off_y + bkt, off_x + b * n_k + k])
+        vals.extend([np.ones(len(bkt)), -g[t]])
+
+        n_rows = n_first + len(bkt)
+        self.A = sp.csr_matrix((np.concatenate(vals), (np.concatenate(rows), np.concatenate(cols))),
+                               shape=(n_rows, n_cols))
+
+        # Row bounds
+        self.row_lower, self.row_upper = self.row_bounds()
+
+        # Variable bounds and integrality, v is binary and the rest non-negative reals
+        self.lower = np.zeros(n_cols)
+        self.upper = np.full(n_cols, np.inf)
+        self.upper[:off_x] = 1
+        self.integrality = np.zeros(n_cols, dtype=np.int8)
+        self.integrality[:off_x] = 1
+
+        self.offsets = {'v': (0, (n_b,)), 'x': (off_x, (n_b, n_k)), 'y': (off_y, (n_b, n_k, n_t)),
+                        'f': (off_f, (n_l, n_t))}
+
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        self.build_stats = {
+            'build_seconds': time.perf_counter() - start,
+            'peak_memory_mb': peak / 1e6,
+            'matrix_memory_mb': (self.A.data.nbytes + self.A.indices.nbytes + self.A.indptr.nbytes) / 1e6,
+            'rows': n_rows,
+            'columns': n_cols,
+            'nonzeros': self.A.nnz,
+        }
+
+        return self.build_stats
+
+    def to_pyomo(self, mutable=False):
+        """
+        Concrete Pyomo model of the matrix, one indexed variable and constraint with a sparse sum per row.
+
+        With mutable, the objective coefficients and the FirstConstraint lower bounds are mutable parameters
+        c[j] and rhs[i], so a scenario can change them in place and a persistent solver only receives the
+        changed coefficients.
+        """
+
+        model = ConcreteModel()
+        A = self.A
+        n_rows, n_cols = A.shape
+        n_first = len(self.sets['B']) * len(self.sets['T'])
+
+        def domain_rule(model, j):
+            return Binary if self.integrality[j] else NonNegativeReals
+
+        model.z = Var(range(n_cols), domain=domain_rule)
+
+        if mutable:
+            model.c = Param(range(n_cols), mutable=True, initialize=dict(enumerate(self.c.tolist())))
+            model.rhs = Param(range(n_first), mutable=True,
+                              initialize=dict(enumerate(self.row_lower[:n_first].tolist())))
+            model.OBJ = Objective(expr=sum(model.c[j] * model.z[j] for j in range(n_cols)), sense=minimize)
+        else:
+            model.OBJ = Objective(expr=sum(float(self.c[j]) * model.z[j] for j in np.flatnonzero(self.c)),
+                                  sense=minimize)
+
+        def row_rule(model, i):
+            start, end = A.indptr[i], A.indptr[i + 1]
+            body = sum(float(a) * model.z[int(j)] for a, j in zip(A.data[start:end], A.indices[start:end]))
+            if mutable and i < n_first:
+                return body >= model.rhs[i]
+            lower = None if np.isinf(self.row_lower[i]) else float(self.row_lower[i])
+            upper = None if np.isinf(self.row_upper[i]) else float(self.row_upper[i])
+            return (lower, body, upper)
+
+        model.Rows = Constraint(range(n_rows), rule=row_rule)
+
+        return model
+
+    def solve(self, solver='glpk'):
+        """
+        Solve the assembled LP with a solver_backend, or the name of one with its default controls. Raises a
+        RuntimeError with the solver's termination if the solve is not optimal
+
+        returns
+        ---------
+        solution:dict - objective value and one array per variable, shaped by its sets
+        """
+
+        backend = solver_backend(solver) if isinstance(solver, str) else solver
+        z, record = backend.solve_matrix(self)
+
+        # A failed solve leaves no solution, its record is kept for inspection
+        self.solution = None
+        self.build_stats.update(record)
+        require_optimal(record)
+
+        start = time.perf_counter()
+        self.solution = self.split_solution(z, record['objective'])
+        self.build_stats['extract_seconds'] = time.perf_counter() - start
+
+        return self.solution
+
+    def split_solution(self, z, objective):
+        """
+        Solution dict of the objective value and one array per variable, shaped by its sets, from the
+        column values z
+        """
+
+        solution = {'objective': objective}
+        for name, (offset, shape) in self.offsets.items():
+            solution[name] = z[offset:offset + int(np.prod(shape))].reshape(shape)
+
+        return solution
+
+    def save(self, path=OUTPUT_DIR, metadata=None):
+        """
+        Write the nonzero values of the solution as a Parquet dataset, one table per variable, with the objective
+        and build statistics
+        """
+
+        if self.solution is None:
+            raise RuntimeError(f"No solution to save, the last solve ended with status "
+                               f"'{self.build_stats.get('status')}'")
+
+        metadata = dict(self.build_stats, objective=self.solution['objective'], **(metadata or {}))
+        write_solution(solution_tables(self.solution, self.sets), path, metadata)
+
+    def run(self, solver='glpk', profiler=None):
+        profiler = profiler if profiler is not None else RunProfiler(enabled=False)
+
+        with profiler.stage('lp_load'):
+            self.load()
+        with profiler.stage('lp_build'):
+            self.build()
+            profiler.count(constraints=self.A.shape[0], variables=self.A.shape[1], nonzeros=self.A.nnz)
+        with profiler.stage('lp_solve'):
+            solution = self.solve(solver)
+            profiler.count(backend=self.build_stats.get('backend'), status=self.build_stats.get('status'))
+
+        return solution
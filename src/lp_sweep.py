@@ -0,0 +1,229 @@
+from __future__ import division
+from pyomo.environ import *
+import time
+from concurrent.futures import ProcessPoolExecutor
+from numbers import Number
+import numpy as np
+import pandas as pd
+from src.lp_sparse import sparse_linear_program, INPUT_DIR, PARAM_FILES
+from src.lp_solvers import solver_backend, OPTIMAL
+
+# Parameters a scenario may change without rebuilding the constraint matrix. They only enter the objective
+# coefficients and the FirstConstraint lower bounds
+MUTABLE_PARAMS = ('A', 'F', 'D', 'S', 'VW', 'P_H_U')
+
+
+def _run_scenarios(input_dir, bundle, solver, solver_options, scenarios, keep_solutions):
+    # Build once in this process and solve each scenario of the chunk in order, warm starting from the last
+    sweep = scenario_sweep(input_dir, bundle, solver, solver_options)
+    return sweep.solve_all(scenarios, keep_solutions)
+
+
+class scenario_sweep:
+    """
+    Solve the charger siting LP for many scenarios that differ only in demand and cost assumptions.
+
+    The matrix is built once by sparse_linear_program. Each scenario then recomputes the objective and row
+    bounds from its parameters and pushes only the coefficients that changed since the previous scenario, so
+    a persistent solver keeps its model and starts from the previous solution. With 'highs' the persistent
+    HiGHS instance (and its basis) lives across scenarios; 'glpk' and 'cbc' re-solve the same mutable model,
+    warm started from the previous values when the solver supports it. Without highspy, 'highs' re-solves the
+    built matrix through scipy.optimize.milp, which has no warm start but still skips the rebuild.
+
+    A scenario is a dict keyed by parameter name, each value either a number scaling the base parameter or a
+    frame of index columns followed by a value column, as in the csv inputs, overriding those entries of the
+    base parameter. The key 'T' restricts the scenario to a time window, a list of hours outside of which the
+    demand is zero.
+
+    Attributes
+    ----------
+    lp : sparse_linear_program
+        Built matrix of the base inputs
+    base_params : dict
+        Parameters of the base inputs, as (codes, values) pairs
+    model : pyomo.environ.ConcreteModel
+        Model with mutable objective coefficients and FirstConstraint bounds, None when solving the matrix
+    backend : solver_backend
+        Solver of the scenarios, configured with the solver_options controls
+    """
+
+    def __init__(self, input_dir=INPUT_DIR, bundle=None, solver='highs', solver_options=None):
+        self.input_dir = input_dir
+        self.bundle = bundle if bundle is None or isinstance(bundle, str) else bundle.path
+        self.solver = solver
+        self.solver_options = solver_options or {}
+
+        # Build the matrix once
+        start = time.perf_counter()
+        self.lp = sparse_linear_program(input_dir, self.bundle)
+        self.lp.load()
+        self.lp.build()
+        self.base_params = dict(self.lp.params)
+
+        self.backend = solver_backend(solver, **self.solver_options)
+        self.model = self.lp.to_pyomo(mutable=True) if self.backend.available() else None
+
+        self.build_seconds = time.perf_counter() - start
+        self._n_first = len(self.lp.sets['B']) * len(self.lp.sets['T'])
+        self._solved = False
+
+    def scenario_params(self, scenario):
+        """
+        Parameters of a scenario, the base parameters with the scenario's scalings and overrides applied
+        """
+
+        params = dict(self.base_params)
+
+        for name, change in scenario.items():
+            if name == 'T':
+                continue
+            if name not in MUTABLE_PARAMS:
+                raise ValueError(f"Parameter {name} changes the constraint matrix and cannot be swept, "
+                                 f"expected one of {MUTABLE_PARAMS}")
+
+            codes, values = self.base_params[name]
+            if isinstance(change, Number):
+                params[name] = (codes, np.asarray(values) * change)
+                continue
+
+            # Override the listed entries on a dense copy of the base parameter
+            index = PARAM_FILES[name][1]
+            new_codes, new_values = self.lp._encode(change.iloc[:, :len(index)], change.iloc[:, -1].values, index)
+            dense = np.zeros(tuple(len(self.lp.sets[s]) for s in index))
+            dense[tuple(codes)] = values
+            dense[tuple(new_codes)] = new_values
+            params[name] = (list(np.nonzero(dense)), dense[np.nonzero(dense)])
+
+        if 'T' in scenario:
+            # Zero the demand outside the time window
+            codes, values = params['A']
+            in_window = np.isin(codes[1], self.lp.sets['T'].get_indexer(pd.Index(scenario['T'])))
+            params['A'] = ([code[in_window] for code in codes], np.asarray(values)[in_window])
+
+        return params
+
+    def update(self, scenario):
+        """
+        Set the objective coefficients and FirstConstraint bounds of a scenario, changing only those that
+        differ from the current ones
+
+        returns
+        ---------
+        changed:int - number of coefficients and bounds that changed
+        """
+
+        self.lp.params = self.scenario_params(scenario)
+        c = self.lp.objective()
+        row_lower, row_upper = self.lp.row_bounds()
+
+        changed_c = np.flatnonzero(c != self.lp.c)
+        changed_rows = np.flatnonzero(row_lower[:self._n_first] != self.lp.row_lower[:self._n_first])
+
+        if self.model is not None:
+            for j in changed_c:
+                self.model.c[int(j)] = float(c[j])
+            for i in changed_rows:
+                self.model.rhs[int(i)] = float(row_lower[i])
+
+        self.lp.c, self.lp.row_lower, self.lp.row_upper = c, row_lower, row_upper
+
+        return len(changed_c) + len(changed_rows)
+
+    def solve(self):
+        """
+        Re-solve the current scenario, warm started from the previous solution where the solver allows it
+
+        returns
+        ---------
+        solution:dict - objective value and one array per variable, plus the solver status. A scenario that is not
+                        solved to optimality has a NaN objective and no arrays
+        """
+
+        if self.model is None:
+            z, record = self.backend.solve_matrix(self.lp)
+        else:
+            record = self.backend.solve(self.model, warmstart=self._solved)
+            z = None
+            if record['status'] == OPTIMAL:
+                z = np.array([self.model.z[j].value or 0.0 for j in range(self.lp.A.shape[1])], dtype=np.float64)
+
+        if record['status'] == OPTIMAL:
+            solution = self.lp.split_solution(z, record['objective'])
+            self._solved = True
+        else:
+            solution = {'objective': np.nan}
+        solution['status'] = record['status']
+        solution['presolve_seconds'] = record['presolve_seconds']
+
+        return solution
+
+    def solve_all(self, scenarios, keep_solutions=False):
+        """
+        Update and solve each scenario of a dict of scenario name to scenario in order
+
+        returns
+        ---------
+        rows:list - one record per scenario with its timings, number of changed coefficients, objective and status,
+                    the objective NaN where the scenario was not solved to optimality
+        """
+
+        rows = []
+        for position, (name, scenario) in enumerate(scenarios.items()):
+            start = time.perf_counter()
+            changed = self.update(scenario)
+            update_seconds = time.perf_counter() - start
+
+            start = time.perf_counter()
+            solution = self.solve()
+            solve_seconds = time.perf_counter() - start
+
+            row = {'scenario': name,
+                   'build_seconds': self.build_seconds if position == 0 else 0.0,
+                   'update_seconds': update_seconds,
+                   'presolve_seconds': solution['presolve_seconds'],
+                   'solve_seconds': solve_seconds,
+                   'changed': changed,
+                   'objective': solution['objective'],
+                   'status': solution['status']}
+            if keep_solutions:
+                row['solution'] = solution
+            rows.append(row)
+
+        return rows
+
+    @classmethod
+    def run(cls, scenarios, input_dir=INPUT_DIR, bundle=None, solver='highs', solver_options=None,
+            workers=1, keep_solutions=False):
+        """
+        Solve a dict of scenario name to scenario, splitting the scenarios into one contiguous chunk per worker
+        process. Each worker builds the model once and warm starts every scenario of its chunk from the
+        previous one, so similar scenarios should be adjacent.
+
+        returns
+        ---------
+        results:pd.DataFrame - one row per scenario, indexed by scenario name, with the build, update and
+                               (pre)solve seconds, number of changed coefficients, objective value, solver status and
+                               the worker that solved it (and the solution dict if keep_solutions)
+        """
+
+        bundle = bundle if bundle is None or isinstance(bundle, str) else bundle.path
+        names = list(scenarios)
+        chunks = [[names[i] for i in chunk] for chunk in np.array_split(np.arange(len(names)), max(workers, 1))
+                  if len(chunk)]
+
+        if workers > 1:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                futures = [executor.submit(_run_scenarios, input_dir, bundle, solver, solver_options,
+                                           {name: scenarios[name] for name in chunk}, keep_solutions)
+                           for chunk in chunks]
+                chunk_rows = [future.result() for future in futures]
+        else:
+            chunk_rows = [_run_scenarios(input_dir, bundle, solver, solver_options, scenarios, keep_solutions)]
+
+        rows = []
+        for worker, chunk in enumerate(chunk_rows):
+            for row in chunk:
+                row['worker'] = worker
+                rows.append(row)
+
+        return pd.DataFrame(rows).set_index('scenario')
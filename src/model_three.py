@@ -1,7 +1,9 @@
 from __future__ import division
 from pyomo.environ import *
+import json
 import numpy as np
 import pandas as pd
+from src.lp_solvers import solver_backend, require_optimal
 
 # Create a model
 model = AbstractModel()
@@ -87,9 +89,9 @@ model.SecondConstraint = Constraint(model.B, model.K, model.T, rule=second_const
 # Create model instance
 instance = model.create_instance(data)
 
-# Solve the LP
-solver = pyomo.opt.SolverFactory('glpk')
-results = solver.solve(instance, tee=True, keepfiles=True)
+# Solve the LP, the solver log goes to a file and the timings to the record
+record = solver_backend('glpk').solve(instance)
+require_optimal(record)
 
 # Write out results
 ind_x = list(instance.x)
@@ -112,4 +114,8 @@ result_f = [i + tuple([j]) for i, j in zip(ind_f, val_f)]
 pd.DataFrame(np.array(result_x)).to_csv('../data/interim/lp_data/output_data/x.csv', index=False)
 pd.DataFrame(np.array(result_v)).to_csv('../data/interim/lp_data/output_data/v.csv', index=False)
 pd.DataFrame(np.array(result_y)).to_csv('../data/interim/lp_data/output_data/y.csv', index=False)
-pd.DataFrame(np.array(result_f)).to_csv('../data/interim/lp_data/output_data/f.csv', index=False)
\ No newline at end of file
+pd.DataFrame(np.array(result_f)).to_csv('../data/interim/lp_data/output_data/f.csv', index=False)
+
+# Write the solve record next to the results
+with open('../data/interim/lp_data/output_data/record.json', 'w') as f:
+    json.dump(record, f, indent=2, default=float)
@@ -1,45 +1,126 @@
+import json
 import numpy as np
 import pandas as pd
 from sklearn.linear_model import LinearRegression
 from sklearn.model_selection import train_test_split
 from geojson.feature import *
+from src import datasets
+
+# Fitted parameters of Linear_Kwh_Model
+KWH_MODEL_PARAMS = '../data/interim/kwh_model_params.json'
 
 
 class Random_Sample_Charge_Location_Model:
+    """
+    Samples the start_soc of the next charge from the empirical distribution of observed charging events,
+    and converts it to the miles a vehicle drives before charging.
 
-    def __init__(self):
-        self.ev_charging_events = pd.read_csv('../data/raw/charges_derived_joined_charger.csv')
+    The observed start_soc values are sorted once, so the sorted array is the empirical CDF. Only samples the
+    vehicle can reach on its current charge (start_soc >= 100 - state_of_charge) are feasible; they form the
+    upper tail of the sorted array, found by binary search and drawn from uniformly. This is the same
+    distribution as redrawing until a sample fits, without the retries.
 
-    def run(self, vehicle):
+    The sorted array is a read-only memory map from the dataset registry, shared with other models and
+    processes, and is not pickled with the model.
+    """
+
+    def __init__(self, registry=None):
+        self.registry = registry or datasets.registry
+
+        # Empirical distribution of start_soc, as a sorted array
+        self.start_soc = self.registry.sorted_column('charging_events', 'start_soc')
+
+    def __getstate__(self):
+        return {'registry': self.registry}
+
+    def __setstate__(self, state):
+        self.__init__(state['registry'])
+
+    def sample_start_soc(self, state_of_charge, rng=None):
+        """
+        Draw one start_soc per input state of charge, conditional on it being reachable on that charge
+
+        Parameters
+        ----------
+        state_of_charge: np.ndarray
+            State of charge of each vehicle
+        rng: np.random.Generator
+            Random generator to draw from, defaults to the global numpy state
+        """
+
+        rng = np.random if rng is None else rng
+        state_of_charge = np.asarray(state_of_charge, dtype=np.float64)
 
-        # Calculate start_soc probabilities
-        self.ev_charging_events['start_soc_prob'] = self.ev_charging_events.start_soc / self.ev_charging_events.start_soc.sum()
+        # First feasible sample in the sorted distribution
+        lowest = np.searchsorted(self.start_soc, 100 - state_of_charge, side='left')
 
-        # Randomly sample from that distribution
-        start_soc = np.random.choice(self.ev_charging_events.start_soc, 1,
-                                     p=list(self.ev_charging_events['start_soc_prob']).reverse())[0]
+        # Inverse CDF on the truncated range
+        feasible = len(self.start_soc) - lowest
+        index = lowest + np.floor(rng.random(len(state_of_charge)) * feasible).astype(np.int64)
+        start_soc = self.start_soc[np.minimum(index, len(self.start_soc) - 1)]
+
+        # If no observed charge is reachable, the vehicle charges when its battery is empty
+        return np.where(feasible > 0, start_soc, 100 - state_of_charge)
+
+    def run(self, vehicle, rng=None):
+
+        # Sample a start_soc the vehicle can reach
+        start_soc = self.sample_start_soc([vehicle.state_of_charge], rng)[0]
 
         # The number of miles needed to get to the next charge
         miles_to_next_charge = ((100 - start_soc) / 100) * vehicle.range
 
-        # The number of miles on the vehicle
-        miles_on_vehicle = vehicle.range * (vehicle.state_of_charge / 100)
+        return miles_to_next_charge
 
-        while miles_to_next_charge > miles_on_vehicle:
-            miles_to_next_charge = self.run(vehicle)
+    def run_batch(self, state_of_charge, vehicle_range, rng=None):
+        """
+        Sample the miles to the next charge for many vehicles at once
 
-        return miles_to_next_charge
+        Parameters
+        ----------
+        state_of_charge: np.ndarray
+            State of charge of each vehicle
+        vehicle_range: np.ndarray
+            Range in miles of each vehicle on full battery
+        rng: np.random.Generator
+            Random generator to draw from, defaults to the global numpy state
+        """
+
+        start_soc = self.sample_start_soc(state_of_charge, rng)
+
+        return ((100 - start_soc) / 100) * vehicle_range
 
 
 class Linear_Kwh_Model:
+    """
+    Predicts the delta_soc of a charge linearly from its start_soc, and converts it to kWh.
 
-    def __init__(self):
-        self.ev_charging_events = pd.read_csv('../data/raw/charges_derived_joined_charger.csv')
+    The fitted coefficient and intercept are kept as floats and applied with NumPy, so prediction needs no
+    sklearn call. They can be saved to a small JSON file after training and loaded in place of training.
+    Training reads the start_soc and delta_soc columns from the dataset registry.
+    """
+
+    def __init__(self, params_path=None, registry=None):
+        self.registry = registry or datasets.registry
         self.model = None
+        self.coefficient = None
+        self.intercept = None
+
+        if params_path is not None:
+            self.load_params(params_path)
 
-    def train(self):
-        x, y = np.array(self.ev_charging_events.start_soc).reshape((-1, 1)), np.array(
-            self.ev_charging_events.delta_soc).reshape((-1, 1))
+    def __getstate__(self):
+        # The fitted parameters are all a prediction needs
+        return {'registry': self.registry, 'coefficient': self.coefficient, 'intercept': self.intercept}
+
+    def __setstate__(self, state):
+        self.__init__(registry=state['registry'])
+        self.coefficient = state['coefficient']
+        self.intercept = state['intercept']
+
+    def train(self, params_path=None):
+        x = np.array(self.registry.column('charging_events', 'start_soc'), dtype=np.float64).reshape((-1, 1))
+        y = np.array(self.registry.column('charging_events', 'delta_soc'), dtype=np.float64).reshape((-1, 1))
 
         # Split features to train/test on
         x_train, x_test, y_train, y_test = train_test_split(x, y, test_size=0.33, random_state=42)
@@ -51,18 +132,72 @@ class Linear_Kwh_Model:
         model.fit(x_train, y_train)
 
         self.model = model
+        self.coefficient = float(np.ravel(model.coef_)[0])
+        self.intercept = float(np.ravel(model.intercept_)[0])
+
+        if params_path is not None:
+            self.save_params(params_path)
+
+    def save_params(self, path=KWH_MODEL_PARAMS):
+        """
+        Write the fitted coefficient and intercept to a JSON file
+        """
+
+        with open(path, 'w') as f:
+            json.dump({'coefficient': self.coefficient, 'intercept': self.intercept}, f)
+
+    def load_params(self, path=KWH_MODEL_PARAMS):
+        """
+        Read the coefficient and intercept written by save_params, in place of training
+        """
+
+        with open(path) as f:
+            params = json.load(f)
+
+        self.coefficient = float(params['coefficient'])
+        self.intercept = float(params['intercept'])
+
+    def predict_batch(self, state_of_charge):
+        """
+        Predict the delta_soc of a charge for many vehicles at once, capped at what fills each battery
+
+        Parameters
+        ----------
+        state_of_charge: np.ndarray
+            State of charge of each vehicle
+        """
+
+        state_of_charge = np.asarray(state_of_charge, dtype=np.float64)
+
+        # Predict Delta_SOC
+        delta_soc_predicted = self.coefficient * state_of_charge + self.intercept
+
+        # If the Delta_SOC predicted is too much for the empty battery capacity, fill the battery
+        return np.minimum(delta_soc_predicted, 100 - state_of_charge)
 
     def run(self, vehicle):
 
         # Predict Delta_SOC
+        delta_soc_predicted = self.predict_batch([vehicle.state_of_charge])[0]
+
+        # kwh prediction
+        energy = (delta_soc_predicted / 100) * vehicle.battery_capacity
+
+        return energy
 
-        delta_soc_predicted = self.model.predict(np.array(vehicle.state_of_charge).reshape(-1, 1))
+    def run_batch(self, state_of_charge, battery_capacity):
+        """
+        Predict the kWh charged for many vehicles at once
 
-        # If the Delta_SOC predicted is too much for the empty battery capacity, re-predict
-        if delta_soc_predicted >= (100 - vehicle.state_of_charge):
-            delta_soc_predicted = [[100 - vehicle.state_of_charge]]
+        Parameters
+        ----------
+        state_of_charge: np.ndarray
+            State of charge of each vehicle
+        battery_capacity: np.ndarray
+            Battery capacity of each vehicle in kWh
+        """
 
         # kwh prediction
-        energy = (delta_soc_predicted[0][0] / 100) * vehicle.battery_capacity
+        energy = (self.predict_batch(state_of_charge) / 100) * battery_capacity
 
-        return energy
\ No newline at end of file
+        return energy
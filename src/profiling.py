@@ -0,0 +1,225 @@
+import cProfile
+import io
+import json
+import os
+import pstats
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+import numpy as np
+import pandas as pd
+
+# Default directory of the cProfile dumps of the profiled stages
+PROFILE_DIR = os.path.join(tempfile.gettempdir(), 'run_profiles')
+
+
+def _rss_bytes():
+    # Resident memory of this process, from /proc where available and the peak so far elsewhere
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _json_default(value):
+    # numpy scalars as python numbers, anything else as its string
+    return value.item() if isinstance(value, np.generic) else str(value)
+
+
+class _MemorySampler:
+    # Background thread sampling the resident memory of the process, keeping the peak
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.start_bytes = self.peak_bytes = _rss_bytes()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            self.peak_bytes = max(self.peak_bytes, _rss_bytes())
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.peak_bytes = max(self.peak_bytes, _rss_bytes())
+
+
+class RunProfiler:
+    """
+    Instrumentation of a pipeline run: wall and CPU time, counters and peak resident memory of each stage, an
+    opt-in cProfile of selected stages and the simulation time of each vehicle. Stages nest, and the run is
+    reported as JSON and CSV.
+
+    A disabled profiler records nothing, so it can be passed through the pipeline at no cost. Memory is that of
+    the current process, sampled in a background thread, so worker processes are not included.
+
+    Parameters
+    ____________
+    enabled : bool
+        Whether stages are recorded
+    profile_stages : tuple
+        Names of the stages run under cProfile
+    profile_dir : str
+        Directory of the .prof dumps of the profiled stages
+    memory_interval : float
+        Seconds between memory samples, None to not sample memory
+    """
+
+    def __init__(self, enabled=True, profile_stages=(), profile_dir=PROFILE_DIR, memory_interval=0.01):
+        self.enabled = enabled
+        self.profile_stages = set(profile_stages)
+        self.profile_dir = profile_dir
+        self.memory_interval = memory_interval
+        self.stages = []
+        self.vehicles = []
+        self._stack = []
+
+    @contextmanager
+    def stage(self, name, **counters):
+        """
+        Context manager recording a stage of the run, with optional initial counters
+
+        ex. with profiler.stage('binning', events=len(events)):
+        """
+
+        if not self.enabled:
+            yield None
+            return
+
+        record = {'stage': name, 'parent': self._stack[-1]['stage'] if self._stack else None,
+                  'counters': dict(counters)}
+        self.stages.append(record)
+        self._stack.append(record)
+
+        sampler = _MemorySampler(self.memory_interval) if self.memory_interval else None
+        profile = cProfile.Profile() if name in self.profile_stages else None
+        wall, cpu = time.perf_counter(), time.process_time()
+        if profile is not None:
+            profile.enable()
+
+        try:
+            yield record
+        finally:
+            if profile is not None:
+                profile.disable()
+            record['wall_seconds'] = time.perf_counter() - wall
+            record['cpu_seconds'] = time.process_time() - cpu
+
+            if sampler is not None:
+                sampler.stop()
+                record['start_memory_mb'] = sampler.start_bytes / 2 ** 20
+                record['peak_memory_mb'] = sampler.peak_bytes / 2 ** 20
+
+            if profile is not None:
+                record['profile'] = self._write_profile(name, profile)
+
+            self._stack.pop()
+
+    def _write_profile(self, name, profile):
+        # Dump the profile for pstats or snakeviz, and keep the top functions by cumulative time in the report
+        os.makedirs(self.profile_dir, exist_ok=True)
+        path = os.path.join(self.profile_dir, f'{name}_{time.time_ns()}.prof')
+        profile.dump_stats(path)
+
+        summary = io.StringIO()
+        pstats.Stats(profile, stream=summary).sort_stats('cumulative').print_stats(20)
+
+        return {'path': path, 'top': summary.getvalue()}
+
+    def count(self, **counters):
+        """
+        Add counters to the current stage, ex. profiler.count(hexes=1200, nonzeros=5000)
+        """
+
+        if self.enabled and self._stack:
+            self._stack[-1]['counters'].update({name: int(value) if isinstance(value, (int, np.integer))
+                                                else value for name, value in counters.items()})
+
+    def record_vehicles(self, vehicle_ids, seconds, events=None):
+        """
+        Record the simulation time of each vehicle, and optionally its number of charging events
+        """
+
+        if not self.enabled:
+            return
+
+        events = np.full(len(vehicle_ids), -1) if events is None else np.asarray(events)
+        stage = self._stack[-1]['stage'] if self._stack else None
+        self.vehicles.extend(zip([stage] * len(vehicle_ids), vehicle_ids, np.asarray(seconds, dtype=np.float64),
+                                 events.astype(np.int64)))
+
+    def vehicle_timings(self):
+        """
+        Simulation time of each vehicle, slowest first
+
+        returns
+        ---------
+        df:pd.DataFrame - columns ['stage','vehicle_id','seconds','events']
+        """
+
+        df = pd.DataFrame(self.vehicles, columns=['stage', 'vehicle_id', 'seconds', 'events'])
+        return df.sort_values('seconds', ascending=False, kind='mergesort').reset_index(drop=True)
+
+    def vehicle_histogram(self, bins=20):
+        """
+        Histogram of the vehicle simulation times over log spaced bins, so slow outliers stand out
+
+        returns
+        ---------
+        df:pd.DataFrame - columns ['lower_seconds','upper_seconds','vehicles']
+        """
+
+        seconds = np.array([vehicle[2] for vehicle in self.vehicles], dtype=np.float64)
+        seconds = seconds[seconds > 0]
+        if not len(seconds):
+            return pd.DataFrame(columns=['lower_seconds', 'upper_seconds', 'vehicles'])
+
+        edges = np.geomspace(seconds.min(), seconds.max(), bins + 1) if seconds.max() > seconds.min() \
+            else np.array([seconds.min(), seconds.max()])
+        counts, edges = np.histogram(seconds, bins=edges)
+
+        return pd.DataFrame({'lower_seconds': edges[:-1], 'upper_seconds': edges[1:], 'vehicles': counts})
+
+    def to_frame(self):
+        """
+        One row per stage, with a column per counter
+        """
+
+        rows = [{key: value for key, value in stage.items() if key not in ('counters', 'profile')}
+                for stage in self.stages]
+        counters = pd.DataFrame([stage['counters'] for stage in self.stages], index=range(len(self.stages)))
+
+        return pd.concat([pd.DataFrame(rows), counters], axis=1)
+
+    def report(self, slowest=10):
+        """
+        Structured report of the run: the stages, and a summary of the vehicle timings with the slowest vehicles
+        and the histogram
+        """
+
+        vehicles = self.vehicle_timings()
+        summary = {}
+        if len(vehicles):
+            summary = {'vehicles': int(len(vehicles)), 'total_seconds': float(vehicles['seconds'].sum()),
+                       'median_seconds': float(vehicles['seconds'].median()),
+                       'p99_seconds': float(vehicles['seconds'].quantile(0.99)),
+                       'slowest': vehicles.head(slowest).to_dict('records'),
+                       'histogram': self.vehicle_histogram().to_dict('records')}
+
+        return {'stages': self.stages, 'vehicles': summary}
+
+    def write(self, path):
+        """
+        Write the run report to a directory: report.json, stages.csv and vehicles.csv
+        """
+
+        os.makedirs(path, exist_ok=True)
+        with open(os.path.join(path, 'report.json'), 'w') as f:
+            json.dump(self.report(), f, indent=2, default=_json_default)
+        self.to_frame().to_csv(os.path.join(path, 'stages.csv'), index=False)
+        self.vehicle_timings().to_csv(os.path.join(path, 'vehicles.csv'), index=False)
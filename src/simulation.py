@@ -1,10 +1,16 @@
 # Regular Imports
 from fiona.crs import from_epsg
 from geojson.feature import *
+import hashlib
+import time
+import numpy as np
 import pandas as pd
-from src.grid import HexGrid
-import geopandas as gpd
+from concurrent.futures import ProcessPoolExecutor
+from src.grid import HexGrid, DemandPyramid
+from src.components import ChargingEventSink, TrajectoryStore
+from src.lp_bundle import InputBundle, BUNDLE_DIR
 from src.general_utils import generate_hourly_charges
+from src.profiling import RunProfiler
 
 
 class VehicleSimulation:
@@ -22,38 +28,103 @@ class VehicleSimulation:
         The EV charging event data set used for random sampling and prediction
     vehicles : list
         List of vehicle objects for prediction of charging
+    charging_events : ChargingEventSink
+        Sink the charging events are recorded into, may be shared across vehicle simulations
 
     """
 
-    def __init__(self, charge_location_model, charge_amount_model):
+    def __init__(self, charge_location_model, charge_amount_model, charging_events=None):
         self.charge_location_model = charge_location_model
         self.charge_amount_model = charge_amount_model
-        self.charging_events = pd.DataFrame()
+        self.charging_events = ChargingEventSink() if charging_events is None else charging_events
 
-    def predict_charge_location(self, vehicle):
-        miles_to_next_charge = self.charge_location_model.run(vehicle)
+    def predict_charge_location(self, vehicle, rng=None):
+        miles_to_next_charge = self.charge_location_model.run(vehicle, rng=rng)
         return miles_to_next_charge
 
     def predict_charge_amount(self, vehicle):
         energy = self.charge_amount_model.run(vehicle)
         return energy
 
-    def run(self, vehicle):
+    def run(self, vehicle, rng=None):
         # While the vehicle is not at its maximum odometer reading
         while vehicle.odometer_reading < vehicle.max_odo:
             # Run charge location model and move vehicle forwards
-            miles_to_next_charge = self.predict_charge_location(vehicle)
+            miles_to_next_charge = self.predict_charge_location(vehicle, rng)
             vehicle.drive(miles_to_next_charge)
 
-            # Run charge amount model and move vehicle forwards
+            # Run charge amount model and charge the vehicle
             energy = self.predict_charge_amount(vehicle)
-            vehicle.charge(energy)
+            charging_event = vehicle.charge(energy)
 
             # Add charging event to charging events
-            self.charging_events = self.charging_events.append(
-                gpd.GeoDataFrame(vehicle.charging_events, geometry=gpd.points_from_xy(vehicle.charging_events.latitude,
-                                                                                      vehicle.charging_events.longitude),
-                                 crs=from_epsg(4326)))
+            self.charging_events.append(vehicle.identifier, *charging_event)
+
+
+# Models of the current worker process, shipped once per process by _init_worker
+_worker_models = {}
+
+
+def _init_worker(charge_location_model, charge_amount_model):
+    _worker_models['charge_location_model'] = charge_location_model
+    _worker_models['charge_amount_model'] = charge_amount_model
+
+
+def _simulate_vehicles(vehicles, seed_sequences, charge_location_model=None, charge_amount_model=None):
+    """
+    Simulate a chunk of vehicles in order, each drawing from its own random generator, into a new event sink.
+    Returns the sink and the seconds each vehicle took
+    """
+
+    charge_location_model = charge_location_model or _worker_models['charge_location_model']
+    charge_amount_model = charge_amount_model or _worker_models['charge_amount_model']
+
+    charging_events = ChargingEventSink()
+    vehicle_sim = VehicleSimulation(charge_location_model, charge_amount_model, charging_events)
+    seconds = np.empty(len(vehicles))
+
+    for i, (vehicle, seed_sequence) in enumerate(zip(vehicles, seed_sequences)):
+        start = time.perf_counter()
+        rng = None if seed_sequence is None else np.random.default_rng(seed_sequence)
+        vehicle_sim.run(vehicle, rng)
+        seconds[i] = time.perf_counter() - start
+
+    return charging_events, seconds
+
+
+def vehicle_seed_sequence(seed, identifier):
+    """
+    SeedSequence of a vehicle's random stream, from the simulation seed and a stable hash of the vehicle's
+    identifier, as python's hash of a string changes between processes
+    """
+
+    key = int.from_bytes(hashlib.sha256(str(identifier).encode()).digest()[:16], 'little')
+    return np.random.SeedSequence([seed, key])
+
+
+def write_demand(grid, bundle_path=BUNDLE_DIR):
+    """
+    Write the energy joined to a HexGrid into an LP input bundle as the demand parameter A, with the geometry
+    lookup of the demand nodes
+
+    parameters
+    ---------
+    grid:HexGrid - grid with an 'energy' demand matrix
+    bundle_path:str - LP input bundle of the scenario
+    """
+
+    # Retrieve the nonzero hexbinned results, ordered by hour
+    lp_input = grid.to_frame(nonzero=True, geometry=False)
+
+    # Rename output for linear program
+    lp_input = lp_input.rename(columns={'hex_id': 'B', 'hour': 'T', 'energy': 'A'})
+
+    # Write the nonzero demand straight into the scenario's LP input bundle, adding its nodes and hours to the sets
+    bundle = InputBundle(bundle_path)
+    bundle.write_param_frame('A', lp_input[['B', 'T', 'A']], extend_sets=True)
+
+    # Write the geometry lookup of the demand nodes
+    bundle.write_geometry(grid.geometry_lookup(lp_input['B'].unique()))
 
 
 class Simulation:
@@ -71,39 +142,160 @@ class Simulation:
         The EV charging event data set used for random sampling and prediction
     vehicles : list
         List of vehicle objects for prediction of charging
+    seed : int
+        Seed of the simulation; each vehicle draws from its own generator, seeded from the seed and the vehicle's
+        identifier, so a vehicle's events depend neither on the number of workers nor on the other vehicles run
+        with it. If None, vehicles draw from the global numpy state when run in a single process
+    workers : int
+        Number of processes to shard the vehicles across, 1 runs in the current process
+    chunk_size : int
+        Number of vehicles sent to a worker per task
+    resolution : int
+        H3 resolution the charging events are binned at, the finest level of the demand pyramid
+    min_resolution : int
+        Coarsest level of the demand pyramid, resolution if None
+    profiler : RunProfiler
+        Records the stages of run and the time of each vehicle, none are recorded if None
 
     """
 
-    def __init__(self, vehicles, charge_location_model, charge_amount_model):
+    def __init__(self, vehicles, charge_location_model, charge_amount_model, seed=None, workers=1, chunk_size=16,
+                 resolution=8, min_resolution=None, profiler=None):
         self.charge_location_model = charge_location_model
         self.charge_amount_model = charge_amount_model
         self.vehicles = vehicles
+        self.seed = seed
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.resolution = resolution
+        self.min_resolution = min_resolution
+        self.profiler = profiler if profiler is not None else RunProfiler(enabled=False)
         self.charging_events = pd.DataFrame()
+        self.pyramid = None
         self.grid = None
 
-    def run(self):
+    def simulate(self, vehicles=None):
+        """
+        Simulate the charging events of every vehicle, or of the input vehicles, and return them as a GeoDataFrame
+        """
+
+        vehicles = self.vehicles if vehicles is None else vehicles
+
+        # Parallel runs are always seeded, so that they can be reproduced
+        if self.seed is None and self.workers > 1:
+            self.seed = np.random.SeedSequence().entropy
+
+        # One random stream per vehicle, keyed by its identifier
+        if self.seed is None:
+            seed_sequences = [None] * len(vehicles)
+        else:
+            seed_sequences = [vehicle_seed_sequence(self.seed, vehicle.identifier) for vehicle in vehicles]
+
+        if self.workers > 1:
+            # Shard the vehicles across worker processes, the models are sent once per worker
+            chunks = range(0, len(vehicles), self.chunk_size)
+            with ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker,
+                                     initargs=(self.charge_location_model, self.charge_amount_model)) as executor:
+                results = executor.map(_simulate_vehicles,
+                                       [vehicles[i:i + self.chunk_size] for i in chunks],
+                                       [seed_sequences[i:i + self.chunk_size] for i in chunks])
+
+                # Merge in vehicle order
+                charging_events = ChargingEventSink()
+                seconds = []
+                for chunk_events, chunk_seconds in results:
+                    charging_events.extend(chunk_events)
+                    seconds.append(chunk_seconds)
+                seconds = np.concatenate(seconds) if seconds else np.empty(0)
 
-        all_charging_events = pd.DataFrame()
+        else:
+            # Run the simulation for each vehicle, recording into a single event sink
+            charging_events, seconds = _simulate_vehicles(vehicles, seed_sequences, self.charge_location_model,
+                                                          self.charge_amount_model)
 
-        # Run the simulation for each vehicle
-        for vehicle in self.vehicles:
-            # Create a vehicle simulation and run it
-            vehicle_sim = VehicleSimulation(self.charge_location_model, self.charge_amount_model)
-            vehicle_sim.run(vehicle)
+        # Convert the recorded events to a GeoDataFrame once
+        events = charging_events.to_frame()
 
-            # Append charging events to class attribute
-            all_charging_events = all_charging_events.append(vehicle_sim.charging_events)
+        if self.profiler.enabled:
+            vehicle_ids = [vehicle.identifier for vehicle in vehicles]
+            counts = events['vehicle_id'].value_counts().reindex(vehicle_ids, fill_value=0).values
+            self.profiler.record_vehicles(vehicle_ids, seconds, counts)
+
+        return events
+
+    def run(self):
+        profiler = self.profiler
+
+        with profiler.stage('simulate', vehicles=len(self.vehicles)):
+            all_charging_events = self.simulate()
+            profiler.count(events=len(all_charging_events))
 
         # Generate hourly charges and save the result for the LP
-        self.charging_events = generate_hourly_charges(all_charging_events)
+        with profiler.stage('hourly_charges'):
+            self.charging_events = generate_hourly_charges(all_charging_events)
+            profiler.count(hourly_charges=len(self.charging_events))
 
-        # Create a grid object, join results to the grid, and save the grid
-        grid = HexGrid(resolution=8)
-        grid.join(self.charging_events, groupby_items=['hex_id', 'hour'], agg_map={'energy': 'sum'}, resolution=8)
-        self.grid = grid
+        # Bin the hourly charges once into the demand pyramid, and grid them at the simulation's resolution
+        with profiler.stage('binning', resolution=self.resolution):
+            self.pyramid = DemandPyramid(self.resolution, self.min_resolution)
+            self.pyramid.join(self.charging_events, agg_map={'energy': 'sum'})
+            self.set_resolution(self.resolution)
+            profiler.count(hexes=len(self.pyramid.level(self.resolution)[0]), grid_hexes=len(self.grid.hex_grid),
+                           nonzeros=self.grid.demand['energy'].nnz)
 
         # Save the result
-        self.save_result()
+        with profiler.stage('save_result'):
+            self.save_result()
+
+    def run_incremental(self, accumulator, day, replace=False, bundle_path=BUNDLE_DIR):
+        """
+        Simulate only the vehicles not yet ingested for the day, add their hourly charges to a DemandAccumulator
+        and refresh the grid and the LP demand from its totals, so the cost follows the new data rather than the
+        history. Vehicles already ingested for the day are skipped unless replace
+
+        parameters
+        ---------
+        accumulator:DemandAccumulator - persisted totals, at the simulation's resolution
+        day:str - label of the telemetry day of the vehicles' trajectories, ex. '2020-01-15'
+        replace:bool - simulate and replace the vehicles already ingested for the day
+        bundle_path:str - LP input bundle the demand is written to
+
+        returns
+        ---------
+        ingested:list - vehicle ids whose contribution was added
+        """
+
+        if accumulator.resolution != self.resolution:
+            raise ValueError(f"The accumulator is at resolution {accumulator.resolution}, the simulation at "
+                             f"{self.resolution}")
+
+        # Simulate the new vehicles only
+        vehicles = [vehicle for vehicle in self.vehicles if replace or (vehicle.identifier, day) not in accumulator]
+        self.charging_events = pd.DataFrame()
+        if vehicles:
+            charging_events = self.simulate(vehicles)
+            if len(charging_events):
+                self.charging_events = generate_hourly_charges(charging_events)
+
+        # Merge them into the totals
+        ingested = accumulator.ingest_frame(self.charging_events, day, [vehicle.identifier for vehicle in vehicles],
+                                            replace=replace)
+        accumulator.save()
+
+        # Refresh the grid and the LP demand from the totals
+        self.pyramid = accumulator.pyramid(self.min_resolution)
+        self.set_resolution(self.resolution)
+        self.save_result(bundle_path)
+
+        return ingested
+
+    def set_resolution(self, resolution):
+        """
+        Grid the demand at another resolution of the pyramid, for the following map and save_result calls
+        """
+
+        self.grid = self.pyramid.fill_grid(HexGrid(resolution=resolution))
+        return self.grid
 
     def map(self, hour=None):
 
@@ -112,13 +304,83 @@ class Simulation:
 
         return hexmap
 
-    def save_result(self):
-        # Retrieve hexbinned results, sort by hour and drop geometry
+    def save_result(self, bundle_path=BUNDLE_DIR):
+        write_demand(self.grid, bundle_path)
+
+
+class FleetSimulation(Simulation):
+    """
+    Simulation that advances every vehicle in lockstep, holding the fleet state in NumPy arrays.
+    Each step draws the miles to the next charge and the kWh charged for all active vehicles in one batched
+    call to the models' run_batch, and vehicles are retired as they reach their maximum odometer reading.
+    Produces the same charging events as Simulation, ordered by vehicle.
+
+    Parameters
+    ____________
+
+    vehicles : list
+        List of vehicle objects for prediction of charging, their state is read but not modified
+    charge_location_model : object
+        Model with run_batch(state_of_charge, vehicle_range, rng) returning miles to the next charge
+    charge_amount_model : object
+        Model with run_batch(state_of_charge, battery_capacity) returning kWh charged
+    interpolate : bool
+        Interpolate position and time between pings, as Vehicle(interpolate=True)
+    seed : int
+        Seed of the fleet's random generator, if None the global numpy state is used
+    resolution, min_resolution : int
+        Finest and coarsest levels of the demand pyramid, as for Simulation
+    profiler : RunProfiler
+        Records the stages of run, as for Simulation. Vehicles advance together, so no vehicle times are recorded
+
+    """
+
+    def __init__(self, vehicles, charge_location_model, charge_amount_model, interpolate=False, seed=None,
+                 resolution=8, min_resolution=None, profiler=None):
+        super().__init__(vehicles, charge_location_model, charge_amount_model, seed=seed, resolution=resolution,
+                         min_resolution=min_resolution, profiler=profiler)
+        self.interpolate = interpolate
+
+    def simulate(self, vehicles=None):
+        vehicles = self.vehicles if vehicles is None else vehicles
+        rng = None if self.seed is None else np.random.default_rng(self.seed)
+        trajectories = TrajectoryStore.from_vehicles(vehicles)
+
+        # Fleet state, one element per vehicle
+        state_of_charge = np.array([vehicle.state_of_charge for vehicle in vehicles], dtype=np.float64)
+        odometer_reading = np.array([vehicle.odometer_reading for vehicle in vehicles], dtype=np.float64)
+        max_odo = np.array([vehicle.max_odo for vehicle in vehicles], dtype=np.float64)
+        vehicle_range = np.array([vehicle.range for vehicle in vehicles], dtype=np.float64)
+        battery_capacity = np.array([vehicle.battery_capacity for vehicle in vehicles], dtype=np.float64)
+
+        charging_events = ChargingEventSink(capacity=max(1024, 4 * len(vehicles)))
+        vehicle_codes = charging_events.register([vehicle.identifier for vehicle in vehicles])
+
+        # Step every vehicle that has not reached its maximum odometer reading
+        active = np.flatnonzero(odometer_reading < max_odo)
+        while active.size:
+            # Run charge location model and move vehicles forwards
+            miles_to_next_charge = self.charge_location_model.run_batch(
+                state_of_charge[active], vehicle_range[active], rng)
+            odometer_reading[active] += miles_to_next_charge
+            state_of_charge[active] -= 100 * (miles_to_next_charge / vehicle_range[active])
+            times, latitudes, longitudes = trajectories.locate(active, odometer_reading[active], self.interpolate)
+
+            # Run charge amount model and charge the vehicles
+            start_soc = state_of_charge[active]
+            energy = self.charge_amount_model.run_batch(start_soc, battery_capacity[active])
+            delta_soc = (energy / battery_capacity[active]) * 100
+
+            # End time of charging event based on duration and power assumptions, to the microsecond
+            duration = np.round((((delta_soc / 100) * 55) / 50) * 3600e6).astype(np.int64) * 1000
+
+            charging_events.append_batch(vehicle_codes[active], latitudes, longitudes, times, times + duration,
+                                         delta_soc, start_soc, energy, tz=trajectories.tz)
+            state_of_charge[active] = start_soc + delta_soc
 
-        lp_input = self.grid.hex_data.sort_values(by='hour')
+            # Retire vehicles that reached their maximum odometer reading
+            active = active[odometer_reading[active] < max_odo[active]]
 
-        # Rename output for linear program
-        lp_input = lp_input.rename(columns={'hex_id': 'B', 'hour': 'T', 'energy': 'A'})
+        charging_events.sort_by_vehicle()
 
-        # Write out the model output
-        lp_input.to_csv('../data/interim/lp_data/input_data/Demand_Model_Output.csv', index=False)
+        return charging_events.to_frame()
@@ -0,0 +1,91 @@
+import itertools
+import numpy as np
+import pandas as pd
+import pytest
+from src.components import TrajectoryArrays, TrajectoryStore
+from src.simulation import Simulation
+
+
+class UniformChargeLocationModel:
+    # Miles to the next charge drawn uniformly, from the vehicle's generator where it has one
+    def run(self, vehicle, rng=None):
+        return (rng if rng is not None else np.random).uniform(20, 80)
+
+
+class FullChargeAmountModel:
+    # kWh to charge the battery back to full
+    def run(self, vehicle):
+        return (100 - vehicle.state_of_charge) / 100 * vehicle.battery_capacity
+
+
+def make_vehicles(vehicles=3, pings=200):
+    """
+    Vehicles of a small synthetic fleet driving across Los Angeles over a day, sharing one TrajectoryStore
+    """
+
+    rng = np.random.default_rng(0)
+    start = pd.Timestamp('2020-01-15', tz='America/Los_Angeles').value
+    trajectories = [TrajectoryArrays(f'vehicle_{i}', np.cumsum(rng.uniform(0, 2, pings)),
+                                     start + np.arange(pings, dtype=np.int64) * 300 * 10 ** 9,
+                                     34.0 + np.cumsum(rng.normal(0, 0.002, pings)),
+                                     -118.3 + np.cumsum(rng.normal(0, 0.002, pings)), 'America/Los_Angeles')
+                    for i in range(vehicles)]
+
+    return TrajectoryStore.from_arrays(trajectories).vehicles()
+
+
+def write_lp_inputs(path, nodes=6, chargers=2, hours=4, seed=0):
+    """
+    Input csv files of a small random instance of the siting LP, in the layout of lp_data/input_data
+    """
+
+    rng = np.random.default_rng(seed)
+    B = [f'88{i:04d}fffff' for i in range(nodes)]
+    K = list(range(1, chargers + 1))
+    T = list(range(1, hours + 1))
+    L = [f'{a}_{b}' for a, b in itertools.permutations(B, 2) if rng.random() < 0.5]
+
+    # Set_List holds one column per set, padded to the longest
+    n = max(len(B), len(K), len(T), len(L))
+    pd.DataFrame({name: pd.Series(members, dtype=object).reindex(range(n))
+                  for name, members in zip('BKTL', (B, K, T, L))}).to_csv(path / 'Set_List.csv', index=False)
+
+    bk = pd.DataFrame(list(itertools.product(B, K)), columns=['B', 'K'])
+    bk.assign(F=rng.integers(300, 400, len(bk))).to_csv(path / 'Fixed_Cost.csv', index=False)
+    bk.assign(D=rng.integers(0, 50, len(bk))).to_csv(path / 'Demand_Charge.csv', index=False)
+    bk.assign(C=10).to_csv(path / 'Plug_in_Limit.csv', index=False)
+    bk.assign(E=rng.integers(0, 3, len(bk))).to_csv(path / 'Existing_Capacity.csv', index=False)
+    bt = pd.DataFrame(list(itertools.product(B, T)), columns=['B', 'T'])
+    bt.assign(A=np.where(rng.random(len(bt)) < 0.5, rng.random(len(bt)) * 100, 0)).to_csv(path / 'Demand.csv',
+                                                                                         index=False)
+    pd.DataFrame({'T': T, 'G': rng.random(hours) * 40 + 10}).to_csv(path / 'Charging_Efficiency.csv', index=False)
+    pd.DataFrame({'K': K, 'N': 50}).to_csv(path / 'Charger_Capacity.csv', index=False)
+    pd.DataFrame({'B': B, 'S': rng.integers(1000, 2000, nodes)}).to_csv(path / 'Site_Develop_Cost.csv', index=False)
+    bkt = pd.DataFrame(list(itertools.product(B, K, T)), columns=['B', 'K', 'T'])
+    bkt.assign(VW=rng.random(len(bkt)) * 5).to_csv(path / 'V_Times_W.csv', index=False)
+    lt = pd.DataFrame(list(itertools.product(L, T)), columns=['L', 'T'])
+    lt.assign(P_H_U=rng.random(len(lt)) * 20 + 5).to_csv(path / 'P_H_U.csv', index=False)
+
+    # Incidence matrix in Pyomo's array format, +1 at a line's origin and -1 at its destination
+    incidence = pd.DataFrame(0, index=pd.Index(B, name='B'), columns=L)
+    for line in L:
+        origin, destination = line.split('_')
+        incidence.loc[origin, line], incidence.loc[destination, line] = 1, -1
+    incidence.to_csv(path / 'Incidence_Matrix.tab', sep=' ')
+
+    return path
+
+
+@pytest.fixture
+def lp_inputs(tmp_path):
+    return str(write_lp_inputs(tmp_path)) + '/'
+
+
+@pytest.fixture
+def simulation():
+    return Simulation(make_vehicles(), UniformChargeLocationModel(), FullChargeAmountModel(), resolution=7)
+
+
+@pytest.fixture
+def fleet():
+    return make_vehicles
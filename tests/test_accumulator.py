@@ -0,0 +1,44 @@
+import numpy as np
+import pandas as pd
+from src.accumulator import DemandAccumulator
+
+
+def hourly_charges(vehicles, seed=0):
+    rng = np.random.default_rng(seed)
+    n = 10 * len(vehicles)
+    return pd.DataFrame({'vehicle_id': np.repeat(vehicles, 10), 'latitude': rng.uniform(33.9, 34.1, n),
+                         'longitude': rng.uniform(-118.4, -118.2, n), 'hour': rng.integers(0, 24, n),
+                         'energy': rng.random(n)})
+
+
+def totals(accumulator):
+    energy = accumulator.energy.tocoo()
+    return pd.Series(energy.data, index=pd.MultiIndex.from_arrays([accumulator.cells.values[energy.row],
+                                                                   energy.col])).sort_index()
+
+
+def test_batched_ingest_matches_vehicle_by_vehicle(tmp_path):
+    charges = hourly_charges(['a', 'b', 'c'])
+
+    batched = DemandAccumulator(str(tmp_path / 'batched'), resolution=7)
+    assert batched.ingest_frame(charges, 'd1', vehicle_ids=['a', 'b', 'c', 'idle']) == ['a', 'b', 'c', 'idle']
+
+    single = DemandAccumulator(str(tmp_path / 'single'), resolution=7)
+    for vehicle_id, events in charges.groupby('vehicle_id'):
+        single.ingest(vehicle_id, 'd1', events)
+
+    pd.testing.assert_series_equal(totals(batched), totals(single))
+    assert ('idle', 'd1') in batched
+
+    # Re-ingesting the day changes nothing, replacing it swaps the contributions in one update
+    assert batched.ingest_frame(charges, 'd1') == []
+    replacement = hourly_charges(['a', 'b', 'c'], seed=1)
+    batched.ingest_frame(replacement, 'd1', replace=True)
+    fresh = DemandAccumulator(str(tmp_path / 'fresh'), resolution=7)
+    fresh.ingest_frame(replacement, 'd1')
+    pd.testing.assert_series_equal(totals(batched), totals(fresh))
+
+    # Retracting everything leaves empty totals
+    for vehicle_id in ('a', 'b', 'c', 'idle'):
+        batched.retract(vehicle_id)
+    assert batched.energy.nnz == 0 and batched.entries() == []
@@ -0,0 +1,114 @@
+import numpy as np
+import pandas as pd
+import pytest
+from src.ensemble import DemandEnsemble, P2Quantile, StreamingMoments, _run_replica
+
+
+def test_replicas_start_from_fresh_vehicles(simulation):
+    odometer = [vehicle.odometer_reading for vehicle in simulation.vehicles]
+
+    # Every replica of the process simulates the whole fleet, not only the first
+    for seed in (11, 12, 13):
+        cells, energy = _run_replica(seed, simulation)
+        assert len(cells) > 0 and energy.sum() > 0
+
+    # The simulation's own vehicles are left at the start of their trajectories
+    assert [vehicle.odometer_reading for vehicle in simulation.vehicles] == odometer
+
+    # A replica depends only on its seed
+    first, second = _run_replica(12, simulation), _run_replica(12, simulation)
+    assert np.array_equal(first[0], second[0]) and (first[1] != second[1]).nnz == 0
+
+
+def test_workers_do_not_change_results(simulation):
+    serial = DemandEnsemble(simulation, seed=7)
+    serial.run(max_replicas=6, tolerance=None)
+    parallel = DemandEnsemble(simulation, seed=7)
+    parallel.run(max_replicas=6, tolerance=None, workers=3)
+
+    pd.testing.assert_frame_equal(serial.history, parallel.history)
+    assert np.array_equal(serial.cells.values, parallel.cells.values)
+    for statistic in ('mean', 'variance', 'p90'):
+        assert (serial.statistic(statistic) != parallel.statistic(statistic)).nnz == 0
+
+    # Every replica adds demand, so the replicas differ and the mean is their average
+    assert (serial.statistic('variance') > 0).nnz > 0
+    assert serial.history['mean_energy'].iloc[-1] > 0
+
+
+def test_streaming_moments_match_numpy():
+    rng = np.random.default_rng(1)
+    stream = rng.gamma(2, 3, (50, 8, 3))
+    stream[:20, 5:] = 0
+
+    # Rows entering late were zero for the arrays before them
+    moments = StreamingMoments((5, 3))
+    for i, x in enumerate(stream):
+        if i == 20:
+            moments.grow(3)
+        moments.update(x if i >= 20 else x[:5])
+
+    assert moments.count == 50
+    np.testing.assert_allclose(moments.mean, stream.mean(axis=0))
+    np.testing.assert_allclose(moments.variance, stream.var(axis=0, ddof=1))
+
+
+def p2_reference(observations, quantile):
+    # Scalar P-square estimate, following Jain and Chlamtac (1985)
+    heights = sorted(observations[:5])
+    positions = [1, 2, 3, 4, 5]
+    desired = [1, 1 + 2 * quantile, 1 + 4 * quantile, 3 + 2 * quantile, 5]
+    increments = [0, quantile / 2, quantile, (1 + quantile) / 2, 1]
+
+    for x in observations[5:]:
+        if x < heights[0]:
+            heights[0], cell = x, 0
+        elif x >= heights[4]:
+            heights[4], cell = x, 3
+        else:
+            cell = max(i for i in range(4) if heights[i] <= x)
+        for i in range(cell + 1, 5):
+            positions[i] += 1
+        desired = [d + increment for d, increment in zip(desired, increments)]
+
+        for i in (1, 2, 3):
+            d = desired[i] - positions[i]
+            if (d >= 1 and positions[i + 1] - positions[i] > 1) or (d <= -1 and positions[i - 1] - positions[i] < -1):
+                s = 1 if d > 0 else -1
+                q, n = heights, positions
+                parabolic = q[i] + s / (n[i + 1] - n[i - 1]) * (
+                    (n[i] - n[i - 1] + s) * (q[i + 1] - q[i]) / (n[i + 1] - n[i])
+                    + (n[i + 1] - n[i] - s) * (q[i] - q[i - 1]) / (n[i] - n[i - 1]))
+                if not q[i - 1] < parabolic < q[i + 1]:
+                    parabolic = q[i] + s * (q[i + s] - q[i]) / (n[i + s] - n[i])
+                heights[i] = parabolic
+                positions[i] += s
+
+    return heights[2]
+
+
+@pytest.mark.parametrize('quantile', [0.5, 0.9])
+def test_p2_quantile_matches_scalar_reference(quantile):
+    rng = np.random.default_rng(2)
+    stream = rng.gamma(2, 3, (400, 30))
+
+    sketch = P2Quantile(quantile, (30,))
+    for x in stream:
+        sketch.update(x)
+
+    reference = [p2_reference(list(stream[:, j]), quantile) for j in range(stream.shape[1])]
+    np.testing.assert_allclose(sketch.estimate, reference)
+
+    # And it approximates the exact quantile of a smooth distribution
+    exact = np.quantile(stream, quantile, axis=0)
+    assert np.median(np.abs(sketch.estimate - exact) / exact) < 0.1
+
+
+def test_p2_quantile_is_exact_before_five_observations():
+    stream = np.array([[3.0, 1.0], [1.0, 4.0], [2.0, 1.0]])
+
+    sketch = P2Quantile(0.9, (2,))
+    for x in stream:
+        sketch.update(x)
+
+    np.testing.assert_allclose(sketch.estimate, np.quantile(stream, 0.9, axis=0))
@@ -0,0 +1,64 @@
+import numpy as np
+import pandas as pd
+from src.general_utils import generate_hourly_charges
+
+
+def charge_events(starts, ends, tz=None):
+    n = len(starts)
+    return pd.DataFrame({'start_time': pd.to_datetime(starts).tz_localize(tz) if tz else pd.to_datetime(starts),
+                         'end_time': pd.to_datetime(ends).tz_localize(tz) if tz else pd.to_datetime(ends),
+                         'latitude': 34.0, 'longitude': -118.2, 'delta_soc': np.arange(1, n + 1) * 10.0,
+                         'energy': np.arange(1, n + 1) * 6.0, 'start_soc': 20.0,
+                         'vehicle_id': [f'vehicle_{i}' for i in range(n)]})
+
+
+def test_hourly_split_conserves_each_event():
+    charges = charge_events(['2020-01-15 08:10', '2020-01-15 09:00', '2020-01-15 22:30', '2020-01-15 12:15',
+                             '2020-01-15 15:00'],
+                            ['2020-01-15 08:50', '2020-01-15 12:00', '2020-01-17 01:30', '2020-01-15 12:15',
+                             '2020-01-15 16:00'])
+    hourly = generate_hourly_charges(charges)
+
+    # Every event keeps its kWh and state of charge, whatever hours it spans
+    totals = hourly.groupby('ID')[['energy', 'delta_soc']].sum()
+    np.testing.assert_allclose(totals['energy'], charges['energy'])
+    np.testing.assert_allclose(totals['delta_soc'], charges['delta_soc'])
+
+    # An event ending on the hour does not touch the next one, a zero length event keeps one hour
+    assert hourly.groupby('ID').size().tolist() == [1, 3, 28, 1, 1]
+    assert (hourly.groupby('ID')['vehicle_id'].first() == charges['vehicle_id']).all()
+
+
+def test_hourly_split_across_hour_and_midnight():
+    charges = charge_events(['2020-01-15 08:40', '2020-01-15 23:30'], ['2020-01-15 09:10', '2020-01-16 01:00'])
+    hourly = generate_hourly_charges(charges)
+
+    # 20 of 30 minutes before 09:00, 10 after
+    first = hourly[hourly['ID'] == 0]
+    assert first.index.tolist() == [pd.Timestamp('2020-01-15 08:00'), pd.Timestamp('2020-01-15 09:00')]
+    np.testing.assert_allclose(first['energy'], [4.0, 2.0])
+    assert first['hour'].tolist() == [8, 9]
+
+    # 30 of 90 minutes before midnight, then a full hour on the next day
+    second = hourly[hourly['ID'] == 1]
+    assert second['hour'].tolist() == [23, 0]
+    assert second.index[1] == pd.Timestamp('2020-01-16 00:00')
+    np.testing.assert_allclose(second['energy'], [4.0, 8.0])
+    np.testing.assert_allclose(second['delta_soc'], [20 / 3, 40 / 3])
+
+
+def test_hourly_split_keeps_local_hours():
+    # 21:45 to 00:15 local time, and 01:30 to 03:30 over the March change, which is one hour long
+    tz = 'America/Los_Angeles'
+    charges = charge_events(['2020-01-15 21:45', '2020-03-08 01:30'], ['2020-01-16 00:15', '2020-03-08 03:30'],
+                            tz=tz)
+    hourly = generate_hourly_charges(charges)
+    assert str(hourly.index.tz) == tz
+
+    evening = hourly[hourly['ID'] == 0]
+    assert evening['hour'].tolist() == [21, 22, 23, 0]
+    np.testing.assert_allclose(evening['energy'], [0.6, 2.4, 2.4, 0.6])
+
+    change = hourly[hourly['ID'] == 1]
+    assert change['hour'].tolist() == [1, 3]
+    np.testing.assert_allclose(change['energy'], [6.0, 6.0])
@@ -0,0 +1,93 @@
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pytest
+from h3 import h3
+from shapely.geometry import Polygon
+import src.grid as grid_module
+from src.grid import HexGrid, DemandPyramid
+from src.h3_utils import bin_by_hexagon
+
+# Region of the fake hexagonal grid, the points are well inside it
+REGION = {'type': 'Polygon', 'coordinates': [[[-118.5, 33.8], [-118.0, 33.8], [-118.0, 34.2], [-118.5, 34.2],
+                                              [-118.5, 33.8]]]}
+
+
+def fake_hexgrid(by_hour, resolution=8, hours=range(25)):
+    # generate_hexgrid over REGION rather than the LA shapefile
+    hexes = sorted(h3.polyfill(REGION, resolution, geo_json_conformant=True))
+    grid = gpd.GeoDataFrame({'hex_id': hexes, 'value': 0},
+                            geometry=[Polygon(h3.h3_to_geo_boundary(h, geo_json=True)) for h in hexes],
+                            crs='EPSG:4326')
+    if by_hour:
+        grid = grid.iloc[np.tile(np.arange(len(hexes)), len(hours))].reset_index(drop=True)
+        grid['hour'] = np.repeat(np.asarray(hours), len(hexes))
+    return grid
+
+
+@pytest.fixture
+def region(monkeypatch):
+    monkeypatch.setattr(grid_module, 'generate_hexgrid', fake_hexgrid)
+
+
+def charge_points(n=500, seed=0):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({'latitude': rng.normal(34.0, 0.02, n), 'longitude': rng.normal(-118.25, 0.02, n),
+                         'hour': rng.integers(0, 24, n), 'energy': rng.random(n) * 20})
+
+
+def test_sparse_join_matches_dense_merge(region):
+    points = charge_points()
+
+    # Points outside the grid's region and hours are dropped, as by the left merge onto the grid
+    outside = pd.DataFrame({'latitude': [35.0, 34.0], 'longitude': [-117.0, -118.25], 'hour': [3, 30],
+                            'energy': [5.0, 5.0]})
+    points = pd.concat([points, outside], ignore_index=True)
+
+    grid = HexGrid(8)
+    grid.join(points, ['hex_id', 'hour'], {'energy': 'sum'})
+
+    # The merge of the binned points onto every (hour, hexagon) of the grid, zero where no point was binned
+    df_aggreg = bin_by_hexagon(points, ['hex_id', 'hour'], {'energy': 'sum'}, 8)
+    dense = pd.merge(left=fake_hexgrid(by_hour=True)[['hex_id', 'hour', 'geometry']],
+                     right=df_aggreg[['hex_id', 'hour', 'energy']], on=['hex_id', 'hour'], how='left').fillna(0)
+    assert (dense['energy'] == 0).any() and len(df_aggreg) > 0
+
+    sparse = grid.to_frame()
+    pd.testing.assert_frame_equal(pd.DataFrame(sparse[['hex_id', 'hour', 'energy']]),
+                                  pd.DataFrame(dense[['hex_id', 'hour', 'energy']]), check_dtype=False)
+    assert sparse.geometry.geom_equals(dense.geometry).all()
+
+    # The nonzero cells are the binned points inside the grid
+    nonzero = grid.to_frame(nonzero=True, geometry=False).sort_values(['hex_id', 'hour']).reset_index(drop=True)
+    expected = dense[dense['energy'] != 0][['hex_id', 'hour', 'energy']].sort_values(['hex_id', 'hour'])
+    pd.testing.assert_frame_equal(nonzero, expected.reset_index(drop=True), check_dtype=False)
+
+
+def test_levels_roll_up_finest_cells():
+    points = charge_points()
+    pyramid = DemandPyramid(base_resolution=9, min_resolution=6, hours=range(24))
+    pyramid.join(points, {'energy': 'sum'})
+
+    finest = bin_by_hexagon(points, ['hex_id', 'hour'], {'energy': 'sum'}, 9)
+    for resolution in pyramid.resolutions:
+        # The finest cells grouped by their parent at the level
+        parents = finest.assign(hex_id=[h3.h3_to_parent(hex_id, resolution) for hex_id in finest['hex_id']])
+        expected = parents.groupby(['hex_id', 'hour'], as_index=False)['energy'].sum()
+
+        level = pyramid.to_frame(resolution).sort_values(['hex_id', 'hour']).reset_index(drop=True)
+        pd.testing.assert_frame_equal(level, expected, check_dtype=False)
+
+
+@pytest.mark.parametrize('resolution', [7, 8])
+def test_filled_grid_conserves_energy(region, resolution):
+    points = charge_points()
+    pyramid = DemandPyramid(base_resolution=8, min_resolution=7)
+    pyramid.join(points, {'energy': 'sum'})
+
+    grid = pyramid.fill_grid(HexGrid(resolution))
+    assert grid.demand['energy'].sum() == pytest.approx(points['energy'].sum())
+
+    # Each hour keeps its energy
+    hourly = points.groupby('hour')['energy'].sum().reindex(grid.hours, fill_value=0)
+    np.testing.assert_allclose(np.asarray(grid.demand['energy'].sum(axis=0)).ravel(), hourly.values)
@@ -0,0 +1,37 @@
+import json
+import numpy as np
+import pandas as pd
+from h3 import h3
+from geojson.feature import Feature, FeatureCollection
+from src import h3_utils
+from src.h3_utils import hexagons_dataframe_to_geojson, hex_geojson
+
+
+def reference_geojson(df_hex):
+    # The collection as built feature by feature before write_geojson
+    features = [Feature(geometry=row["geometry"], id=row["hex_id"],
+                        properties={col: row[col] for col in df_hex.columns.drop('geometry', 'hex_id')})
+                for i, row in df_hex.iterrows()]
+    return json.dumps(FeatureCollection(features))
+
+
+def hourly_hexagons(hour, center=(34.05, -118.25)):
+    rng = np.random.default_rng(hour)
+    hex_ids = list(h3.k_ring(h3.geo_to_h3(*center, 8), 2))
+    return pd.DataFrame({'hex_id': hex_ids, 'hour': hour, 'energy': rng.random(len(hex_ids)) * 100,
+                         'count': rng.integers(0, 10, len(hex_ids)), 'geometry': hex_geojson(hex_ids).values})
+
+
+def test_streamed_geojson_matches_feature_collection(monkeypatch):
+    monkeypatch.setattr(h3_utils, '_geometry_fragments', h3_utils.OrderedDict())
+
+    # The maps of later hours reuse the geometries serialized for the first
+    for hour in range(3):
+        df_hex = hourly_hexagons(hour)
+        assert hexagons_dataframe_to_geojson(df_hex) == reference_geojson(df_hex)
+
+    # Only as many geometries as hexagon boundaries are kept, the most recently written
+    monkeypatch.setattr(h3_utils, 'HEX_BOUNDARY_CACHE_SIZE', 5)
+    df_hex = hourly_hexagons(3, center=(33.95, -118.4))
+    assert hexagons_dataframe_to_geojson(df_hex) == reference_geojson(df_hex)
+    assert list(h3_utils._geometry_fragments) == df_hex['hex_id'].tolist()[-5:]
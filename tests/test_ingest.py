@@ -0,0 +1,51 @@
+import numpy as np
+import pandas as pd
+import pytest
+from src.components import Vehicle
+from src.ingest import stream_trajectories, LA_MSA
+
+
+def write_telemetry(path, times):
+    # One vehicle pinging at the input local times, written with their offsets as in the export
+    local = pd.DatetimeIndex(times).tz_convert('America/Los_Angeles')
+    offsets = local.strftime('%Y-%m-%d %H:%M:%S%z').str.replace(r'(\d\d)(\d\d)$', r'\1:\2', regex=True)
+    pd.DataFrame({'hashed_vin': 'vin', 'odo_read': np.arange(len(times), dtype=np.float64),
+                  'element_time_local': offsets, 'decr_lat': 34.0, 'decr_lng': -118.2,
+                  'msa_name': LA_MSA}).to_csv(path, index=False)
+
+
+def test_chunks_across_daylight_saving_share_utc_times(tmp_path):
+    # Hourly pings over the March change, read in chunks with one offset and chunks with both
+    times = pd.date_range('2020-03-07 12:00', '2020-03-09 12:00', freq='H', tz='UTC')
+    write_telemetry(tmp_path / 'part_0.csv', times)
+
+    trajectories = list(stream_trajectories(str(tmp_path / 'part_*.csv'), partitions=1, chunk_size=7))
+    assert len(trajectories) == 1
+
+    arrays = trajectories[0]
+    assert arrays.tz == 'America/Los_Angeles'
+    np.testing.assert_array_equal(arrays.times, times.values.astype(np.int64))
+
+    # Local times follow the zone's offset on each side of the change
+    vehicle = Vehicle.from_arrays(arrays)
+    for reading in (10, 40):
+        vehicle.odometer_reading = reading - 1
+        vehicle.drive(1)
+        assert vehicle.time == times[reading].tz_convert('America/Los_Angeles')
+
+
+def test_local_times_repeated_by_daylight_saving_are_dropped(tmp_path):
+    # Pings without an offset every 20 minutes over the November change, where 01:00 to 02:00 happens twice
+    local = pd.date_range('2020-10-31 23:00', '2020-11-01 04:00', freq='20T')
+    pd.DataFrame({'hashed_vin': 'vin', 'odo_read': np.arange(len(local), dtype=np.float64),
+                  'element_time_local': local.strftime('%Y-%m-%d %H:%M:%S'), 'decr_lat': 34.0, 'decr_lng': -118.2,
+                  'msa_name': LA_MSA}).to_csv(tmp_path / 'part_0.csv', index=False)
+
+    with pytest.warns(UserWarning, match='Dropped 3 rows'):
+        trajectories = list(stream_trajectories(str(tmp_path / 'part_*.csv'), partitions=1, chunk_size=4))
+
+    # The repeated hour's pings are dropped and the others keep their UTC times
+    arrays = trajectories[0]
+    kept = local[(local.hour != 1)].tz_localize('America/Los_Angeles').tz_convert('UTC')
+    np.testing.assert_array_equal(arrays.times, kept.values.astype(np.int64))
+    np.testing.assert_array_equal(arrays.odometer, np.flatnonzero(local.hour != 1))
@@ -0,0 +1,90 @@
+import os
+import numpy as np
+import pandas as pd
+import pytest
+from h3 import h3
+from shapely.geometry import Polygon
+from src.lp_bundle import InputBundle, PARAM_INDEX
+from src.lp_sparse import sparse_linear_program, PARAM_FILES
+
+
+def loaded(**kwargs):
+    lp = sparse_linear_program(**kwargs)
+    lp.load()
+    return lp
+
+
+def test_bundle_round_trip(lp_inputs, tmp_path):
+    bundle = InputBundle.from_csv(lp_inputs, str(tmp_path / 'inputs.bundle'))
+    assert bundle.validate() == []
+
+    # A bundle read back from disk loads the same sets, parameters and incidence as the csv files
+    csv, read = loaded(input_dir=lp_inputs), loaded(bundle=str(tmp_path / 'inputs.bundle'))
+    for name in ['B', 'K', 'T', 'L']:
+        assert csv.sets[name].astype(str).equals(read.sets[name].astype(str))
+    for name in PARAM_FILES:
+        np.testing.assert_array_equal(read._dense(name), csv._dense(name))
+    assert (read.incidence != csv.incidence).nnz == 0
+
+    # As do the geometries of the nodes
+    hex_ids = [h3.geo_to_h3(34.0, -118.2 + 0.01 * i, 8) for i in range(3)]
+    polygons = [Polygon(h3.h3_to_geo_boundary(hex_id, geo_json=True)) for hex_id in hex_ids]
+    bundle.write_geometry({'hex_id': hex_ids, 'geometry': polygons})
+    geometry = InputBundle(bundle.path).read_geometry()
+    assert geometry['hex_id'].tolist() == hex_ids
+    assert all(a.equals(b) for a, b in zip(geometry.geometry, polygons))
+
+
+def test_validate_reports_missing_arrays(lp_inputs, tmp_path):
+    bundle = InputBundle.from_csv(lp_inputs, str(tmp_path / 'inputs.bundle'))
+    os.remove(os.path.join(bundle.path, 'param_VW_T.npy'))
+    os.remove(os.path.join(bundle.path, 'set_L.npy'))
+
+    errors = InputBundle(bundle.path).validate()
+    assert "Missing array set_L of set L" in errors
+    assert "Missing arrays ['param_VW_T'] of parameter VW" in errors
+
+    # And loading it into the LP fails with them
+    with pytest.raises(ValueError, match='Missing arrays'):
+        loaded(bundle=bundle.path)
+
+
+def test_validate_reports_missing_parameters(tmp_path):
+    bundle = InputBundle(str(tmp_path / 'empty.bundle'))
+    assert set(bundle.validate()) == {f"Missing set {name}" for name in 'BKTL'} | \
+        {f"Missing parameter {name}" for name in PARAM_INDEX}
+
+
+def test_validate_reports_mismatched_incidence_labels(lp_inputs, tmp_path):
+    bundle = InputBundle.from_csv(lp_inputs, str(tmp_path / 'inputs.bundle'))
+
+    # Incidence entries of lines that are not in L
+    (b, l), p = bundle.read_param('p', mmap=False)
+    bundle.write_param('p', [b, l + len(bundle.read_set('L'))], p)
+    assert bundle.validate() == ["Parameter p has codes outside its sets"]
+
+    # Labels outside the sets are dropped when writing from a frame, unless the sets are extended
+    nodes, lines = bundle.read_set('B', mmap=False), bundle.read_set('L', mmap=False)
+    frame = {'B': [nodes[0], 'unknown_node'], 'L': [lines[0], lines[0]], 'p': [1.0, -1.0]}
+    bundle.write_param_frame('p', pd.DataFrame(frame))
+    assert bundle.read_param('p')[1].tolist() == [1.0]
+    assert bundle.validate() == []
+
+
+def test_validate_reports_wrong_shaped_demand(lp_inputs, tmp_path):
+    bundle = InputBundle.from_csv(lp_inputs, str(tmp_path / 'inputs.bundle'))
+    (b, t), a = bundle.read_param('A', mmap=False)
+
+    # Demand for more hours than T
+    bundle.write_param('A', [b, t + len(bundle.read_set('T'))], a)
+    assert bundle.validate() == ["Parameter A has codes outside its sets"]
+
+    # Demand by node only, or with index and value arrays of different lengths
+    with pytest.raises(ValueError, match=r"indexed by \['B', 'T'\], got 1"):
+        bundle.write_param('A', [b], a)
+    bundle.write_param('A', [b, t[:-1]], a)
+    assert bundle.validate() == ["Parameter A has index and value arrays of different lengths"]
+
+    # Or twice for a cell
+    bundle.write_param('A', [np.r_[b, b[:1]], np.r_[t, t[:1]]], np.r_[a, a[:1]])
+    assert bundle.validate() == ["Parameter A has duplicate entries"]
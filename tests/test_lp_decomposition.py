@@ -0,0 +1,32 @@
+import pytest
+from src import lp_decomposition
+from src.lp_decomposition import benders_decomposition
+from src.lp_sparse import sparse_linear_program
+
+
+def monolithic_objective(input_dir):
+    lp = sparse_linear_program(input_dir)
+    lp.load()
+    lp.build()
+    return lp.solve('highs')['objective']
+
+
+@pytest.mark.parametrize('window', [1, 4])
+def test_benders_matches_monolithic_objective(lp_inputs, window):
+    expected = monolithic_objective(lp_inputs)
+
+    solution = benders_decomposition(lp_inputs, window=window, solver='appsi_highs').solve(tolerance=1e-6)
+    assert solution['lower_bound'] <= expected * (1 + 1e-6)
+    assert solution['objective'] == pytest.approx(expected, rel=1e-5)
+
+    # No unmet demand at the optimum, the penalty is above the cost of serving it
+    assert solution['u'].max() == pytest.approx(0, abs=1e-6)
+
+
+def test_subproblem_duals_without_highs_linprog(lp_inputs, monkeypatch):
+    # SciPy before 1.7 has no linprog row duals, the subproblems then go through Pyomo's dual suffix
+    expected = benders_decomposition(lp_inputs, solver='appsi_highs').solve(tolerance=1e-6)
+
+    monkeypatch.setattr(lp_decomposition, '_highs_linprog', lambda: None)
+    solution = benders_decomposition(lp_inputs, solver='appsi_highs').solve(tolerance=1e-6)
+    assert solution['objective'] == pytest.approx(expected['objective'], rel=1e-6)
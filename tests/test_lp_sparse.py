@@ -0,0 +1,36 @@
+import numpy as np
+import pytest
+from pyomo.environ import value
+from conftest import write_lp_inputs
+from src.lp_model import linear_program
+from src.lp_solvers import solver_backend, OPTIMAL
+from src.lp_sparse import sparse_linear_program
+
+
+def test_sparse_build_matches_pyomo_model(tmp_path, monkeypatch):
+    # linear_program reads its inputs from the data directory relative to the working directory
+    input_dir = tmp_path / 'data' / 'interim' / 'lp_data' / 'input_data'
+    input_dir.mkdir(parents=True)
+    write_lp_inputs(input_dir)
+    (tmp_path / 'notebooks').mkdir()
+    monkeypatch.chdir(tmp_path / 'notebooks')
+
+    instance = linear_program().load()
+    record = solver_backend('highs').solve(instance)
+    assert record['status'] == OPTIMAL
+
+    lp = sparse_linear_program(str(input_dir) + '/')
+    lp.load()
+    lp.build()
+    solution = lp.solve('highs')
+
+    assert solution['objective'] == pytest.approx(value(instance.OBJ), rel=1e-9)
+
+    # Same values of every variable, in the sparse column order
+    B, K, T, L = (lp.sets[name] for name in ['B', 'K', 'T', 'L'])
+    expected = {'v': [[instance.v[b].value for b in B]],
+                'x': [[instance.x[b, k].value for k in K] for b in B],
+                'y': [[[instance.y[b, k, t].value for t in T] for k in K] for b in B],
+                'f': [[instance.f[l, t].value for t in T] for l in L]}
+    for name, values in expected.items():
+        np.testing.assert_allclose(solution[name], np.reshape(values, solution[name].shape), atol=1e-6)
@@ -0,0 +1,32 @@
+import pandas as pd
+from src.simulation import Simulation
+from conftest import UniformChargeLocationModel, FullChargeAmountModel
+
+
+def simulate(vehicles, workers=1, seed=5):
+    simulation = Simulation(vehicles, UniformChargeLocationModel(), FullChargeAmountModel(), seed=seed,
+                            workers=workers, chunk_size=2)
+    events = pd.DataFrame(simulation.simulate().drop(columns='geometry'))
+    return {vehicle_id: df.reset_index(drop=True) for vehicle_id, df in events.groupby('vehicle_id')}
+
+
+def test_vehicle_streams_follow_identifiers(fleet):
+    everyone = simulate(fleet(5))
+
+    # A vehicle's events do not depend on the other vehicles simulated with it, or on their order
+    alone = simulate(fleet(5)[3:4])
+    pd.testing.assert_frame_equal(alone['vehicle_3'], everyone['vehicle_3'])
+
+    reordered = simulate(fleet(5)[::-1])
+    for vehicle_id, events in everyone.items():
+        pd.testing.assert_frame_equal(reordered[vehicle_id], events)
+
+    # Nor on the number of workers
+    parallel = simulate(fleet(5), workers=2)
+    for vehicle_id, events in everyone.items():
+        pd.testing.assert_frame_equal(parallel[vehicle_id], events)
+
+
+def test_vehicle_streams_follow_seed(fleet):
+    first, second = simulate(fleet(2), seed=5), simulate(fleet(2), seed=6)
+    assert not first['vehicle_0'].equals(second['vehicle_0'])